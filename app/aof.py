@@ -0,0 +1,221 @@
+import logging
+import os
+
+from gevent.monkey import get_original
+
+from background import BackgroundChild
+from protocol_handler import ProtocolHandler, RequestParser
+
+
+logger = logging.getLogger(__name__)
+
+FSYNC_ALWAYS = 'always'
+FSYNC_EVERYSEC = 'everysec'
+FSYNC_NO = 'no'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_EVERYSEC, FSYNC_NO)
+
+READ_SIZE = 2**20
+
+# with gevent's monkey patching these would be greenlets, the everysec fsync
+# has to happen in a real thread to keep off the loop
+start_new_thread, = get_original('_thread', ['start_new_thread'])
+sleep = get_original('time', 'sleep')
+
+
+class AppendOnlyFile:
+    """
+    Log of the write commands applied to the keyspace, in the wire format so
+    it is replayed with the same parser the server uses.
+
+    Commands are buffered by `append` and written out by `flush`, which the
+    server calls once per batch of requests before sending the replies, so one
+    write (and with `always` one fsync) covers the whole batch. With
+    `everysec` a background thread fsyncs once a second, so a slow disk
+    doesn't hold up the clients.
+
+    `start_rewrite` forks a child that writes the minimal commands recreating
+    the keyspace to a new file. Commands logged meanwhile are also kept in a
+    rewrite buffer, appended to the new file once the child is done, right
+    before it replaces the old one.
+    """
+    def __init__(self, filename, fsync=FSYNC_EVERYSEC, rewrite_min_size=64 * 2**20,
+                 rewrite_percentage=100):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy {fsync}')
+        self.filename = filename
+        self.fsync = fsync
+        self.rewrite_min_size = rewrite_min_size
+        self.rewrite_percentage = rewrite_percentage
+        self._protocol = ProtocolHandler()
+        self._buf = bytearray()
+        self._fh = None
+        self._dirty = False
+        self._syncing = False
+        self.size = 0
+        # size right after the last rewrite, growth is measured against it
+        self.base_size = 0
+        self._rewrite = None
+        self._rewrite_buf = None
+        self.last_rewrite_status = b'ok'
+
+    def _open(self):
+        self._fh = open(self.filename, 'ab', buffering=0)
+        self.size = self.base_size = os.fstat(self._fh.fileno()).st_size
+
+    def load(self, execute):
+        """
+        Replay the log through `execute(command, *args)`. A command cut short
+        by a crash is dropped and truncated away, returns the number replayed.
+        """
+        n = 0
+        if os.path.exists(self.filename):
+            parser = RequestParser()
+            with open(self.filename, 'rb') as fh:
+                while True:
+                    data = fh.read(READ_SIZE)
+                    if not data:
+                        break
+                    parser.feed(data)
+                    for request in parser.parse():
+                        execute(request[0].upper(), *request[1:])
+                        n += 1
+                size = fh.tell()
+            if parser.offset < size:
+                logger.warning(f'Truncating {size - parser.offset} bytes of '
+                               f'incomplete command from {self.filename}')
+                os.truncate(self.filename, parser.offset)
+        self._open()
+        if self.fsync == FSYNC_EVERYSEC and not self._syncing:
+            self._syncing = True
+            start_new_thread(self._fsync_loop, ())
+        return n
+
+    def _fsync_loop(self):
+        while self._fh is not None:
+            sleep(1)
+            fh = self._fh
+            if fh is None or not self._dirty:
+                continue
+            self._dirty = False
+            # a duplicate, the file may be closed and swapped meanwhile
+            try:
+                fd = os.dup(fh.fileno())
+            except (OSError, ValueError):
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                logger.exception('Unable to fsync the append only file')
+            finally:
+                os.close(fd)
+        self._syncing = False
+
+    def append(self, args):
+        self._protocol.encode(self._buf, args)
+        if self._rewrite_buf is not None:
+            self._protocol.encode(self._rewrite_buf, args)
+
+    def flush(self):
+        if not self._buf:
+            return
+        self._fh.write(self._buf)
+        self.size += len(self._buf)
+        del self._buf[:]
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(self._fh.fileno())
+        else:
+            self._dirty = True
+
+    def cron(self):
+        self.flush()
+        return self.poll_rewrite()
+
+    def close(self):
+        if self._fh is None:
+            return
+        self.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        self._fh = None
+        if self._rewrite is not None:
+            self._rewrite.kill()
+            self._rewrite = None
+            self._remove_tmp()
+
+    @property
+    def rewriting(self):
+        return self._rewrite is not None
+
+    def needs_rewrite(self):
+        if self._rewrite is not None or self.rewrite_percentage <= 0:
+            return False
+        if self.size < self.rewrite_min_size:
+            return False
+        growth = (self.size - self.base_size) * 100 / max(self.base_size, 1)
+        return growth >= self.rewrite_percentage
+
+    @property
+    def _tmp_filename(self):
+        return f'{self.filename}.rewrite.tmp'
+
+    def _remove_tmp(self):
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+
+    def _write_rewrite(self, commands, report):
+        buf = bytearray()
+        written = 0
+        with open(self._tmp_filename, 'wb') as fh:
+            for args in commands():
+                self._protocol.encode(buf, args)
+                if len(buf) >= READ_SIZE:
+                    fh.write(buf)
+                    written += len(buf)
+                    report(written)
+                    del buf[:]
+            fh.write(buf)
+            fh.flush()
+            os.fsync(fh.fileno())
+        return True
+
+    def start_rewrite(self, commands):
+        """Rewrite the log from `commands()`, an iterable of argument lists."""
+        if self._rewrite is not None:
+            return False
+        # everything buffered so far is part of the keyspace the child sees
+        self.flush()
+        child = BackgroundChild(lambda report: self._write_rewrite(commands, report))
+        child.start()
+        self._rewrite = child
+        self._rewrite_buf = bytearray()
+        return True
+
+    def poll_rewrite(self):
+        child = self._rewrite
+        if child is None:
+            return
+        ok = child.poll()
+        if ok is None:
+            return
+        self._rewrite = None
+        rewrite_buf, self._rewrite_buf = self._rewrite_buf, None
+        if ok:
+            try:
+                with open(self._tmp_filename, 'ab') as fh:
+                    fh.write(rewrite_buf)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                self.flush()
+                os.replace(self._tmp_filename, self.filename)
+            except OSError:
+                logger.exception('Unable to install rewritten append only file')
+                self._remove_tmp()
+                ok = False
+            else:
+                self._fh.close()
+                self._open()
+                self._dirty = False
+        else:
+            self._remove_tmp()
+        self.last_rewrite_status = b'ok' if ok else b'err'
+        return ok
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import socket
+import threading
+
+from protocol_handler import RequestParser
+from exc import ClientQuit, Shutdown, Subscribed, Replicate
+from pubsub import Subscriber
+
+
+logger = logging.getLogger(__name__)
+
+
+class TransportSubscriber(Subscriber):
+    # writes are collected and handed to the transport once per loop
+    # iteration, the transport buffers whatever can't be sent right away
+    def __init__(self, transport, limit=0):
+        super().__init__(limit)
+        self._transport = transport
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        transport = self._transport
+        if transport.is_closing():
+            return
+        self._size += len(data)
+        if self.limit and transport.get_write_buffer_size() + self._size > self.limit:
+            logger.warning(f'Disconnecting subscriber over its {self.limit} bytes output buffer limit')
+            self._chunks = []
+            transport.abort()
+            return
+        self._chunks.append(data)
+        if len(self._chunks) == 1:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        chunks, self._chunks = self._chunks, []
+        self._size = 0
+        if chunks and not self._transport.is_closing():
+            self._transport.write(b''.join(chunks))
+
+
+class ConnectionProtocol(asyncio.Protocol):
+    # received bytes go straight into the parser, the replies to everything
+    # parsed from one read are written with a single transport.write
+    def __init__(self, server):
+        self._server = server
+        self._parser = RequestParser()
+        self._out = bytearray()
+        self._transport = None
+        self._address = None
+        self._client = None
+        # set while blocked on an empty list, what arrives meanwhile is only
+        # buffered, reading goes on so a disconnect is still noticed
+        self._waiter = None
+        self._timer = None
+        # set in push mode
+        self._subscriber = None
+        # set once the client turned out to be a replica
+        self._replica = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._address = transport.get_extra_info('peername')
+        self._client = f'{self._address[0]}:{self._address[1]}'.encode('utf-8')
+        logger.info(f'Request received on address {self._address[0]}:{self._address[1]}')
+        self._server.client_connected()
+
+    def connection_lost(self, exc):
+        logger.info(f'Finished reading request at {self._address[0]}:{self._address[1]}')
+        self._server.client_disconnected(self._client)
+        if self._waiter is not None:
+            self._server.finish_wait(self._waiter)
+            self._waiter = None
+            self._cancel_timer()
+        if self._subscriber is not None:
+            self._server.unsubscribe_all(self._subscriber)
+            self._subscriber = None
+        if self._replica is not None:
+            self._server.detach_replica(self._replica)
+            self._replica = None
+
+    def data_received(self, data):
+        if self._replica is not None:
+            return
+        if self._waiter is not None:
+            self._parser.feed(data)
+            return
+        if self._subscriber is not None:
+            self._parser.feed(data)
+            self._push(self._parser.parse())
+            return
+        self._process(self._server.handle_data, self._parser, data, self._out,
+                      client=self._client)
+
+    def _process(self, func, *args, **kwargs):
+        out = self._out
+        blocked = None
+        try:
+            blocked = func(*args, **kwargs)
+        except Subscribed as e:
+            self._transport.write(out)
+            del out[:]
+            self._subscriber = TransportSubscriber(self._transport,
+                                                   self._server.pubsub_buffer_limit)
+            self._push(e.requests)
+            return
+        except Replicate as e:
+            self._transport.write(out)
+            del out[:]
+            self._replica = TransportSubscriber(self._transport, self._server.replica_buffer_limit)
+            self._server.attach_replica(self._replica, self._client, e)
+            return
+        except ClientQuit:
+            logger.info(f'Client exited: {self._address[0]}:{self._address[1]}')
+            self._transport.write(out)
+            self._transport.close()
+        except Shutdown:
+            self._server.shutdown()
+            self._transport.write(out)
+            # propagates out of the event loop like it does with gevent
+            raise KeyboardInterrupt
+        except Exception as e:
+            logger.error(f'Error processing request. {str(e)}')
+        else:
+            self._transport.write(out)
+        del out[:]
+        if blocked is not None:
+            self._block(*blocked)
+
+    def _push(self, requests):
+        subscriber = self._subscriber
+        try:
+            rest = self._server.handle_pubsub(subscriber, requests)
+        except ClientQuit:
+            logger.info(f'Client exited: {self._address[0]}:{self._address[1]}')
+            subscriber.flush()
+            self._transport.close()
+            return
+        # replies go out ahead of anything written directly after this
+        subscriber.flush()
+        if rest is not None:
+            # no subscriptions left, back to normal
+            self._subscriber = None
+            self._process(self._server.handle_requests, rest, self._out, client=self._client)
+
+    def _block(self, waiter, requests):
+        # the requests after a blocking command wait for its reply
+        loop = asyncio.get_running_loop()
+        self._waiter = waiter
+        waiter.notify = lambda: loop.call_soon(self._unblock, waiter, requests)
+        if waiter.timeout:
+            self._timer = loop.call_later(waiter.timeout, self._unblock, waiter, requests)
+
+    def _unblock(self, waiter, requests):
+        if self._waiter is not waiter:
+            return
+        self._waiter = None
+        self._cancel_timer()
+        self._process(self._server.resume_requests, waiter, requests, self._out,
+                      client=self._client)
+        if self._waiter is None and not self._transport.is_closing():
+            self.data_received(b'')
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    # stop reading from clients that don't read their replies
+    def pause_writing(self):
+        self._transport.pause_reading()
+
+    def resume_writing(self):
+        self._transport.resume_reading()
+
+
+class AsyncioStreamServer:
+    def __init__(self, address, server, backlog=128):
+        self.address = address
+        self.server = server
+        self.backlog = backlog
+        self._periodic = []
+        self._threads = []
+        self._loop = None
+
+    def call_periodic(self, func, interval):
+        self._periodic.append((func, interval))
+
+    def call_in_thread(self, func):
+        # started once the event loop runs
+        self._threads.append(func)
+
+    def threadsafe(self, func):
+        """`func` for other threads to call, it runs in the event loop."""
+        def call(*args):
+            self._loop.call_soon_threadsafe(func, *args)
+        return call
+
+    def _schedule(self, loop, func, interval):
+        def run():
+            try:
+                func()
+            except Exception as e:
+                logger.exception(f'Error running {func.__name__}. {str(e)}')
+            loop.call_later(interval, run)
+        loop.call_later(interval, run)
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        factory = lambda: ConnectionProtocol(self.server)
+        if isinstance(self.address, socket.socket):
+            server = await loop.create_server(factory, sock=self.address,
+                                              backlog=self.backlog)
+        else:
+            host, port = self.address
+            server = await loop.create_server(factory, host, port,
+                                              reuse_address=True,
+                                              backlog=self.backlog)
+        for func, interval in self._periodic:
+            self._schedule(loop, func, interval)
+        self._loop = loop
+        for func in self._threads:
+            threading.Thread(target=func, daemon=True).start()
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
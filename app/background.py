@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundChild:
+    """
+    Runs `target(report)` in a forked child so it works on a copy-on-write
+    snapshot of the parent's memory without blocking it.
+
+    The child reports progress by calling `report(n)`, which is sent back over
+    a pipe, and its exit status tells the parent whether `target` succeeded.
+    The parent calls `poll` periodically to collect both.
+    """
+    def __init__(self, target):
+        self._target = target
+        self.pid = None
+        self.progress = 0
+        self.started = None
+        self._reader = None
+        self._pending = b''
+
+    def start(self):
+        if not hasattr(os, 'fork'):
+            raise OSError('fork is not supported on this platform')
+        reader, writer = os.pipe()
+        self.started = time.time()
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            self._run(writer)
+        os.close(writer)
+        os.set_blocking(reader, False)
+        self.pid = pid
+        self._reader = reader
+        return pid
+
+    def _run(self, writer):
+        def report(n):
+            try:
+                os.write(writer, b'%d\n' % n)
+            except OSError:
+                pass
+
+        status = 1
+        try:
+            if self._target(report):
+                status = 0
+        except BaseException:
+            logger.exception('Background child failed')
+        finally:
+            # skip the parent's atexit handlers and buffered file flushes
+            os._exit(status)
+
+    def _read_progress(self):
+        while True:
+            try:
+                data = os.read(self._reader, 4096)
+            except BlockingIOError:
+                return
+            if not data:
+                return
+            lines = (self._pending + data).split(b'\n')
+            self._pending = lines.pop()
+            if lines:
+                self.progress = int(lines[-1])
+
+    def poll(self):
+        """Return None while the child is running, True or False once it exited."""
+        self._read_progress()
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return
+        self._read_progress()
+        os.close(self._reader)
+        return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+    def kill(self):
+        try:
+            os.kill(self.pid, 9)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        os.close(self._reader)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
@@ -1,5 +1,10 @@
+from bisect import bisect
+from collections import namedtuple, OrderedDict
+from hashlib import md5
+import os
 import socket
 from gevent.thread import get_ident
+import threading
 import time
 import heapq
 
@@ -8,14 +13,26 @@ from exc import CommandError
 from const import Error
 
 
+# pattern is None for messages received through a channel subscription
+Message = namedtuple('Message', ('channel', 'data', 'pattern'))
+
+# seconds between attempts to listen for invalidations again
+TRACKING_RECONNECT_INTERVAL = 1
+# commands replacing the whole keyspace, a cache drops everything for them
+FLUSH_COMMANDS = frozenset((b'FLUSH', b'FLUSHALL', b'RESTORE', b'MERGE'))
+_MISSING = object()
+
+
 class SocketPool:
-    def __init__(self, host, port, max_age=60):
+    def __init__(self, host, port, max_age=60, on_connect=None):
         self.host = host
         self.port = port
         self.max_age = max_age
         self.free = []
         self.in_use = {}
         self._tid = get_ident
+        # called with every new connection before it is used
+        self.on_connect = on_connect
     
     def checkout(self):
         now = time.time()
@@ -45,7 +62,15 @@ class SocketPool:
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         conn.connect((self.host, self.port))
-        return conn.makefile('rwb')
+        sock = conn.makefile('rwb')
+        if self.on_connect is not None:
+            try:
+                self.on_connect(sock)
+            except Exception:
+                sock.close()
+                conn.close()
+                raise
+        return sock
 
     def checkin(self):
         tid = self._tid()
@@ -67,24 +92,123 @@ class SocketPool:
             return True
         return False
     
+class LocalCache:
+    """
+    The values a Client read last, up to `max_size` of them. Only used while
+    the client listens for invalidations, each of which drops the keys it
+    names, or everything for None.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.ready = False
+        # bumped by every invalidation, a value read before one isn't stored
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key):
+        data = self._data
+        try:
+            value = data[key]
+            data.move_to_end(key)
+        except (KeyError, TypeError):
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, epoch):
+        data = self._data
+        with self._lock:
+            if epoch != self.epoch or not self.ready:
+                return
+            try:
+                data[key] = value
+            except TypeError:
+                return
+            data.move_to_end(key)
+            if len(data) > self.max_size:
+                data.popitem(last=False)
+    
+    def invalidate(self, keys):
+        with self._lock:
+            self.epoch += 1
+            if keys is None:
+                self._data.clear()
+                return
+            for key in keys:
+                try:
+                    self._data.pop(key, None)
+                except TypeError:
+                    pass
+    
+    def forget(self, args):
+        """
+        Drop what a command about to be sent may change. The client's own
+        writes can't wait for the server's invalidation, the keys of every
+        command but GET and MGET are dropped along with them.
+        """
+        if args[0] in (b'GET', b'MGET'):
+            return
+        if args[0] in FLUSH_COMMANDS:
+            self.invalidate(None)
+            return
+        keys = []
+        for arg in args[1:]:
+            if isinstance(arg, dict):
+                keys.extend(arg)
+            elif isinstance(arg, (str, bytes)):
+                keys.append(arg)
+        self.invalidate(keys)
+    
+    def reset(self, ready):
+        with self._lock:
+            self.epoch += 1
+            self.ready = ready
+            self._data.clear()
+
+
 class Client:
-    def __init__(self, host='127.0.0.1', port=8888, pool_max_age=60):
+    def __init__(self, host='127.0.0.1', port=8888, pool_max_age=60, cache_size=0):
         self._host = host
         self._port = port
         
         self._protocol = ProtocolHandler()
         self._socket_pool = SocketPool(host, port, pool_max_age)
         
+        # with a cache_size, values read by GET are cached and the server
+        # tracks them, invalidations arrive on a channel of this client's own
+        self._cache = None
+        if cache_size:
+            self._cache = LocalCache(cache_size)
+            self._tracking_channel = b'__tracking__:' + os.urandom(16).hex().encode('ascii')
+            self._socket_pool.on_connect = self._track
+            threading.Thread(target=self._listen, daemon=True).start()
     
     def execute(self, *args):
+        if self._cache is not None:
+            self._cache.forget(args)
+        return self._receive(self._send(args), args)
+
+    # a command is written and its reply read separately so ShardedClient
+    # can have several servers working at once
+    def _send(self, args):
         socket_file = self._socket_pool.checkout()
-        close_conn = args[0] in (b'QUIT', b'SHUTDOWN')
         self._protocol.write_response(socket_file, args)
+        return socket_file
+
+    def _receive(self, socket_file, args):
+        close_conn = args[0] in (b'QUIT', b'SHUTDOWN')
         try:
             resp = self._protocol.handle_request(socket_file)
         except EOFError:
             self._socket_pool.close()
-            raise Exception('server went away')
+            raise ConnectionError('server went away')
         except Exception:
             self._socket_pool.close()
             raise Exception('internal server error')
@@ -97,6 +221,41 @@ class Client:
             raise CommandError(resp.message)
         return resp
     
+    def pipeline(self, batch_size=1000):
+        return Pipeline(self, batch_size)
+    
+    def _track(self, socket_file):
+        self._protocol.write_response(
+            socket_file, (b'CLIENT', b'TRACKING', b'ON', self._tracking_channel))
+        resp = self._protocol.handle_request(socket_file)
+        if isinstance(resp, Error):
+            raise CommandError(resp.message)
+    
+    def _listen(self):
+        cache = self._cache
+        while True:
+            try:
+                with Subscription(self._host, self._port) as sub:
+                    sub.subscribe(self._tracking_channel)
+                    sub._read()
+                    # anything cached may have changed while nobody listened
+                    cache.reset(ready=True)
+                    for message in sub:
+                        cache.invalidate(message.data)
+            except (OSError, EOFError):
+                pass
+            finally:
+                # anything else is a bug, the cache stays off and it surfaces
+                cache.reset(ready=False)
+            time.sleep(TRACKING_RECONNECT_INTERVAL)
+    
+    def cache_info(self):
+        cache = self._cache
+        if cache is None:
+            return None
+        return {'size': len(cache), 'max_size': cache.max_size, 'hits': cache.hits,
+                'misses': cache.misses, 'listening': cache.ready}
+    
     def command(cmd):
         def method(self, *args):
             return self.execute(cmd.encode('utf-8'), *args)
@@ -109,7 +268,6 @@ class Client:
     decrby = command('DECRBY')
     delete = command('DELETE')
     exists = command('EXISTS')
-    get = command('GET')
     getset = command('GETSET')
     incr = command('INCR')
     incrby = command('INCRBY')
@@ -125,6 +283,43 @@ class Client:
     length = command('LEN')
     flush = command('FLUSH')
     
+    def get(self, key):
+        cache = self._cache
+        if cache is None or not cache.ready:
+            return self.execute(b'GET', key)
+        value = cache.get(key)
+        if value is _MISSING:
+            epoch = cache.epoch
+            value = self.execute(b'GET', key)
+            cache.set(key, value, epoch)
+        return value
+    
+    # incremental iteration, each call returns the next cursor, 0 once done,
+    # and a batch of items. The *_iter variants follow the cursor to the end
+    def _scan_options(self, match=None, count=None, type=None):
+        options = []
+        if match is not None:
+            options += [b'MATCH', match]
+        if count is not None:
+            options += [b'COUNT', count]
+        if type is not None:
+            options += [b'TYPE', type]
+        return options
+    
+    def _scan_iter(self, scan):
+        cursor = 0
+        while True:
+            cursor, batch = scan(cursor)
+            yield from batch
+            if not cursor:
+                return
+    
+    def scan(self, cursor=0, match=None, count=None, type=None):
+        return self.execute(b'SCAN', cursor, *self._scan_options(match, count, type))
+    
+    def scan_iter(self, match=None, count=None, type=None):
+        return self._scan_iter(lambda cursor: self.scan(cursor, match, count, type))
+    
     # SET commands
     sadd = command('SADD')
     scard = command('SCARD')
@@ -138,6 +333,12 @@ class Client:
     srem = command('SREM')
     sunion = command('SUNION')
     
+    def sscan(self, key, cursor=0, match=None, count=None):
+        return self.execute(b'SSCAN', key, cursor, *self._scan_options(match, count))
+    
+    def sscan_iter(self, key, match=None, count=None):
+        return self._scan_iter(lambda cursor: self.sscan(key, cursor, match, count))
+    
     # HASHMAP commands
     hdel = command('HDEL')
     hexists = command('HEXISTS')
@@ -152,6 +353,18 @@ class Client:
     hsetnx = command('HSETNX')
     hvals = command('HVALS')
     
+    def hscan(self, key, cursor=0, match=None, count=None):
+        return self.execute(b'HSCAN', key, cursor, *self._scan_options(match, count))
+    
+    def hscan_iter(self, key, match=None, count=None):
+        # (field, value) pairs
+        cursor = 0
+        while True:
+            cursor, batch = self.hscan(key, cursor, match, count)
+            yield from batch.items()
+            if not cursor:
+                return
+    
     # Queue commands
     lpush = command('LPUSH')
     rpush = command('RPUSH')
@@ -166,14 +379,542 @@ class Client:
     rpoplpush = command('RPOPLPUSH')
     lflush = command('LFLUSH')
     
+    def lscan(self, key, cursor=0, match=None, count=None):
+        return self.execute(b'LSCAN', key, cursor, *self._scan_options(match, count))
+    
+    def lscan_iter(self, key, match=None, count=None):
+        return self._scan_iter(lambda cursor: self.lscan(key, cursor, match, count))
+    
+    # blocking queue commands, a timeout of 0 blocks until something is pushed
+    def blpop(self, *keys, timeout=0):
+        return self.execute(b'BLPOP', *keys, timeout)
+    
+    def brpop(self, *keys, timeout=0):
+        return self.execute(b'BRPOP', *keys, timeout)
+    
+    def brpoplpush(self, src, dest, timeout=0):
+        return self.execute(b'BRPOPLPUSH', src, dest, timeout)
+    
+    # sorted set commands, zadd takes score member pairs
+    zadd = command('ZADD')
+    zcard = command('ZCARD')
+    zincrby = command('ZINCRBY')
+    zpopmax = command('ZPOPMAX')
+    zpopmin = command('ZPOPMIN')
+    zrank = command('ZRANK')
+    zrem = command('ZREM')
+    zrevrank = command('ZREVRANK')
+    zscore = command('ZSCORE')
+    
+    def zscan(self, key, cursor=0, match=None, count=None):
+        return self.execute(b'ZSCAN', key, cursor, *self._scan_options(match, count))
+    
+    def zscan_iter(self, key, match=None, count=None):
+        # [member, score] pairs
+        return self._scan_iter(lambda cursor: self.zscan(key, cursor, match, count))
+    
+    def _range_options(self, withscores=False, offset=None, count=None):
+        options = []
+        if withscores:
+            options.append(b'WITHSCORES')
+        if offset is not None or count is not None:
+            options += [b'LIMIT', offset or 0, -1 if count is None else count]
+        return options
+    
+    def zrange(self, key, start, stop, withscores=False):
+        return self.execute(b'ZRANGE', key, start, stop, *self._range_options(withscores))
+    
+    def zrevrange(self, key, start, stop, withscores=False):
+        return self.execute(b'ZREVRANGE', key, start, stop, *self._range_options(withscores))
+    
+    def zrangebyscore(self, key, min_score, max_score, withscores=False, offset=None, count=None):
+        return self.execute(b'ZRANGEBYSCORE', key, min_score, max_score,
+                            *self._range_options(withscores, offset, count))
+    
+    def zrevrangebyscore(self, key, max_score, min_score, withscores=False, offset=None, count=None):
+        return self.execute(b'ZREVRANGEBYSCORE', key, max_score, min_score,
+                            *self._range_options(withscores, offset, count))
+    
     # MISC.
     expire = command('EXPIRE')
+    pexpire = command('PEXPIRE')
+    pexpireat = command('PEXPIREAT')
+    ttl = command('TTL')
+    pttl = command('PTTL')
+    persist = command('PERSIST')
     flushall = command('FLUSHALL')
     quit = command('QUIT')
     shutdown = command('SHUTDOWN')
     save = command('SAVE')
+    bgsave = command('BGSAVE')
+    lastsave = command('LASTSAVE')
+    save_status = command('SAVESTATUS')
+    bgrewriteaof = command('BGREWRITEAOF')
     restore = command('RESTORE')
     merge = command('MERGE')
+    publish = command('PUBLISH')
+    info = command('INFO')
+    
+    def config_resetstat(self):
+        return self.execute(b'CONFIG', b'RESETSTAT')
+    
+    def slowlog_get(self, count=10):
+        return self.execute(b'SLOWLOG', b'GET', count)
+    
+    def slowlog_len(self):
+        return self.execute(b'SLOWLOG', b'LEN')
+    
+    def slowlog_reset(self):
+        return self.execute(b'SLOWLOG', b'RESET')
+    
+    def profile_start(self, seconds=10):
+        return self.execute(b'PROFILE', b'START', seconds)
+    
+    def profile_stop(self, count=20):
+        return self.execute(b'PROFILE', b'STOP', count)
+    
+    def pubsub(self):
+        return Subscription(self._host, self._port)
+
+    def __len__(self):
+        return self.length()
+
+
+class Pipeline(Client):
+    # commands are queued and written `batch_size` at a time so neither side
+    # buffers an unbounded amount of data, a failed command doesn't abort the
+    # batch, its CommandError is returned in place of the result
+    def __init__(self, client, batch_size=1000):
+        self._host = client._host
+        self._port = client._port
+        self._batch_size = batch_size
+        
+        self._protocol = client._protocol
+        self._socket_pool = client._socket_pool
+        self._cache = client._cache
+        self._queue = []
+        self.results = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.results = self.send()
+        else:
+            self._queue = []
+    
+    def execute(self, *args):
+        self._queue.append(args)
+        return self
+    
+    def get(self, key):
+        # queued like any other command, never answered from the cache
+        return self.execute(b'GET', key)
+    
+    def send(self):
+        queue, self._queue = self._queue, []
+        if not queue:
+            return []
+        if self._cache is not None:
+            for args in queue:
+                self._cache.forget(args)
+        
+        results = []
+        close_conn = any(args[0] in (b'QUIT', b'SHUTDOWN') for args in queue)
+        socket_file = self._socket_pool.checkout()
+        try:
+            for i in range(0, len(queue), self._batch_size):
+                batch = queue[i:i+self._batch_size]
+                buf = bytearray()
+                for args in batch:
+                    self._protocol.encode(buf, args)
+                socket_file.write(buf)
+                socket_file.flush()
+                for _ in batch:
+                    resp = self._protocol.handle_request(socket_file)
+                    if isinstance(resp, Error):
+                        resp = CommandError(resp.message)
+                    results.append(resp)
+        except EOFError:
+            self._socket_pool.close()
+            raise ConnectionError('server went away')
+        except Exception:
+            self._socket_pool.close()
+            raise Exception('internal server error')
+        
+        if close_conn:
+            self._socket_pool.close()
+        else:
+            self._socket_pool.checkin()
+        return results
+    
+    def __len__(self):
+        return len(self._queue)
+
+
+class Subscription:
+    """
+    A connection of its own in push mode. Iterating over it yields the
+    published messages as they arrive, until every subscription is dropped.
+
+        with client.pubsub() as sub:
+            sub.subscribe('news')
+            for message in sub:
+                ...
+    """
+    def __init__(self, host='127.0.0.1', port=8888):
+        self._protocol = ProtocolHandler()
+        self._conn = socket.create_connection((host, port))
+        self._conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._conn.makefile('rwb')
+        # subscriptions confirmed by the server so far
+        self.count = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _send(self, *args):
+        self._protocol.write_response(self._file, args)
+    
+    def subscribe(self, *channels):
+        self._send(b'SUBSCRIBE', *channels)
+    
+    def psubscribe(self, *patterns):
+        self._send(b'PSUBSCRIBE', *patterns)
+    
+    def unsubscribe(self, *channels):
+        self._send(b'UNSUBSCRIBE', *channels)
+    
+    def punsubscribe(self, *patterns):
+        self._send(b'PUNSUBSCRIBE', *patterns)
+    
+    def _read(self):
+        try:
+            reply = self._protocol.handle_request(self._file)
+        except EOFError:
+            raise ConnectionError('server went away')
+        if isinstance(reply, Error):
+            raise CommandError(reply.message)
+        return reply
+    
+    def get_message(self):
+        """Block for the next message, None once no subscriptions are left."""
+        while True:
+            reply = self._read()
+            kind = reply[0]
+            if kind == b'message':
+                return Message(reply[1], reply[2], None)
+            if kind == b'pmessage':
+                return Message(reply[2], reply[3], reply[1])
+            # confirmation of a (un)subscribe
+            self.count = reply[2]
+            if not self.count:
+                return None
+    
+    def __iter__(self):
+        while True:
+            message = self.get_message()
+            if message is None:
+                return
+            yield message
+    
+    def close(self):
+        try:
+            self._file.close()
+            self._conn.close()
+        except OSError:
+            pass
+
+
+def _hash(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    elif not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return int.from_bytes(md5(value).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes. Each node is placed at `vnodes`
+    points around the ring and a key belongs to the first point after its
+    hash, so adding or removing a node only moves the keys of its points,
+    about 1 / nodes of them, and spreads them evenly over the others.
+    """
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def _build(self):
+        ring = sorted((_hash(f'{host}:{port}-{i}'), (host, port))
+                      for host, port in self.nodes for i in range(self.vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    def add(self, node):
+        if node not in self.nodes:
+            self.nodes.append(node)
+            self._build()
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self._build()
+
+    def get(self, key):
+        if not self._points:
+            raise ValueError('no nodes in the ring')
+        i = bisect(self._points, _hash(key))
+        return self._owners[i if i < len(self._owners) else 0]
+
+
+class ShardedClient:
+    """
+    Spreads the keyspace over independent servers, each key is sent to the
+    node the HashRing gives it.
+
+        client = ShardedClient([('127.0.0.1', 8888), ('127.0.0.1', 8889)])
+        client.mset({'a': 1, 'b': 2})
+        client.mget('a', 'b')
+
+    MGET, MPOP, MDELETE, MSET and MSETEX are split per node, sent to all of
+    them before any reply is read so the nodes work on their parts at once,
+    and merged back in order. They are not atomic. Other commands taking
+    several keys need them all on one node. Keys aren't moved when nodes are
+    added or removed, the ones whose node changed are simply not found. A
+    cache_size gives each node's Client a cache of its own.
+    """
+    def __init__(self, nodes, vnodes=160, pool_max_age=60, cache_size=0):
+        self._pool_max_age = pool_max_age
+        # per node
+        self._cache_size = cache_size
+        self._ring = HashRing(vnodes=vnodes)
+        self._clients = {}
+        for host, port in nodes:
+            self.add_node(host, port)
+
+    @property
+    def nodes(self):
+        return list(self._ring.nodes)
+
+    def add_node(self, host, port):
+        node = (host, port)
+        if node not in self._clients:
+            self._clients[node] = Client(host, port, self._pool_max_age, self._cache_size)
+        self._ring.add(node)
+
+    def remove_node(self, host, port):
+        self._ring.remove((host, port))
+        del self._clients[host, port]
+
+    def get_client(self, key):
+        """The Client of the node `key` lives on."""
+        return self._clients[self._ring.get(key)]
+
+    def _colocated(self, keys):
+        nodes = {self._ring.get(key) for key in keys}
+        if len(nodes) > 1:
+            raise CommandError('Keys must be on the same node')
+        return self._clients[nodes.pop()]
+
+    def _run(self, jobs):
+        """
+        Send every node in `jobs`, a dict of node to command, its command, then
+        read the replies. Returns a dict of node to reply.
+        """
+        sent = []
+        error = None
+        for node, args in jobs.items():
+            client = self._clients[node]
+            if client._cache is not None:
+                client._cache.forget(args)
+            try:
+                sent.append((node, client, client._send(args), args))
+            except Exception as e:
+                client._socket_pool.close()
+                error = error or e
+        # replies are read off every connection written to, even after an
+        # error, so none is left with one pending
+        replies = {}
+        for node, client, socket_file, args in sent:
+            try:
+                replies[node] = client._receive(socket_file, args)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return replies
+
+    def _group(self, keys):
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self._ring.get(key), []).append(i)
+        return groups
+
+    def _gather(self, command, keys):
+        groups = self._group(keys)
+        replies = self._run({node: (command, *[keys[i] for i in idx])
+                             for node, idx in groups.items()})
+        accum = [None] * len(keys)
+        for node, idx in groups.items():
+            for i, value in zip(idx, replies[node]):
+                accum[i] = value
+        return accum
+
+    def _split(self, data):
+        parts = {}
+        for key, value in data.items():
+            parts.setdefault(self._ring.get(key), {})[key] = value
+        return parts
+
+    def mget(self, *keys):
+        return self._gather(b'MGET', keys)
+
+    def mpop(self, *keys):
+        return self._gather(b'MPOP', keys)
+
+    def mdelete(self, *keys):
+        groups = self._group(keys)
+        replies = self._run({node: (b'MDELETE', *[keys[i] for i in idx])
+                             for node, idx in groups.items()})
+        return sum(replies.values())
+
+    def mset(self, data):
+        replies = self._run({node: (b'MSET', part) for node, part in self._split(data).items()})
+        return sum(replies.values())
+
+    def msetex(self, data, expires):
+        self._run({node: (b'MSETEX', part, expires) for node, part in self._split(data).items()})
+
+    def keyed(name):
+        # Client's method of the same name, on the node owning the key
+        def method(self, key, *args, **kwargs):
+            return getattr(self.get_client(key), name)(key, *args, **kwargs)
+
+        return method
+
+    def colocated(name):
+        def method(self, *keys, **kwargs):
+            return getattr(self._colocated(keys), name)(*keys, **kwargs)
+
+        return method
+
+    # key value commands
+    append = keyed('append')
+    decr = keyed('decr')
+    decrby = keyed('decrby')
+    delete = keyed('delete')
+    exists = keyed('exists')
+    get = keyed('get')
+    getset = keyed('getset')
+    incr = keyed('incr')
+    incrby = keyed('incrby')
+    pop = keyed('pop')
+    set = keyed('set')
+    setex = keyed('setex')
+    setnx = keyed('setnx')
+
+    # SET commands
+    sadd = keyed('sadd')
+    scard = keyed('scard')
+    sismember = keyed('sismember')
+    smembers = keyed('smembers')
+    spop = keyed('spop')
+    srem = keyed('srem')
+    sscan = keyed('sscan')
+    sscan_iter = keyed('sscan_iter')
+    sdiff = colocated('sdiff')
+    sdiffstore = colocated('sdiffstore')
+    sinter = colocated('sinter')
+    sinterstore = colocated('sinterstore')
+    sunion = colocated('sunion')
+
+    # HASHMAP commands
+    hdel = keyed('hdel')
+    hexists = keyed('hexists')
+    hget = keyed('hget')
+    hgetall = keyed('hgetall')
+    hincrby = keyed('hincrby')
+    hkeys = keyed('hkeys')
+    hlen = keyed('hlen')
+    hmget = keyed('hmget')
+    hmset = keyed('hmset')
+    hset = keyed('hset')
+    hsetnx = keyed('hsetnx')
+    hvals = keyed('hvals')
+    hscan = keyed('hscan')
+    hscan_iter = keyed('hscan_iter')
+
+    # Queue commands
+    lpush = keyed('lpush')
+    rpush = keyed('rpush')
+    lpop = keyed('lpop')
+    rpop = keyed('rpop')
+    lrem = keyed('lrem')
+    llen = keyed('llen')
+    lindex = keyed('lindex')
+    lrange = keyed('lrange')
+    lset = keyed('lset')
+    ltrim = keyed('ltrim')
+    lflush = keyed('lflush')
+    lscan = keyed('lscan')
+    lscan_iter = keyed('lscan_iter')
+    rpoplpush = colocated('rpoplpush')
+    blpop = colocated('blpop')
+    brpop = colocated('brpop')
+
+    def brpoplpush(self, src, dest, timeout=0):
+        return self._colocated((src, dest)).brpoplpush(src, dest, timeout)
+
+    # sorted set commands
+    zadd = keyed('zadd')
+    zcard = keyed('zcard')
+    zincrby = keyed('zincrby')
+    zpopmax = keyed('zpopmax')
+    zpopmin = keyed('zpopmin')
+    zrank = keyed('zrank')
+    zrem = keyed('zrem')
+    zrevrank = keyed('zrevrank')
+    zscore = keyed('zscore')
+    zrange = keyed('zrange')
+    zrevrange = keyed('zrevrange')
+    zrangebyscore = keyed('zrangebyscore')
+    zrevrangebyscore = keyed('zrevrangebyscore')
+    zscan = keyed('zscan')
+    zscan_iter = keyed('zscan_iter')
+
+    # MISC.
+    expire = keyed('expire')
+    pexpire = keyed('pexpire')
+    pexpireat = keyed('pexpireat')
+    ttl = keyed('ttl')
+    pttl = keyed('pttl')
+    persist = keyed('persist')
+
+    # keyless commands run on every node
+    def _broadcast(self, *args):
+        return self._run({node: args for node in self._ring.nodes})
+
+    def flushall(self):
+        return all(self._broadcast(b'FLUSHALL').values())
+
+    def flush(self):
+        return sum(self._broadcast(b'FLUSH').values())
+
+    def length(self):
+        return sum(self._broadcast(b'LEN').values())
+
+    def scan_iter(self, match=None, count=None, type=None):
+        # the nodes one after the other
+        for node in self.nodes:
+            yield from self._clients[node].scan_iter(match, count, type)
 
     def __len__(self):
-        return self.length() 
\ No newline at end of file
+        return self.length()
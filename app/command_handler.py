@@ -1,21 +1,180 @@
 
-from functools import wraps
-from collections import deque
+from functools import partial, wraps
+from io import BytesIO
+from collections import Counter, deque
+from itertools import islice
+from operator import attrgetter
+import logging
 import time
-import heapq
-import pickle
+from time import perf_counter_ns
 import os
 
-from const import Value, KV, SET, HASH, QUEUE
-from exc import CommandError, ClientQuit, Shutdown
+from background import BackgroundChild
+from compact import new_hash, new_set, fit_hash, fit_set, encode_hash, encode_set
+from const import Value, KV, SET, HASH, QUEUE, ZSET
+from eviction import Evictor, NOEVICTION
+from exc import CommandError, ClientQuit, Shutdown, SnapshotError
+from profiler import Profiler
+from pubsub import PubSub
+from quicklist import QuickList
+from replication import Primary
+from scan import DEFAULT_COUNT, ScanDict, match, walk, walk_list
+from slowlog import SlowLog
+import snapshot
+from sorted_set import SortedSet, member_kind
+from stats import Stats
+from timing_wheel import TimingWheel, now_ms
+from tracking import Tracking
+
+
+# commands modifying the keyspace
+WRITE_COMMANDS = frozenset((
+    b'APPEND', b'DECR', b'DECRBY', b'DELETE', b'GETSET', b'INCR', b'INCRBY',
+    b'MDELETE', b'MPOP', b'MSET', b'MSETEX', b'POP', b'SET', b'SETNX', b'SETEX',
+    b'FLUSH', b'SADD', b'SDIFFSTORE', b'SINTERSTORE', b'SPOP', b'SREM',
+    b'SUNIONSTORE', b'HDEL', b'HINCRBY', b'HMSET', b'HSET', b'HSETNX', b'LPUSH',
+    b'RPUSH', b'LPOP', b'RPOP', b'LREM', b'LSET', b'LTRIM', b'RPOPLPUSH',
+    b'LFLUSH', b'EXPIRE', b'PEXPIRE', b'PEXPIREAT', b'PERSIST', b'FLUSHALL',
+    b'RESTORE', b'MERGE', b'BLPOP', b'BRPOP', b'BRPOPLPUSH', b'ZADD', b'ZREM',
+    b'ZINCRBY', b'ZPOPMIN', b'ZPOPMAX',
+))
+# write commands that can't grow the keyspace, allowed past maxmemory
+SHRINKING_COMMANDS = frozenset((
+    b'DELETE', b'MDELETE', b'MPOP', b'POP', b'FLUSH', b'SPOP', b'SREM', b'HDEL',
+    b'LPOP', b'RPOP', b'LREM', b'LTRIM', b'LFLUSH', b'PERSIST', b'FLUSHALL',
+    b'BLPOP', b'BRPOP', b'ZREM', b'ZPOPMIN', b'ZPOPMAX',
+))
+# every argument is a key
+MULTI_KEY_COMMANDS = frozenset((
+    b'MDELETE', b'MGET', b'MPOP', b'SDIFF', b'SDIFFSTORE', b'SINTER',
+    b'SINTERSTORE', b'SUNION', b'SUNIONSTORE', b'RPOPLPUSH',
+))
+# every argument but the trailing timeout is a key
+BLOCKING_COMMANDS = frozenset((b'BLPOP', b'BRPOP', b'BRPOPLPUSH'))
+# keys are given as a mapping of key to value
+MAPPING_COMMANDS = frozenset((b'MSET', b'MSETEX'))
+KEYLESS_COMMANDS = frozenset((
+    b'LEN', b'FLUSH', b'FLUSHALL', b'QUIT', b'SHUTDOWN', b'SAVE', b'BGSAVE',
+    b'LASTSAVE', b'SAVESTATUS', b'RESTORE', b'MERGE', b'BGREWRITEAOF', b'PUBLISH',
+    b'SCAN', b'INFO', b'CONFIG', b'SLOWLOG', b'PROFILE', b'CLIENT',
+))
+# commands whose effect depends on when they run, see _propagate_command
+RELATIVE_EXPIRY_COMMANDS = frozenset((b'EXPIRE', b'PEXPIRE', b'SETEX', b'MSETEX'))
+# names of the data types, as taken by SCAN's TYPE filter
+TYPE_NAMES = {b'string': KV, b'hash': HASH, b'list': QUEUE, b'set': SET, b'zset': ZSET}
+# sections of INFO, in the order given when none is asked for. Counting the
+# keys of each data type walks the whole keyspace, only done when asked for
+INFO_SECTIONS = (b'server', b'clients', b'replication', b'stats', b'keyspace',
+                 b'commandstats', b'latencystats')
+INFO_ALL_SECTIONS = INFO_SECTIONS + (b'datatypes',)
+# items per command when writing out large collections
+DUMP_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def command_keys(command, args):
+    if command in MULTI_KEY_COMMANDS:
+        return list(args)
+    if command in BLOCKING_COMMANDS:
+        return list(args[:-1])
+    if command in MAPPING_COMMANDS:
+        return list(args[0]) if args and isinstance(args[0], dict) else []
+    if command in KEYLESS_COMMANDS or not args:
+        return []
+    return [args[0]]
+
+
+class Waiter:
+    """
+    A client blocked on empty lists. It is parked in the FIFO queue of each of
+    its keys and handed its reply by the first push to any of them, `notify` is
+    called once that happens. `alive`, if set, tells whether the client is
+    still connected, one that is gone is dropped rather than served.
+    """
+    __slots__ = ('keys', 'left', 'dest', 'timeout', 'result', 'done', 'notify', 'alive')
+
+    def __init__(self, keys, left, dest=None, timeout=0):
+        self.keys = keys
+        self.left = left
+        self.dest = dest
+        # seconds, 0 waits forever
+        self.timeout = timeout
+        self.result = None
+        self.done = False
+        self.notify = None
+        self.alive = None
+
+    def set(self, result):
+        self.result = result
+        self.done = True
+        if self.notify is not None:
+            self.notify()
 
 
 class CommandHandler:
-    def __init__(self):
-        self._kv = {}
+    def __init__(self, maxmemory=0, maxmemory_policy=NOEVICTION, maxmemory_samples=5,
+                 aof=None, snapshot_compression=False, hash_max_entries=128,
+                 hash_max_value=64, set_max_entries=128, set_max_value=64,
+                 set_max_intset_entries=512, slowlog_log_slower_than=10000,
+                 slowlog_max_len=128, repl_backlog_size=2**20,
+                 tracking_table_max_keys=10**6):
+        self._kv = ScanDict()
+        
+        # hashes and sets within these sizes use the compact encodings, 0
+        # disables them, see compact.py
+        self._hash_max_entries = hash_max_entries
+        self._hash_max_value = hash_max_value
+        self._set_max_entries = set_max_entries
+        self._set_max_value = set_max_value
+        self._set_max_intset_entries = set_max_intset_entries
+        
+        # key -> deadline in ms, at most one entry per key
+        self._expiry = TimingWheel()
+        self._expired_keys = 0
         
-        self._expiry_map = {}
-        self._expiry = []
+        # estimated memory used per key, only tracked when maxmemory is set
+        self._memory = Evictor(maxmemory, maxmemory_policy, maxmemory_samples)
+        self._evicted_keys = 0
+
+        # forked child writing a snapshot, and the outcome of the last save
+        self._bgsave = None
+        self._bgsave_filename = None
+        self._lastsave = int(time.time())
+        self._lastsave_status = b'ok'
+        self._lastsave_duration = None
+        self._snapshot_compression = snapshot_compression
+
+        # callables receiving every change to the keyspace as a list of
+        # arguments, replaying them in order recreates the keyspace
+        self._feeds = []
+        self._aof = aof
+        if aof is not None:
+            self._feeds.append(aof.append)
+
+        # key -> deque of Waiters blocked on it, oldest first, and the keys
+        # pushed to by the current command that have some
+        self._waiters = {}
+        self._ready = set()
+
+        # channels and patterns subscribed to by connections in push mode
+        self.pubsub = PubSub()
+        # keys read by clients caching them, told through pubsub once changed
+        self.tracking = Tracking(tracking_table_max_keys)
+
+        # replicas of this server and, on a replica, its link to the primary
+        # (set by the server), whose writes are the only ones it takes
+        self.replication = Primary(repl_backlog_size)
+        self.replica_link = None
+        self.read_only = False
+
+        # commands run and their latencies, for INFO, the slowest of them with
+        # their arguments and the address of the client that sent them, set
+        # by the server
+        self.stats = Stats()
+        self.slowlog = SlowLog(slowlog_log_slower_than, slowlog_max_len)
+        self.client = None
+        self.profiler = Profiler((self.execute,))
 
         self._commands = {
             # Key value commands
@@ -39,6 +198,7 @@ class CommandHandler:
             b'SETEX': self.kv_setex,
             b'LEN': self.kv_len,
             b'FLUSH': self.kv_flush,
+            b'SCAN': self.scan,
             
             # Set commands.
             b'SADD': self.sadd,
@@ -51,6 +211,7 @@ class CommandHandler:
             b'SMEMBERS': self.smembers,
             b'SPOP': self.spop,
             b'SREM': self.srem,
+            b'SSCAN': self.sscan,
             b'SUNION': self.sunion,
             b'SUNIONSTORE': self.sunionstore,
             
@@ -64,6 +225,7 @@ class CommandHandler:
             b'HLEN': self.hlen,
             b'HMSET': self.hmset,
             b'HMGET': self.hmget,
+            b'HSCAN': self.hscan,
             b'HSET': self.hset,
             b'HSETNX': self.hsetnx,
             b'HVALS': self.hvals,
@@ -77,23 +239,246 @@ class CommandHandler:
             b'LLEN': self.llen,
             b'LINDEX': self.lindex,
             b'LRANGE': self.lrange,
+            b'LSCAN': self.lscan,
             b'LSET': self.lset,
             b'LTRIM': self.ltrim,
             b'RPOPLPUSH': self.rpoplpush,
             b'LFLUSH': self.lflush,
+            b'BLPOP': self.blpop,
+            b'BRPOP': self.brpop,
+            b'BRPOPLPUSH': self.brpoplpush,
+            
+            # sorted set commands
+            b'ZADD': self.zadd,
+            b'ZCARD': self.zcard,
+            b'ZINCRBY': self.zincrby,
+            b'ZPOPMAX': self.zpopmax,
+            b'ZPOPMIN': self.zpopmin,
+            b'ZRANGE': self.zrange,
+            b'ZRANGEBYSCORE': self.zrangebyscore,
+            b'ZRANK': self.zrank,
+            b'ZREM': self.zrem,
+            b'ZREVRANGE': self.zrevrange,
+            b'ZREVRANGEBYSCORE': self.zrevrangebyscore,
+            b'ZREVRANK': self.zrevrank,
+            b'ZSCAN': self.zscan,
+            b'ZSCORE': self.zscore,
             
             # Misc.
             b'EXPIRE': self.expire,
+            b'PEXPIRE': self.pexpire,
+            b'PEXPIREAT': self.pexpireat,
+            b'TTL': self.ttl,
+            b'PTTL': self.pttl,
+            b'PERSIST': self.persist,
             b'FLUSHALL': self.flush_all,
             b'QUIT': self.client_quit,
             b'SHUTDOWN': self.shutdown,
             b'SAVE': self.save_to_disk,
+            b'BGSAVE': self.bgsave,
+            b'LASTSAVE': self.lastsave,
+            b'SAVESTATUS': self.save_status,
             b'RESTORE': self.restore_from_disk,
             b'MERGE': self.merge_from_disk,
+            b'BGREWRITEAOF': self.bgrewriteaof,
+            b'PUBLISH': self.publish,
+            b'INFO': self.info,
+            b'CONFIG': self.config,
+            b'SLOWLOG': self.slowlog_command,
+            b'PROFILE': self.profile,
+            b'CLIENT': self.client_command,
         }
         
     def handle(self, command):
         return self._commands[command]
+    
+    def execute(self, command, *args):
+        try:
+            handler = self._commands[command]
+        except KeyError:
+            raise CommandError(f'Unrecogonized command: {command}')
+        if self.read_only and command in WRITE_COMMANDS:
+            raise CommandError("READONLY You can't write against a read only replica.")
+        start = perf_counter_ns()
+        failed = False
+        try:
+            if not self._memory.enabled:
+                result = handler(*args)
+            else:
+                if command in WRITE_COMMANDS and command not in SHRINKING_COMMANDS:
+                    self.free_memory()
+                keys = command_keys(command, args)
+                try:
+                    result = handler(*args)
+                finally:
+                    for key in keys:
+                        self._memory.touch(key, self._kv.get(key))
+        except CommandError:
+            failed = True
+            raise
+        finally:
+            elapsed = perf_counter_ns() - start
+            self.stats.record(command, elapsed, failed)
+            if elapsed > self.slowlog.threshold_ns:
+                self.slowlog.record(command, args, elapsed, self.client)
+        
+        if self._feeds and command in WRITE_COMMANDS:
+            self._propagate_command(command, args, result)
+        tracking = self.tracking
+        if tracking.keys or tracking.clients:
+            if command in WRITE_COMMANDS:
+                self.invalidate(None if command in KEYLESS_COMMANDS else command_keys(command, args))
+            elif self.client in tracking.clients:
+                self._invalidated(tracking.track(tracking.clients[self.client],
+                                                 command_keys(command, args)))
+        if self._ready:
+            # after the push itself was logged
+            self.serve_waiters()
+        return result
+    
+    def propagate(self, args):
+        for feed in self._feeds:
+            feed(args)
+    
+    def invalidate(self, keys=None):
+        """Tell the clients caching `keys`, all of them if None, that they changed."""
+        if keys is None:
+            for channel in self.tracking.invalidate_all():
+                self.pubsub.publish(channel, None)
+        elif self.tracking.keys:
+            self._invalidated(self.tracking.invalidate(keys))
+    
+    def _invalidated(self, changed):
+        for channel, keys in changed.items():
+            self.pubsub.publish(channel, keys)
+    
+    def _propagate_command(self, command, args, result):
+        if command in RELATIVE_EXPIRY_COMMANDS:
+            # logged with an absolute deadline so replaying them later doesn't
+            # push the expiry back
+            if command == b'SETEX':
+                self.propagate([b'SET', args[0], args[1]])
+                keys = [args[0]]
+            elif command == b'MSETEX':
+                self.propagate([b'MSET', args[0]])
+                keys = list(args[0])
+            else:
+                keys = [args[0]]
+            for key in keys:
+                deadline = self._expiry.get(key)
+                if deadline is not None:
+                    self.propagate([b'PEXPIREAT', key, deadline])
+        elif command == b'SPOP':
+            # the members popped are random, remove exactly those instead
+            if result:
+                self.propagate([b'SREM', args[0], *result])
+        elif command in BLOCKING_COMMANDS:
+            # logged as the pop that happened, blocked clients are logged
+            # once they are served
+            if result is None or isinstance(result, Waiter):
+                return
+            if command == b'BRPOPLPUSH':
+                self.propagate([b'RPOPLPUSH', args[0], args[1]])
+            else:
+                self.propagate([b'LPOP' if command == b'BLPOP' else b'RPOP', result[0]])
+        elif command in (b'RESTORE', b'MERGE'):
+            # the file might be gone or different by the time this is replayed
+            if result:
+                self.propagate([b'FLUSHALL'])
+                for dump in self.dump_commands():
+                    self.propagate(dump)
+        else:
+            self.propagate([command, *args])
+    
+    def dump_commands(self):
+        """Yield the commands recreating the keyspace, large collections in batches."""
+        expiry = self._expiry
+        for key, (data_type, value) in self._kv.items():
+            if data_type == KV:
+                yield [b'SET', key, value]
+            elif data_type == HASH:
+                items = iter(value.items())
+                batch = dict(islice(items, DUMP_BATCH_SIZE))
+                yield [b'HMSET', key, batch]
+                while batch:
+                    batch = dict(islice(items, DUMP_BATCH_SIZE))
+                    if batch:
+                        yield [b'HMSET', key, batch]
+            elif data_type == ZSET:
+                items = value.items()
+                batch = list(islice(items, DUMP_BATCH_SIZE))
+                while True:
+                    yield [b'ZADD', key, *[x for member, score in batch for x in (score, member)]]
+                    batch = list(islice(items, DUMP_BATCH_SIZE))
+                    if not batch:
+                        break
+            else:
+                command = b'RPUSH' if data_type == QUEUE else b'SADD'
+                items = iter(value)
+                batch = list(islice(items, DUMP_BATCH_SIZE))
+                yield [command, key, *batch]
+                while batch:
+                    batch = list(islice(items, DUMP_BATCH_SIZE))
+                    if batch:
+                        yield [command, key, *batch]
+            deadline = expiry.get(key)
+            if deadline is not None:
+                yield [b'PEXPIREAT', key, deadline]
+    
+    def load_aof(self):
+        def replay(command, *args):
+            try:
+                self.execute(command, *args)
+            except CommandError as e:
+                logger.warning(f'Error replaying {command}: {e.message}')
+        
+        # replayed commands are already in the log
+        feeds, self._feeds = self._feeds, []
+        try:
+            return self._aof.load(replay)
+        finally:
+            self._feeds = feeds
+            self.stats.reset()
+    
+    def check_aof_rewrite(self):
+        # rewrite once the log grew past the configured threshold
+        aof = self._aof
+        if aof is None or self._bgsave is not None or not aof.needs_rewrite():
+            return False
+        aof.start_rewrite(self.dump_commands)
+        return True
+    
+    def bgrewriteaof(self):
+        if self._aof is None:
+            raise CommandError('Append only file is not enabled')
+        if self._aof.rewriting:
+            raise CommandError('Background append only file rewriting already in progress')
+        if self._bgsave is not None:
+            raise CommandError('Background save in progress')
+        try:
+            self._aof.start_rewrite(self.dump_commands)
+        except OSError as e:
+            raise CommandError(f'Unable to start append only file rewrite: {e}')
+        return b'Background append only file rewriting started'
+    
+    def free_memory(self):
+        memory = self._memory
+        while memory.over_limit():
+            key = memory.victim(self._expiry)
+            if key is None:
+                raise CommandError("OOM command not allowed when used memory > 'maxmemory'.")
+            self._kv.pop(key, None)
+            self.unexpire(key)
+            memory.remove(key)
+            self._evicted_keys += 1
+            self.propagate([b'DELETE', key])
+            self.invalidate([key])
+    
+    def _reset_memory(self):
+        self._memory.clear()
+        if self._memory.enabled:
+            for key, value in self._kv.items():
+                self._memory.touch(key, value)
         
     def enforce_datatype(data_type, set_missing=True, subtype=None):
         def decorator(func):
@@ -107,6 +492,8 @@ class CommandHandler:
     def check_datatype(self, data_type, key, set_missing=True, subtype=None):
         if key in self._kv and self.check_expired(key):
             del self._kv[key]
+            self.invalidate([key])
+            self.unexpire(key)
         
         if key in self._kv:
             value = self._kv[key]
@@ -116,39 +503,306 @@ class CommandHandler:
                 raise CommandError('Operation against wrong value type.')
         elif set_missing:
             if data_type == HASH:
-                value = {}
+                value = new_hash(self._hash_max_entries)
             elif data_type == QUEUE:
-                value = deque()
+                value = QuickList()
             elif data_type == SET:
-                value = set()
+                value = new_set(self._set_max_entries, self._set_max_intset_entries)
+            elif data_type == ZSET:
+                value = SortedSet()
             elif data_type == KV:
                 value = ''
             
             self._kv[key] = Value(data_type, value)
     
-    def _get_state(self):
-        return {'kv': self._kv}
-    
-    def _set_state(self, state, merge=False):
-        if not merge:
-            self._kv = state['kv']
-        else:
-            merge = state['kv'].update(self._kv)
-            self._kv = merge
+    def _write_snapshot(self, filename, report=None):
+        # written next to the target and renamed over it, so a crash halfway
+        # never leaves a truncated snapshot behind
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as fh:
+                snapshot.dump(fh, self._kv, self._expiry,
+                              compress=self._snapshot_compression, report=report)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return True
     
     def save_to_disk(self, filename):
-        with open(filename, 'wb') as fh:
-            pickle.dump(self._get_state(), fh, pickle.HIGHEST_PROTOCOL)
+        start = time.monotonic()
+        try:
+            self._write_snapshot(filename)
+        except (OSError, SnapshotError) as e:
+            self._lastsave_status = b'err'
+            raise CommandError(f'Error saving snapshot: {e}')
+        self._lastsave = int(time.time())
+        self._lastsave_status = b'ok'
+        self._lastsave_duration = int((time.monotonic() - start) * 1000)
         return True
     
+    def bgsave(self, filename):
+        self.check_background()
+        if self._bgsave is not None:
+            raise CommandError('Background save already in progress')
+        if self._aof is not None and self._aof.rewriting:
+            raise CommandError('Background append only file rewriting in progress')
+        child = BackgroundChild(lambda report: self._write_snapshot(filename, report))
+        try:
+            child.start()
+        except OSError as e:
+            raise CommandError(f'Unable to start background save: {e}')
+        self._bgsave = child
+        self._bgsave_filename = filename
+        return b'Background saving started'
+    
+    def check_background(self):
+        child = self._bgsave
+        if child is None:
+            return
+        ok = child.poll()
+        if ok is None:
+            return
+        self._bgsave = None
+        self._lastsave_duration = int(child.elapsed * 1000)
+        if ok:
+            self._lastsave = int(time.time())
+            self._lastsave_status = b'ok'
+        else:
+            self._lastsave_status = b'err'
+        return ok
+    
+    def lastsave(self):
+        self.check_background()
+        return self._lastsave
+    
+    def save_status(self):
+        self.check_background()
+        child = self._bgsave
+        return {
+            b'in_progress': int(child is not None),
+            b'filename': self._bgsave_filename,
+            b'bytes_written': child.progress if child is not None else 0,
+            b'elapsed_ms': int(child.elapsed * 1000) if child is not None else 0,
+            b'last_save': self._lastsave,
+            b'last_status': self._lastsave_status,
+            b'last_duration_ms': self._lastsave_duration,
+            b'aof_enabled': int(self._aof is not None),
+            b'aof_size': self._aof.size if self._aof is not None else 0,
+            b'aof_rewrite_in_progress': int(self._aof is not None and self._aof.rewriting),
+            b'aof_last_rewrite_status': self._aof.last_rewrite_status if self._aof is not None else None,
+        }
+    
+    def info(self, *sections):
+        sections = [(section.encode('utf-8') if isinstance(section, str) else section).lower()
+                    for section in sections] or INFO_SECTIONS
+        if b'all' in sections:
+            sections = INFO_ALL_SECTIONS
+        accum = {}
+        for section in sections:
+            if section == b'server':
+                accum[section] = self.stats.server()
+            elif section == b'clients':
+                clients = self.stats.clients()
+                clients[b'blocked_clients'] = len({id(waiter) for waiters in self._waiters.values()
+                                                   for waiter in waiters})
+                clients[b'tracking_clients'] = len(self.tracking.clients)
+                accum[section] = clients
+            elif section == b'replication':
+                accum[section] = self.replication_info()
+            elif section == b'stats':
+                stats = self.stats.stats()
+                stats[b'expired_keys'] = self._expired_keys
+                stats[b'evicted_keys'] = self._evicted_keys
+                stats[b'tracking_total_keys'] = len(self.tracking.keys)
+                accum[section] = stats
+            elif section == b'keyspace':
+                accum[section] = {b'keys': len(self._kv), b'expires': len(self._expiry)}
+            elif section == b'datatypes':
+                counts = Counter(map(attrgetter('data_type'), self._kv.values()))
+                accum[section] = {name: counts[data_type] for name, data_type in TYPE_NAMES.items()}
+            elif section == b'commandstats':
+                accum[section] = self.stats.command_stats()
+            elif section == b'latencystats':
+                accum[section] = self.stats.latency_stats()
+            else:
+                raise CommandError(f'Unrecogonized INFO section: {section}')
+        return accum
+    
+    def replication_info(self):
+        primary = self.replication
+        link = self.replica_link
+        info = {b'role': b'replica' if link is not None else b'primary'}
+        if link is not None:
+            info.update({
+                b'primary_host': link.host,
+                b'primary_port': link.port,
+                b'primary_link_status': b'up' if link.connected else b'down',
+                b'primary_replid': link.replid,
+                b'primary_offset': link.offset,
+                b'full_syncs_from_primary': link.full_syncs,
+            })
+        info.update({
+            b'replid': primary.replid,
+            b'repl_offset': primary.offset,
+            b'repl_backlog_size': primary.backlog_size,
+            b'connected_replicas': len(primary.replicas),
+            b'replicas': list(primary.replicas.values()),
+            b'full_syncs': primary.full_syncs,
+            b'partial_syncs': primary.partial_syncs,
+        })
+        return info
+    
+    def attach_replica(self, replica, address, replid, offset):
+        """Start streaming writes to `replica`, True if it needed a full resync."""
+        if self.replication.backlog is None:
+            self._feeds.append(self.replication.feed)
+        return self.replication.attach(replica, address, replid, offset, self._snapshot)
+    
+    def detach_replica(self, replica):
+        self.replication.detach(replica)
+    
+    def _snapshot(self):
+        fh = BytesIO()
+        snapshot.dump(fh, self._kv, self._expiry)
+        return fh.getvalue()
+    
+    def apply(self, command, *args):
+        """Run a write from the primary, the only way to change a replica."""
+        self.read_only = False
+        try:
+            return self.execute(command, *args)
+        finally:
+            self.read_only = True
+    
+    def sync_from(self, data):
+        """Replace the keyspace with the primary's, `data` is a snapshot of it."""
+        try:
+            kv, deadlines = snapshot.load(BytesIO(data))
+        except SnapshotError as e:
+            raise CommandError(f'Error loading snapshot from primary: {e}')
+        self._replace(kv, deadlines)
+        self.invalidate()
+        # the append only file and replicas of this replica start over too
+        if self._feeds:
+            self.propagate([b'FLUSHALL'])
+            for dump in self.dump_commands():
+                self.propagate(dump)
+    
+    def _subcommand(self, command, subcommand, choices):
+        if isinstance(subcommand, str):
+            subcommand = subcommand.encode('utf-8')
+        if isinstance(subcommand, bytes):
+            subcommand = subcommand.upper()
+        if subcommand not in choices:
+            raise CommandError(f'Unrecogonized {command} subcommand: {subcommand}')
+        return subcommand
+    
+    def config(self, subcommand):
+        self._subcommand('CONFIG', subcommand, (b'RESETSTAT',))
+        self.stats.reset()
+        self._expired_keys = 0
+        self._evicted_keys = 0
+        return 1
+    
+    def slowlog_command(self, subcommand, *args):
+        subcommand = self._subcommand('SLOWLOG', subcommand, (b'GET', b'LEN', b'RESET'))
+        if subcommand == b'GET':
+            count = args[0] if args else 10
+            self._check_int(count)
+            return self.slowlog.get(count)
+        if subcommand == b'LEN':
+            return len(self.slowlog)
+        self.slowlog.reset()
+        return 1
+    
+    def client_command(self, subcommand, *args):
+        """
+        CLIENT TRACKING ON channel has the keys this connection reads from then
+        on invalidated through channel once they change, OFF stops tracking.
+        """
+        self._subcommand('CLIENT', subcommand, (b'TRACKING',))
+        mode = self._subcommand('CLIENT TRACKING', args[0] if args else None, (b'ON', b'OFF'))
+        if mode == b'OFF':
+            self.tracking.disable(self.client)
+        elif len(args) != 2:
+            raise CommandError('CLIENT TRACKING ON takes the channel to send invalidations to')
+        else:
+            self.tracking.enable(self.client, args[1])
+        return 1
+    
+    def profile(self, subcommand, *args):
+        """
+        PROFILE START [seconds] samples the commands run for that long, PROFILE
+        STOP [count] ends it early if need be and returns the hottest functions.
+        """
+        subcommand = self._subcommand('PROFILE', subcommand, (b'START', b'STOP'))
+        args = args[:1]
+        if subcommand == b'START':
+            for seconds in args:
+                if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0:
+                    raise CommandError('Profiling window must be a positive number of seconds')
+            self.profiler.start(*args)
+            return 1
+        self._check_int(*args)
+        return self.profiler.stop(*args)
+    
     def restore_from_disk(self, filename, merge=False):
         if not os.path.exists(filename):
             return False
-        with open(filename, 'rb') as fh:
-            state = pickle.load(fh)
-        self._set_state(state, merge=merge)
+        try:
+            with open(filename, 'rb') as fh:
+                kv, deadlines = snapshot.load(fh)
+        except (OSError, SnapshotError) as e:
+            raise CommandError(f'Error loading snapshot: {e}')
+        self._replace(kv, deadlines, merge)
         return True
     
+    def _replace(self, kv, deadlines, merge=False):
+        self._compact(kv)
+        if not merge:
+            self._kv = ScanDict(kv)
+            self._expiry.clear()
+        else:
+            # keys already in memory win over the ones from the file
+            for key in self._kv:
+                kv.pop(key, None)
+                deadlines.pop(key, None)
+            self._kv.update(kv)
+        for key, deadline in deadlines.items():
+            self._expiry.add(key, deadline)
+        self._reset_memory()
+    
+    def _compact(self, kv):
+        # snapshots load hashes and sets as dicts and sets
+        for value in kv.values():
+            if value.data_type == HASH:
+                value.value = encode_hash(value.value, self._hash_max_entries,
+                                          self._hash_max_value)
+            elif value.data_type == SET:
+                value.value = encode_set(value.value, self._set_max_entries,
+                                         self._set_max_value, self._set_max_intset_entries)
+    
+    def _hash(self, key, fields, values):
+        # the hash at key in an encoding that can take fields and values
+        value = self._kv[key]
+        value.value = fit_hash(value.value, fields, values, self._hash_max_entries,
+                               self._hash_max_value)
+        return value.value
+    
+    def _set(self, key, members):
+        value = self._kv[key]
+        value.value = fit_set(value.value, members, self._set_max_entries, self._set_max_value,
+                              self._set_max_intset_entries)
+        return value.value
+    
+    def _new_set(self, members):
+        return Value(SET, encode_set(members, self._set_max_entries, self._set_max_value,
+                                     self._set_max_intset_entries))
+    
     def merge_from_disk(self, filename):
         return self.restore_from_disk(filename, merge=True)
 
@@ -156,6 +810,9 @@ class CommandHandler:
         self.kv_flush()
         return 1
     
+    def publish(self, channel, message):
+        return self.pubsub.publish(channel, message)
+    
     def client_quit(self):
         raise ClientQuit('client closed connection')
     
@@ -166,11 +823,13 @@ class CommandHandler:
     @enforce_datatype(QUEUE)
     def lpush(self, key, *values):
         self._kv[key].value.extendleft(values)
+        self._pushed(key)
         return len(values)
    
     @enforce_datatype(QUEUE)
     def rpush(self, key, *values):
         self._kv[key].value.extend(values)
+        self._pushed(key)
         return len(values) 
     
     @enforce_datatype(QUEUE)
@@ -218,9 +877,9 @@ class CommandHandler:
     
     @enforce_datatype(QUEUE)
     def ltrim(self, key, start, stop):
-        trimmed = list(self._kv[key].value)[start:stop]
-        self._kv[key] = Value(QUEUE, deque(trimmed))
-        return len(trimmed)
+        value = self._kv[key].value
+        value.trim(start, stop)
+        return len(value)
 
     @enforce_datatype(QUEUE)
     def rpoplpush(self, src, dest):
@@ -230,11 +889,120 @@ class CommandHandler:
         except IndexError:
             return 0
         else:
+            self._pushed(dest)
             return 1
+    
+    def _block_timeout(self, timeout):
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)):
+            raise CommandError('Timeout is not a number')
+        if timeout < 0:
+            raise CommandError('Timeout is negative')
+        return timeout
+    
+    def _blocking_pop(self, keys, timeout, left, dest=None):
+        if not keys:
+            raise CommandError('At least one key is required')
+        timeout = self._block_timeout(timeout)
+        keys = tuple(dict.fromkeys(keys))
+        for key in keys:
+            self.check_datatype(QUEUE, key, set_missing=False)
+        if dest is not None:
+            self.check_datatype(QUEUE, dest, set_missing=False)
+        
+        for key in keys:
+            if key in self._kv and self._kv[key].value:
+                items = self._kv[key].value
+                value = items.popleft() if left else items.pop()
+                if dest is None:
+                    return [key, value]
+                self.check_datatype(QUEUE, dest)
+                self._kv[dest].value.appendleft(value)
+                self._pushed(dest)
+                return value
+        
+        # nothing to pop, the server waits on the returned Waiter
+        waiter = Waiter(keys, left, dest, timeout)
+        for key in keys:
+            self._waiters.setdefault(key, deque()).append(waiter)
+        return waiter
+    
+    def blpop(self, *args):
+        return self._blocking_pop(args[:-1], args[-1] if args else None, left=True)
+    
+    def brpop(self, *args):
+        return self._blocking_pop(args[:-1], args[-1] if args else None, left=False)
+    
+    def brpoplpush(self, src, dest, timeout):
+        return self._blocking_pop((src,), timeout, left=False, dest=dest)
+    
+    def _pushed(self, key):
+        if key in self._waiters:
+            self._ready.add(key)
+    
+    def _unpark(self, waiter):
+        for key in waiter.keys:
+            waiters = self._waiters.get(key)
+            if waiters is None:
+                continue
+            try:
+                waiters.remove(waiter)
+            except ValueError:
+                pass
+            if not waiters:
+                del self._waiters[key]
+    
+    def serve_waiters(self):
+        # hand what was pushed to the clients blocked on those keys, in the
+        # order they blocked, no other key is looked at
+        while self._ready:
+            key = self._ready.pop()
+            value = self._kv.get(key)
+            if value is None or value.data_type != QUEUE:
+                continue
+            items = value.value
+            while items and key in self._waiters:
+                waiter = self._waiters[key][0]
+                self._unpark(waiter)
+                if waiter.alive is not None and not waiter.alive():
+                    waiter.set(None)
+                    continue
+                dest = waiter.dest
+                if dest is not None:
+                    try:
+                        self.check_datatype(QUEUE, dest)
+                    except CommandError as e:
+                        waiter.set(e)
+                        continue
+                
+                item = items.popleft() if waiter.left else items.pop()
+                if dest is None:
+                    self.propagate([b'LPOP' if waiter.left else b'RPOP', key])
+                    waiter.set([key, item])
+                else:
+                    self._kv[dest].value.appendleft(item)
+                    self.propagate([b'RPOPLPUSH', key, dest])
+                    self.invalidate([dest])
+                    self._pushed(dest)
+                    if self._memory.enabled:
+                        self._memory.touch(dest, self._kv[dest])
+                    waiter.set(item)
+            if self._memory.enabled:
+                self._memory.touch(key, value)
+    
+    def finish_wait(self, waiter):
+        """The reply for a Waiter, None if it wasn't served before timing out."""
+        if not waiter.done:
+            self._unpark(waiter)
+            waiter.done = True
+        return waiter.result
 
     @enforce_datatype(QUEUE)
     def lrange(self, key, start, end=None):
-        return list(self._kv[key].value)[start:end]
+        return self._kv[key].value.range(start, end)
+    
+    @enforce_datatype(QUEUE)
+    def lscan(self, key, cursor, *options):
+        return self._scan(partial(walk_list, self._kv[key].value), cursor, options)
     
     @enforce_datatype(QUEUE)
     def lflush(self, key):
@@ -265,9 +1033,9 @@ class CommandHandler:
     
     @enforce_datatype(HASH)
     def hincrby(self, key, field, incr=1):
-        self._kv[key].value.setdefault(field, 0)
-        self._kv[key].value[field] += incr
-        return self._kv[key].value[field]
+        value = self._hash(key, (field,), ())
+        value[field] = value.get(field, 0) + incr
+        return value[field]
     
     @enforce_datatype(HASH)
     def hkeys(self, key):
@@ -287,19 +1055,19 @@ class CommandHandler:
     
     @enforce_datatype(HASH)
     def hmset(self, key, data):
-        self._kv[key].value.update(data)
+        self._hash(key, data.keys(), data.values()).update(data)
         return len(data)
     
     @enforce_datatype(HASH)
     def hset(self, key, field, value):
-        self._kv[key].value[field] = value
+        self._hash(key, (field,), (value,))[field] = value
         return 1
     
     @enforce_datatype(HASH)
     def hsetnx(self, key, field, value):
         kval = self._kv[key].value
         if field not in kval:
-            kval[field] = value
+            self._hash(key, (field,), (value,))[field] = value
             return 1
         return 0
     
@@ -307,9 +1075,15 @@ class CommandHandler:
     def hvals(self, key):
         return list(self._kv[key].value.values())
     
+    @enforce_datatype(HASH)
+    def hscan(self, key, cursor, *options):
+        value = self._kv[key].value
+        cursor, fields = self._scan(partial(walk, value), cursor, options)
+        return [cursor, {field: value[field] for field in fields}]
+    
     @enforce_datatype(SET)
     def sadd(self, key, *members):
-        self._kv[key].value.update(members)
+        self._set(key, members).update(members)
         return self.scard(key)
     
     @enforce_datatype(SET)
@@ -330,7 +1104,7 @@ class CommandHandler:
     def sdiffstore(self, dest, key, *keys):
         diff = set(self.sdiff(key, *keys))
         self.check_datatype(SET, dest)
-        self._kv[dest] = Value(SET, diff)
+        self._kv[dest] = self._new_set(diff)
         return len(diff)
     
     @enforce_datatype(SET)
@@ -338,7 +1112,7 @@ class CommandHandler:
         src = set(self._kv[key].value)
         for other_key in keys:
             self.check_datatype(SET, other_key)
-            src &= self._kv[other_key].value
+            src.intersection_update(self._kv[other_key].value)
 
         return list(src)
     
@@ -346,7 +1120,7 @@ class CommandHandler:
     def sinterstore(self, dest, key, *keys):
         inter = set(self.sinter(key, *keys))
         self.check_datatype(SET, dest)
-        self._kv[dest] = Value(SET, inter)
+        self._kv[dest] = self._new_set(inter)
         return len(inter)
     
     @enforce_datatype(SET)
@@ -384,16 +1158,159 @@ class CommandHandler:
         src = set(self._kv[key].value)
         for key in keys:
             self.check_datatype(SET, key)
-            src |= self._kv[key].value
+            src.update(self._kv[key].value)
         return list(src)
 
     @enforce_datatype(SET)
     def sunionstore(self, dest, key, *keys):
         un = set(self.sunion(key, *keys))
         self.check_datatype(SET, dest)
-        self._kv[dest] = Value(SET, un)
+        self._kv[dest] = self._new_set(un)
         return len(un)
     
+    @enforce_datatype(SET)
+    def sscan(self, key, cursor, *options):
+        return self._scan(partial(walk, self._kv[key].value), cursor, options)
+    
+    def _score(self, value):
+        # scores are numbers, '+inf' and '-inf' included
+        if isinstance(value, bool):
+            raise CommandError('Score is not a number')
+        if not isinstance(value, (int, float)):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise CommandError('Score is not a number')
+        if value != value:
+            raise CommandError('Score is not a number')
+        return value
+    
+    def _score_bound(self, value):
+        # '(' in front of a bound excludes it
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        if isinstance(value, str) and value.startswith('('):
+            return self._score(value[1:]), True
+        return self._score(value), False
+    
+    def _member(self, member):
+        try:
+            member_kind(member)
+        except TypeError:
+            raise CommandError('Members must be strings, bytes or numbers')
+        return member
+    
+    def _range_options(self, options):
+        # trailing WITHSCORES and LIMIT offset count
+        withscores = False
+        offset, count = 0, None
+        options = list(options)
+        while options:
+            option = options.pop(0)
+            if isinstance(option, str):
+                option = option.encode('utf-8')
+            option = option.upper() if isinstance(option, bytes) else option
+            if option == b'WITHSCORES':
+                withscores = True
+            elif option == b'LIMIT' and len(options) >= 2:
+                offset, count = options.pop(0), options.pop(0)
+                self._check_int(offset, count)
+            else:
+                raise CommandError(f'Unknown option {option}')
+        return withscores, offset, count
+    
+    def _check_int(self, *values):
+        for value in values:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise CommandError('Value is not an integer')
+    
+    def _pairs(self, pairs, withscores):
+        if withscores:
+            return [[member, score] for member, score in pairs]
+        return [member for member, _ in pairs]
+    
+    @enforce_datatype(ZSET)
+    def zadd(self, key, *args):
+        if len(args) % 2:
+            raise CommandError('ZADD needs score member pairs')
+        # everything is checked before anything is added
+        pairs = [(self._member(member), self._score(score))
+                 for score, member in zip(args[::2], args[1::2])]
+        return self._kv[key].value.update(pairs)
+    
+    @enforce_datatype(ZSET)
+    def zcard(self, key):
+        return len(self._kv[key].value)
+    
+    @enforce_datatype(ZSET)
+    def zincrby(self, key, incr, member):
+        zset = self._kv[key].value
+        score = self._score(incr) + (zset.score(self._member(member)) or 0)
+        if score != score:
+            raise CommandError('Resulting score is not a number')
+        zset.add(member, score)
+        return score
+    
+    @enforce_datatype(ZSET)
+    def zpopmin(self, key, count=1):
+        self._check_int(count)
+        return self._pairs(self._kv[key].value.pop(count), True)
+    
+    @enforce_datatype(ZSET)
+    def zpopmax(self, key, count=1):
+        self._check_int(count)
+        return self._pairs(self._kv[key].value.pop(count, reverse=True), True)
+    
+    @enforce_datatype(ZSET)
+    def zrange(self, key, start, stop, *options):
+        self._check_int(start, stop)
+        withscores, _, _ = self._range_options(options)
+        return self._pairs(self._kv[key].value.range(start, stop), withscores)
+    
+    @enforce_datatype(ZSET)
+    def zrevrange(self, key, start, stop, *options):
+        self._check_int(start, stop)
+        withscores, _, _ = self._range_options(options)
+        return self._pairs(self._kv[key].value.range(start, stop, reverse=True), withscores)
+    
+    @enforce_datatype(ZSET)
+    def zrangebyscore(self, key, min_score, max_score, *options):
+        withscores, offset, count = self._range_options(options)
+        (low, low_ex), (high, high_ex) = self._score_bound(min_score), self._score_bound(max_score)
+        pairs = self._kv[key].value.range_by_score(low, high, low_ex, high_ex, offset, count)
+        return self._pairs(pairs, withscores)
+    
+    @enforce_datatype(ZSET)
+    def zrevrangebyscore(self, key, max_score, min_score, *options):
+        withscores, offset, count = self._range_options(options)
+        (low, low_ex), (high, high_ex) = self._score_bound(min_score), self._score_bound(max_score)
+        pairs = self._kv[key].value.range_by_score(low, high, low_ex, high_ex, offset, count,
+                                                   reverse=True)
+        return self._pairs(pairs, withscores)
+    
+    @enforce_datatype(ZSET)
+    def zrank(self, key, member):
+        return self._kv[key].value.rank(self._member(member))
+    
+    @enforce_datatype(ZSET)
+    def zrevrank(self, key, member):
+        return self._kv[key].value.rank(self._member(member), reverse=True)
+    
+    @enforce_datatype(ZSET)
+    def zrem(self, key, *members):
+        zset = self._kv[key].value
+        return sum(zset.remove(self._member(member)) for member in members)
+    
+    @enforce_datatype(ZSET)
+    def zscan(self, key, cursor, *options):
+        zset = self._kv[key].value
+        cursor, members = self._scan(zset.scan, cursor, options)
+        return [cursor, self._pairs([(member, zset.score(member)) for member in members], True)]
+    
+    @enforce_datatype(ZSET)
+    def zscore(self, key, member):
+        return self._kv[key].value.score(self._member(member))
+    
     def kv_exists(self, key):
         return 1 if key in self._kv and not self.check_expired(key) else 0
     
@@ -431,6 +1348,7 @@ class CommandHandler:
     def kv_delete(self, key):
         if key in self._kv:
             del self._kv[key]
+            self.unexpire(key)
             return 1
         return 0
     
@@ -463,6 +1381,7 @@ class CommandHandler:
         else:
             orig = None
         
+        self.unexpire(key)
         self._kv[key] = Value(KV, value)
         return orig
     
@@ -482,6 +1401,7 @@ class CommandHandler:
             except KeyError:
                 pass
             else:
+                self.unexpire(key)
                 n +=1
         return n
     
@@ -498,6 +1418,7 @@ class CommandHandler:
         accum = []
         for key in keys:
             if self.kv_exists(key):
+                self.unexpire(key)
                 accum.append(self._kv.pop(key).value)
             else:
                 accum.append(None)
@@ -525,42 +1446,124 @@ class CommandHandler:
     
     def kv_pop(self, key):
         if self.kv_exists(key):
+            self.unexpire(key)
             return self._kv.pop(key).value
     
     def kv_len(self):
         return len(self._kv)
     
+    def _scan_options(self, options, types=False):
+        # trailing MATCH pattern, COUNT n and, for SCAN, TYPE name
+        pattern, count, data_type = None, DEFAULT_COUNT, None
+        options = list(options)
+        while options:
+            option = options.pop(0)
+            if isinstance(option, str):
+                option = option.encode('utf-8')
+            option = option.upper() if isinstance(option, bytes) else option
+            if not options:
+                raise CommandError(f'Missing value for {option}')
+            value = options.pop(0)
+            if option == b'MATCH':
+                pattern = value
+            elif option == b'COUNT':
+                self._check_int(value)
+                if value < 1:
+                    raise CommandError('COUNT must be positive')
+                count = value
+            elif option == b'TYPE' and types:
+                name = value.encode('utf-8') if isinstance(value, str) else value
+                if name not in TYPE_NAMES:
+                    raise CommandError(f'Unknown type {value}')
+                data_type = TYPE_NAMES[name]
+            else:
+                raise CommandError(f'Unknown option {option}')
+        return pattern, count, data_type
+    
+    def _scan(self, walker, cursor, options):
+        # the entries walked by this call from cursor that match
+        pattern, count, _ = self._scan_options(options)
+        cursor, batch = walker(cursor, count)
+        if pattern is not None:
+            batch = [entry for entry in batch if match(pattern, entry)]
+        return [cursor, batch]
+    
+    def scan(self, cursor, *options):
+        pattern, count, data_type = self._scan_options(options, types=True)
+        kv = self._kv
+        cursor, batch = kv.order.walk(cursor, count)
+        keys = []
+        for key in batch:
+            value = kv.get(key)
+            if value is None or self.check_expired(key):
+                continue
+            if data_type is not None and value.data_type != data_type:
+                continue
+            if pattern is not None and not match(pattern, key):
+                continue
+            keys.append(key)
+        return [cursor, keys]
+    
     def expire(self, key, nseconds):
-        eta = time.time()+nseconds
-        self._expiry_map[key] = eta
-        heapq.heappush(self._expiry, (eta, key))
+        return self.pexpireat(key, now_ms() + int(nseconds * 1000))
+    
+    def pexpire(self, key, nmilliseconds):
+        return self.pexpireat(key, now_ms() + int(nmilliseconds))
+    
+    def pexpireat(self, key, timestamp):
+        if not self.kv_exists(key):
+            return 0
+        self._expiry.add(key, int(timestamp))
+        return 1
+    
+    def pttl(self, key):
+        if not self.kv_exists(key):
+            return -2
+        deadline = self._expiry.get(key)
+        if deadline is None:
+            return -1
+        return max(deadline - now_ms(), 0)
+    
+    def ttl(self, key):
+        remaining = self.pttl(key)
+        if remaining < 0:
+            return remaining
+        return (remaining + 500) // 1000
+    
+    def persist(self, key):
+        if not self.kv_exists(key):
+            return 0
+        return 0 if self._expiry.remove(key) is None else 1
     
     def kv_flush(self):
         kvlen = self.kv_len()
         self._kv.clear()
-        self._expiry = []
-        self._expiry_map = {}
+        self._expiry.clear()
+        self._memory.clear()
         return kvlen
     
     def check_expired(self, key, ts=None):
-        ts = ts or time.time()
-        return key in self._expiry_map and ts > self._expiry_map[key]
+        deadline = self._expiry.get(key)
+        if deadline is None:
+            return False
+        return (now_ms() if ts is None else int(ts * 1000)) >= deadline
     
     def unexpire(self, key):
-        self._expiry_map.pop(key, None)
+        self._expiry.remove(key)
     
-    def clean_expired(self, ts=None): # TODO: schedule clean up via schedular process
-        ts = ts or time.time()
+    def clean_expired(self, ts=None, budget=None):
+        # active expiry, called periodically by the server. budget caps the
+        # seconds spent per call so a large sweep never stalls requests, keys
+        # left over are picked up by the next call
+        now = now_ms() if ts is None else int(ts * 1000)
+        deadline = time.monotonic() + budget if budget is not None else None
         n = 0
-        while self._expiry:
-            expires, key = heapq.heappop(self._expiry)
-            if ts > expires:
-                heapq.heappush(self._expiry, (expires, key))
-                break
-                
-            if self._expiry_map.get(key) == expires:
-                del self._expiry_map[key]
-                del self._kv[key]
-                n +=1
+        expired = []
+        for key in self._expiry.advance(now, deadline):
+            self._memory.remove(key)
+            if self._kv.pop(key, None) is not None:
+                n += 1
+                expired.append(key)
+        self._expired_keys += n
+        self.invalidate(expired)
         return n
-        
\ No newline at end of file
@@ -0,0 +1,309 @@
+"""
+Compact encodings for small hashes and sets.
+
+Most hashes and sets hold a handful of items, where a dict or a set spends
+more memory on its hash table than on the items. Small ones are kept in flat
+python lists instead, and sets of integers in a sorted array('q'). Lookups
+are linear (or a binary search) in C, which at these sizes is as fast as
+hashing. The command handler swaps them for a dict or a set once they grow
+past the configured limits, see `fit_hash` and `fit_set`, they never go back.
+Those are a ScanDict and a ScanSet, which the scans can walk in hash order.
+"""
+from array import array
+from bisect import bisect_left
+from itertools import islice
+import sys
+
+from scan import ScanDict, ScanSet
+
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+# items looked at to estimate the memory held
+SIZE_SAMPLES = 8
+
+
+def _sampled_size(container, items, n):
+    size = object.__sizeof__(container) + sys.getsizeof(items)
+    if n:
+        sample = list(islice(iter(container), SIZE_SAMPLES))
+        size += sum(map(sys.getsizeof, sample)) * n // len(sample)
+    return size
+
+
+def _fit(items, max_size):
+    # strings longer than max_size bytes aren't kept in compact encodings
+    for item in items:
+        if isinstance(item, (bytes, str)) and len(item) > max_size:
+            return False
+    return True
+
+
+def _int64(items):
+    for item in items:
+        if type(item) is not int or not INT64_MIN <= item <= INT64_MAX:
+            return False
+    return True
+
+
+class SmallHash:
+    """A dict as a flat list of alternating fields and values."""
+    __slots__ = ('_items',)
+
+    def __init__(self, items=()):
+        self._items = []
+        self.update(items)
+
+    def _find(self, field):
+        # a value equal to field may come first
+        items = self._items
+        try:
+            i = items.index(field)
+            while i & 1:
+                i = items.index(field, i + 1)
+        except ValueError:
+            return -1
+        return i
+
+    def __len__(self):
+        return len(self._items) // 2
+
+    def __contains__(self, field):
+        return self._find(field) >= 0
+
+    def __iter__(self):
+        return iter(self._items[::2])
+
+    def __getitem__(self, field):
+        i = self._find(field)
+        if i < 0:
+            raise KeyError(field)
+        return self._items[i + 1]
+
+    def __setitem__(self, field, value):
+        i = self._find(field)
+        if i < 0:
+            hash(field)
+            self._items += (field, value)
+        else:
+            self._items[i + 1] = value
+
+    def __delitem__(self, field):
+        i = self._find(field)
+        if i < 0:
+            raise KeyError(field)
+        del self._items[i:i + 2]
+
+    def __eq__(self, other):
+        if isinstance(other, (SmallHash, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __sizeof__(self):
+        return _sampled_size(self, self._items, len(self._items))
+
+    def __repr__(self):
+        return f'SmallHash({dict(self.items())!r})'
+
+    def get(self, field, default=None):
+        i = self._find(field)
+        return default if i < 0 else self._items[i + 1]
+
+    def setdefault(self, field, default=None):
+        i = self._find(field)
+        if i < 0:
+            self[field] = default
+            return default
+        return self._items[i + 1]
+
+    def update(self, items):
+        if not self._items:
+            # fields repeated in items keep their last value, like a dict's
+            self._items = [x for pair in dict(items).items() for x in pair]
+            return
+        if hasattr(items, 'items'):
+            items = items.items()
+        for field, value in items:
+            self[field] = value
+
+    def keys(self):
+        return self._items[::2]
+
+    def values(self):
+        return self._items[1::2]
+
+    def items(self):
+        items = self._items
+        return zip(items[::2], items[1::2])
+
+
+class SmallSet:
+    """A set as a list of its members."""
+    __slots__ = ('_members',)
+
+    def __init__(self, members=()):
+        self._members = []
+        self.update(members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, member):
+        return member in self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __eq__(self, other):
+        if isinstance(other, (SmallSet, IntSet, set, frozenset)):
+            return set(self) == set(other)
+        return NotImplemented
+
+    def __sizeof__(self):
+        return _sampled_size(self, self._members, len(self._members))
+
+    def __repr__(self):
+        return f'SmallSet({set(self._members)!r})'
+
+    def add(self, member):
+        if member not in self._members:
+            hash(member)
+            self._members.append(member)
+
+    def update(self, members):
+        own = self._members
+        own += [member for member in dict.fromkeys(members) if member not in own]
+
+    def remove(self, member):
+        try:
+            self._members.remove(member)
+        except ValueError:
+            raise KeyError(member)
+
+    def discard(self, member):
+        if member in self._members:
+            self._members.remove(member)
+
+    def pop(self):
+        try:
+            return self._members.pop()
+        except IndexError:
+            raise KeyError('pop from an empty set')
+
+
+class IntSet(SmallSet):
+    """A set of 64 bit integers as a sorted array, searched by bisection."""
+    __slots__ = ()
+
+    def __init__(self, members=()):
+        self._members = array('q')
+        self.update(members)
+
+    def _find(self, member):
+        members = self._members
+        try:
+            i = bisect_left(members, member)
+        except TypeError:
+            return -1
+        return i if i < len(members) and members[i] == member else -1
+
+    def __contains__(self, member):
+        return self._find(member) >= 0
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self._members)
+
+    def __repr__(self):
+        return f'IntSet({set(self._members)!r})'
+
+    def add(self, member):
+        members = self._members
+        i = bisect_left(members, member)
+        if i == len(members) or members[i] != member:
+            members.insert(i, member)
+
+    def update(self, members):
+        members = list(members)
+        if len(members) == 1:
+            self.add(members[0])
+            return
+        merged = set(members)
+        merged.update(self._members)
+        self._members = array('q', sorted(merged))
+
+    def remove(self, member):
+        i = self._find(member)
+        if i < 0:
+            raise KeyError(member)
+        del self._members[i]
+
+    def discard(self, member):
+        i = self._find(member)
+        if i >= 0:
+            del self._members[i]
+
+
+def new_hash(max_entries):
+    return SmallHash() if max_entries else ScanDict()
+
+
+def new_set(max_entries, max_intset_entries):
+    if max_intset_entries:
+        return IntSet()
+    return SmallSet() if max_entries else ScanSet()
+
+
+def fit_hash(value, fields, values, max_entries, max_size):
+    """
+    The hash to set `fields` to `values` in: `value` itself or, if they would
+    take it past the limits, a dict with its contents.
+    """
+    if type(value) is not SmallHash:
+        return value
+    if (len(value) + len(fields) <= max_entries and _fit(fields, max_size)
+            and _fit(values, max_size)):
+        return value
+    return ScanDict(value.items())
+
+
+def fit_set(value, members, max_entries, max_size, max_intset_entries):
+    """
+    The set to add `members` to: `value` itself or, if they would take it past
+    the limits, a more general encoding with its contents.
+    """
+    kind = type(value)
+    if kind is ScanSet:
+        return value
+    n = len(value) + len(members)
+    if kind is IntSet:
+        if n <= max_intset_entries and _int64(members):
+            return value
+    elif n <= max_entries and _fit(members, max_size):
+        return value
+    if n <= max_entries and _fit(members, max_size):
+        small = SmallSet()
+        small._members = list(value)
+        return small
+    return ScanSet(value)
+
+
+def encode_hash(value, max_entries, max_size):
+    """`value`, a dict, in the most compact encoding that holds it."""
+    if len(value) <= max_entries and _fit(value.keys(), max_size) and _fit(value.values(), max_size):
+        small = SmallHash()
+        small._items = [x for pair in value.items() for x in pair]
+        return small
+    return ScanDict(value)
+
+
+def encode_set(value, max_entries, max_size, max_intset_entries):
+    """`value`, a set, in the most compact encoding that holds it."""
+    if len(value) <= max_intset_entries and _int64(value):
+        intset = IntSet()
+        intset._members = array('q', sorted(value))
+        return intset
+    if len(value) <= max_entries and _fit(value, max_size):
+        small = SmallSet()
+        small._members = list(value)
+        return small
+    return ScanSet(value)
@@ -1,9 +1,33 @@
 from collections import namedtuple
 
 Error = namedtuple('Error', ('message',))
-Value = namedtuple('Value', ('data_type', 'value'))
+
+
+class Value:
+    """
+    The data type of a key and its value. Slotted rather than a namedtuple,
+    it's allocated for every key.
+    """
+    __slots__ = ('data_type', 'value')
+
+    def __init__(self, data_type, value):
+        self.data_type = data_type
+        self.value = value
+
+    def __iter__(self):
+        return iter((self.data_type, self.value))
+
+    def __eq__(self, other):
+        if isinstance(other, Value):
+            return self.data_type == other.data_type and self.value == other.value
+        return NotImplemented
+
+    def __repr__(self):
+        return f'Value(data_type={self.data_type!r}, value={self.value!r})'
+
 
 KV = 0
 HASH = 1
 QUEUE = 2
 SET = 3
+ZSET = 4
@@ -0,0 +1,180 @@
+from bisect import insort
+from collections import deque
+from itertools import islice
+import random
+import sys
+import time
+
+
+NOEVICTION = 'noeviction'
+ALLKEYS_LRU = 'allkeys-lru'
+ALLKEYS_LFU = 'allkeys-lfu'
+VOLATILE_TTL = 'volatile-ttl'
+POLICIES = (NOEVICTION, ALLKEYS_LRU, ALLKEYS_LFU, VOLATILE_TTL)
+
+# rough cost of a slot in the keyspace dict plus the per key metadata
+ENTRY_OVERHEAD = 96
+# elements looked at to estimate the size of a collection
+SIZE_SAMPLES = 8
+# best candidates kept between evictions, as redis does
+POOL_SIZE = 16
+
+# logarithmic access counter, see redis' LFU implementation
+LFU_INIT = 5
+LFU_MAX = 255
+LFU_LOG_FACTOR = 10
+LFU_DECAY_SECONDS = 60
+
+
+def estimate_size(obj):
+    """
+    Approximate the memory held by obj. Collections are extrapolated from a
+    few elements, so the cost doesn't depend on their length.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        if obj:
+            sample = list(islice(obj.items(), SIZE_SAMPLES))
+            per_item = sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in sample)
+            size += per_item * len(obj) // len(sample)
+    elif isinstance(obj, (list, tuple, deque, set, frozenset)):
+        if obj:
+            sample = list(islice(obj, SIZE_SAMPLES))
+            size += sum(map(sys.getsizeof, sample)) * len(obj) // len(sample)
+    return size
+
+
+def parse_size(value):
+    value = str(value).strip().lower()
+    for suffix, multiplier in (('gb', 2**30), ('mb', 2**20), ('kb', 2**10), ('b', 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * multiplier)
+    return int(value)
+
+
+class KeyMeta:
+    __slots__ = ('index', 'size', 'accessed', 'counter')
+
+    def __init__(self, index, size, accessed):
+        self.index = index
+        self.size = size
+        self.accessed = accessed
+        self.counter = LFU_INIT
+
+
+class Evictor:
+    """
+    Tracks an estimate of the memory used by the keyspace and picks keys to
+    evict once it goes over `maxmemory`.
+
+    Victims are chosen the way redis does it, by sampling a few random keys and
+    keeping the best candidates in a small pool, rather than by scanning the
+    whole keyspace. Keys are also kept in a list next to their metadata so a
+    random key can be drawn in O(1).
+    """
+    def __init__(self, maxmemory=0, policy=NOEVICTION, samples=5):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown maxmemory policy {policy}')
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self.samples = samples
+        self.used = 0
+        self._meta = {}
+        self._keys = []
+        self._pool = []
+
+    @property
+    def enabled(self):
+        return self.maxmemory > 0
+
+    def over_limit(self):
+        return self.used > self.maxmemory
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        self.used = 0
+        self._meta = {}
+        self._keys = []
+        self._pool = []
+
+    def touch(self, key, value):
+        """Refresh the size and access metadata of key, value is None once deleted."""
+        if value is None:
+            self.remove(key)
+            return
+        size = ENTRY_OVERHEAD + sys.getsizeof(key) + estimate_size(value.value)
+        meta = self._meta.get(key)
+        now = time.monotonic()
+        if meta is None:
+            self._meta[key] = KeyMeta(len(self._keys), size, now)
+            self._keys.append(key)
+            self.used += size
+            return
+        self.used += size - meta.size
+        meta.size = size
+        meta.counter = self._lfu_increment(self._lfu_decay(meta, now))
+        meta.accessed = now
+
+    def remove(self, key):
+        meta = self._meta.pop(key, None)
+        if meta is None:
+            return
+        self.used -= meta.size
+        # swap the last key into the hole to keep the list dense
+        last = self._keys.pop()
+        if last != key:
+            self._keys[meta.index] = last
+            self._meta[last].index = meta.index
+
+    def _lfu_decay(self, meta, now):
+        periods = int((now - meta.accessed) // LFU_DECAY_SECONDS)
+        return max(meta.counter - periods, 0)
+
+    def _lfu_increment(self, counter):
+        if counter >= LFU_MAX:
+            return LFU_MAX
+        base = max(counter - LFU_INIT, 0)
+        if random.random() < 1. / (base * LFU_LOG_FACTOR + 1):
+            return counter + 1
+        return counter
+
+    def _score(self, key, expiry):
+        # lower is evicted first
+        if self.policy == VOLATILE_TTL:
+            return expiry.get(key)
+        meta = self._meta[key]
+        if self.policy == ALLKEYS_LFU:
+            return self._lfu_decay(meta, time.monotonic())
+        return meta.accessed
+
+    def victim(self, expiry):
+        """Return the next key to evict, or None if there is nothing to evict."""
+        if self.policy == NOEVICTION or not self._keys:
+            return
+
+        if self.policy == VOLATILE_TTL:
+            candidates = expiry.nearest(self.samples)
+        else:
+            keys = self._keys
+            candidates = [keys[random.randrange(len(keys))] for _ in range(self.samples)]
+
+        pooled = {key for _, key in self._pool}
+        for key in candidates:
+            if key in pooled or key not in self._meta:
+                continue
+            score = self._score(key, expiry)
+            if score is None:
+                continue
+            if len(self._pool) < POOL_SIZE or score < self._pool[-1][0]:
+                insort(self._pool, (score, key), key=lambda item: item[0])
+                pooled.add(key)
+                if len(self._pool) > POOL_SIZE:
+                    self._pool.pop()
+
+        # pooled keys might have been deleted since they were sampled
+        while self._pool:
+            _, key = self._pool.pop(0)
+            if key in self._meta and (self.policy != VOLATILE_TTL or key in expiry):
+                return key
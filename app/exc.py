@@ -4,4 +4,18 @@ class CommandError(Exception):
         super(CommandError, self).__init__()
 
 class ClientQuit(Exception): pass
-class Shutdown(Exception): pass
\ No newline at end of file
+class Shutdown(Exception): pass
+class SnapshotError(Exception): pass
+
+class Subscribed(Exception):
+    # raised to switch a connection to push mode, with the requests left to run
+    def __init__(self, requests):
+        self.requests = requests
+        super(Subscribed, self).__init__()
+
+class Replicate(Exception):
+    # raised by PSYNC to turn a connection into a replica's stream
+    def __init__(self, replid, offset):
+        self.replid = replid
+        self.offset = offset
+        super(Replicate, self).__init__()
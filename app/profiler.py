@@ -0,0 +1,110 @@
+"""
+Sampling profiler for a live server.
+
+A thread wakes up every `interval` seconds for a fixed window and looks at
+the stack of every other thread. Only stacks inside one of the functions in
+scope, the server's dispatch path, are counted, so time spent idle waiting
+for clients doesn't drown out the commands. Each function is credited with
+the samples it was running in (self) and the ones it was on the stack for
+(total).
+"""
+from collections import Counter
+import os
+import sys
+import time
+
+from gevent.monkey import get_original
+
+from exc import CommandError
+
+
+# with gevent's monkey patching these would be greenlets, sampling has to
+# happen in a real thread to see the one running the commands
+start_new_thread, allocate_lock, get_ident = get_original(
+    '_thread', ['start_new_thread', 'allocate_lock', 'get_ident'])
+sleep = get_original('time', 'sleep')
+
+DEFAULT_SECONDS = 10
+DEFAULT_INTERVAL = 0.001
+DEFAULT_TOP = 20
+
+
+def _name(code):
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})'.encode('utf-8')
+
+
+class Profiler:
+    def __init__(self, scope=()):
+        self._scope = {func.__code__ for func in scope}
+        self._done = None
+        self._stopping = False
+        self._report = None
+
+    def add_scope(self, *funcs):
+        self._scope.update(func.__code__ for func in funcs)
+
+    @property
+    def running(self):
+        return self._done is not None and self._done.locked()
+
+    def start(self, seconds=DEFAULT_SECONDS, interval=DEFAULT_INTERVAL):
+        if self.running:
+            raise CommandError('Profiling already in progress')
+        self._stopping = False
+        self._report = None
+        self._done = allocate_lock()
+        self._done.acquire()
+        start_new_thread(self._run, (seconds, interval))
+
+    def stop(self, top=DEFAULT_TOP):
+        """The functions with the most samples, stopping the window if still open."""
+        if self._done is None:
+            raise CommandError('Profiling not started')
+        self._stopping = True
+        # at most an interval
+        self._done.acquire()
+        self._done.release()
+        samples, elapsed, own, total = self._report
+        ranked = sorted(total, key=lambda code: (own[code], total[code]), reverse=True)
+        return {
+            b'samples': samples,
+            b'seconds': round(elapsed, 3),
+            b'functions': [[_name(code), own[code], total[code]] for code in ranked[:top]],
+        }
+
+    def _run(self, seconds, interval):
+        samples = 0
+        own = Counter()
+        total = Counter()
+        start = time.monotonic()
+        deadline = start + seconds
+        try:
+            while not self._stopping and time.monotonic() < deadline:
+                samples += self._sample(own, total)
+                sleep(interval)
+        finally:
+            self._report = (samples, time.monotonic() - start, own, total)
+            self._done.release()
+
+    def _sample(self, own, total):
+        scope = self._scope
+        me = get_ident()
+        n = 0
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            # the stack up to the outermost function in scope
+            stack = []
+            depth = 0
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code)
+                if code in scope:
+                    depth = len(stack)
+                frame = frame.f_back
+            if not depth:
+                continue
+            n += 1
+            own[stack[0]] += 1
+            total.update(set(stack[:depth]))
+        return n
@@ -39,12 +39,26 @@ Dictionary: "%number of elements\r\n...key0...value0...key1...value1..\r\n"
 Set: "&number of elements\r\n...elements..."
 """
 
-from io import BytesIO
 import json
 from collections import deque
 import datetime
 
+from compact import SmallHash, SmallSet, IntSet
 from const import Error
+from quicklist import QuickList
+from sorted_set import SortedSet
+
+# replies common enough to be encoded once up front
+CRLF = b'\r\n'
+NULL = b'$-1\r\n'
+TRUE = b':1\r\n'
+FALSE = b':0\r\n'
+EMPTY_ARRAY = b'*0\r\n'
+EMPTY_DICT = b'%0\r\n'
+EMPTY_SET = b'&0\r\n'
+SMALL_INTEGERS = 1024
+LARGE_PAYLOAD = 1024
+INTEGERS = [b':%d\r\n' % i for i in range(-1, SMALL_INTEGERS)]
 
 class ProtocolHandler:
     def __init__(self):
@@ -59,6 +73,26 @@ class ProtocolHandler:
             b'%': self.handle_dict,
             b'&': self.handle_set,
         }
+        self.encoders = {
+            bytes: self.encode_bytes,
+            str: self.encode_str,
+            bool: self.encode_bool,
+            int: self.encode_integer,
+            float: self.encode_float,
+            Error: self.encode_error,
+            list: self.encode_array,
+            tuple: self.encode_array,
+            deque: self.encode_array,
+            QuickList: self.encode_array,
+            SortedSet: self.encode_array,
+            dict: self.encode_dict,
+            set: self.encode_set,
+            SmallHash: self.encode_dict,
+            SmallSet: self.encode_set,
+            IntSet: self.encode_set,
+            type(None): self.encode_none,
+            datetime.datetime: self.encode_datetime,
+        }
     
     def handle_simple_string(self, socket_file):
         return socket_file.readline().rstrip(b'\r\n')
@@ -68,10 +102,10 @@ class ProtocolHandler:
     
     def handle_integer(self, socket_file):
         number = socket_file.readline().rstrip(b'\r\n')
-        if b'.' in number:
+        try:
+            return int(number)
+        except ValueError:
             return float(number)
-        
-        return int(number)
     
     def handle_string(self, socket_file):
         length = int(socket_file.readline().rstrip(b'\r\n'))
@@ -108,39 +142,273 @@ class ProtocolHandler:
         except KeyError:
             return first_byte + socket_file.readline().rstrip(b'\r\n')
     
-    def write_response(self, socket_file, data):
-        buf = BytesIO()
-        self._write(buf, data)
-        buf.seek(0)
-        socket_file.write(buf.getvalue())
-        socket_file.flush()
-        
-    def _write(self, buf, data):
-        if isinstance(data, bytes):
-            buf.write(b'$%d\r\n%s\r\n' % (len(data), data))
-        elif isinstance(data, str):
-            bdata = data.encode('utf-8')
-            buf.write(b'^%d\r\n%s\r\n' % (len(bdata), bdata))
-        elif data is True or data is False:
-            buf.write(b':%d\r\n' % (1 if data else 0))
-        elif isinstance(data, (int, float)):
-            buf.write(b':%d\r\n' % data)
-        elif isinstance(data, Error):
-            buf.write(b'-%s\r\n' % (data.message.encode('utf-8')))
-        elif isinstance(data, (list, tuple, deque)):
-            buf.write(b'*%d\r\n' % len(data))
-            for item in data:
-                self._write(buf, item)
-        elif isinstance(data, dict):
-            buf.write(b'%%%d\r\n' % len(data))
-            for key in data:
-                self._write(buf, key)
-                self._write(buf, data[key])
-        elif isinstance(data, set):
-            buf.write(b'&%d\r\n' % len(data))
-            for item in data:
-                self._write(buf, item)
-        elif data is None:
-            buf.write(b'$-1\r\n')
-        elif isinstance(data, datetime.datetime):
-            self._write(buf, str(data))
+    def write_response(self, socket_file, data, flush=True):
+        buf = bytearray()
+        self.encode(buf, data)
+        socket_file.write(buf)
+        if flush:
+            socket_file.flush()
+    
+    def encode(self, buf, data):
+        self.encoders.get(data.__class__, self.encode_other)(buf, data)
+    
+    def encode_other(self, buf, data):
+        # subclasses of the supported types, resolved once and then cached
+        for cls in data.__class__.__mro__[1:]:
+            if cls in self.encoders:
+                self.encoders[data.__class__] = self.encoders[cls]
+                return self.encoders[cls](buf, data)
+    
+    def encode_bytes(self, buf, data):
+        if len(data) < LARGE_PAYLOAD:
+            buf += b'$%d\r\n%s\r\n' % (len(data), data)
+        else:
+            # large payloads are appended as they are instead of being formatted
+            # into a temporary copy first
+            buf += b'$%d\r\n' % len(data)
+            buf += data
+            buf += CRLF
+    
+    def encode_str(self, buf, data):
+        bdata = data.encode('utf-8')
+        buf += b'^%d\r\n' % len(bdata)
+        buf += bdata
+        buf += CRLF
+    
+    def encode_bool(self, buf, data):
+        buf += TRUE if data else FALSE
+    
+    def encode_integer(self, buf, data):
+        if -1 <= data < SMALL_INTEGERS:
+            buf += INTEGERS[data + 1]
+        else:
+            buf += b':%d\r\n' % data
+    
+    def encode_float(self, buf, data):
+        buf += b':%r\r\n' % data
+    
+    def encode_error(self, buf, data):
+        buf += b'-%s\r\n' % data.message.encode('utf-8')
+    
+    def encode_none(self, buf, data):
+        buf += NULL
+    
+    def encode_datetime(self, buf, data):
+        self.encode_str(buf, str(data))
+    
+    def encode_array(self, buf, data):
+        if not data:
+            buf += EMPTY_ARRAY
+            return
+        buf += b'*%d\r\n' % len(data)
+        self._encode_items(buf, data)
+    
+    def encode_set(self, buf, data):
+        if not data:
+            buf += EMPTY_SET
+            return
+        buf += b'&%d\r\n' % len(data)
+        self._encode_items(buf, data)
+    
+    def encode_dict(self, buf, data):
+        if not data:
+            buf += EMPTY_DICT
+            return
+        buf += b'%%%d\r\n' % len(data)
+        encoders = self.encoders
+        encode_other = self.encode_other
+        for key, value in data.items():
+            encoders.get(key.__class__, encode_other)(buf, key)
+            encoders.get(value.__class__, encode_other)(buf, value)
+    
+    def _encode_items(self, buf, items):
+        encoders = self.encoders
+        encode_other = self.encode_other
+        for item in items:
+            # inline the most common element type, skipping the call
+            if item.__class__ is bytes and len(item) < LARGE_PAYLOAD:
+                buf += b'$%d\r\n%s\r\n' % (len(item), item)
+            else:
+                encoders.get(item.__class__, encode_other)(buf, item)
+
+
+class RequestParser:
+    """
+    Incremental parser for the same wire format, fed with raw bytes as they
+    arrive instead of reading from a socket file.
+
+    Partially received containers are kept on a stack so every element is only
+    parsed once no matter how many reads it takes to receive the whole frame,
+    and bulk payloads are copied straight out of the receive buffer.
+    """
+    def __init__(self):
+        self._buf = bytearray()
+        self._stack = []
+        # stream offset just past the last complete frame
+        self.offset = 0
+        self._consumed = 0
+        self.scalars = {
+            ord('+'): self.parse_simple_string,
+            ord('-'): self.parse_error,
+            ord(':'): self.parse_integer,
+        }
+        self.bulks = {
+            ord('$'): bytes,
+            ord('^'): self.parse_bytes,
+            ord('@'): self.parse_json,
+        }
+        self.containers = {
+            ord('*'): list,
+            ord('%'): self.parse_dict,
+            ord('&'): set,
+        }
+
+    def parse_simple_string(self, line):
+        return bytes(line)
+
+    def parse_error(self, line):
+        return Error(bytes(line))
+
+    def parse_integer(self, line):
+        try:
+            return int(line)
+        except ValueError:
+            return float(line)
+
+    def parse_bytes(self, data):
+        return str(data, 'utf-8')
+
+    def parse_json(self, data):
+        return json.loads(bytes(data))
+
+    def parse_dict(self, elements):
+        return dict(zip(elements[::2], elements[1::2]))
+
+    def feed(self, data):
+        self._buf += data
+
+    def parse(self):
+        try:
+            return self._parse()
+        except ValueError:
+            # framing is lost, nothing after this point can be trusted
+            self._buf.clear()
+            self._stack.clear()
+            raise
+
+    def _parse_bulks(self, buf, view, pos, size, items, remaining):
+        # fast path for the common case, the bulk strings making up a request
+        find = buf.find
+        append = items.append
+        while remaining > 0 and pos < size and buf[pos] == 36: # '$'
+            end = find(b'\r\n', pos)
+            if end == -1:
+                break
+            length = int(buf[pos+1:end])
+            if length == -1:
+                append(None)
+                pos = end + 2
+            else:
+                start = end + 2
+                stop = start + length
+                if size < stop + 2:
+                    break
+                append(bytes(view[start:stop]))
+                pos = stop + 2
+            remaining -= 1
+        return pos, remaining
+
+    def _parse(self):
+        buf = self._buf
+        find = buf.find
+        stack = self._stack
+        frames = []
+        pos = 0
+        last = -1
+        size = len(buf)
+        with memoryview(buf) as view:
+            while pos < size:
+                kind = buf[pos]
+                if kind == 42 and not stack: # '*'
+                    end = find(b'\r\n', pos)
+                    if end == -1:
+                        break
+                    count = int(buf[pos+1:end])
+                    items = []
+                    pos, remaining = self._parse_bulks(buf, view, end + 2, size,
+                                                       items, count)
+                    if remaining > 0:
+                        stack.append([kind, remaining, items])
+                        continue
+                    frames.append(items)
+                    last = pos
+                    continue
+                elif kind == 36 and stack and stack[-1][0] == 42:
+                    # resume a request that was split across reads
+                    container = stack[-1]
+                    pos, container[1] = self._parse_bulks(buf, view, pos, size,
+                                                          container[2], container[1])
+                    if container[1]:
+                        if pos < size and buf[pos] != 36:
+                            continue
+                        break
+                    stack.pop()
+                    value = container[2]
+                elif kind in self.bulks:
+                    end = find(b'\r\n', pos)
+                    if end == -1:
+                        break
+                    length = int(buf[pos+1:end])
+                    if length == -1:
+                        value = None
+                        pos = end + 2
+                    else:
+                        start = end + 2
+                        if size < start + length + 2:
+                            break
+                        value = self.bulks[kind](view[start:start+length])
+                        pos = start + length + 2
+                elif kind in self.containers:
+                    end = find(b'\r\n', pos)
+                    if end == -1:
+                        break
+                    count = int(buf[pos+1:end])
+                    pos = end + 2
+                    if kind == 37: # '%' holds a key and a value per item
+                        count *= 2
+                    if count > 0:
+                        stack.append([kind, count, []])
+                        continue
+                    value = self.containers[kind]([])
+                elif kind in self.scalars:
+                    end = find(b'\r\n', pos)
+                    if end == -1:
+                        break
+                    value = self.scalars[kind](buf[pos+1:end])
+                    pos = end + 2
+                else:
+                    # inline command, terminated by a newline
+                    end = find(b'\n', pos)
+                    if end == -1:
+                        break
+                    value = bytes(buf[pos:end]).rstrip(b'\r\n')
+                    pos = end + 1
+
+                while stack:
+                    container = stack[-1]
+                    container[2].append(value)
+                    container[1] -= 1
+                    if container[1]:
+                        break
+                    stack.pop()
+                    value = self.containers[container[0]](container[2])
+                else:
+                    frames.append(value)
+                    last = pos
+
+        if last >= 0:
+            self.offset = self._consumed + last
+        if pos:
+            self._consumed += pos
+            del buf[:pos]
+        return frames
@@ -0,0 +1,213 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from fnmatch import fnmatchcase
+import logging
+import socket
+import threading
+
+import gevent
+from gevent.event import Event
+
+from protocol_handler import ProtocolHandler
+from exc import CommandError
+
+
+logger = logging.getLogger(__name__)
+
+# commands switching a connection to push mode, and the only ones allowed there
+PUBSUB_COMMANDS = frozenset((b'SUBSCRIBE', b'UNSUBSCRIBE', b'PSUBSCRIBE', b'PUNSUBSCRIBE'))
+
+
+def _match(pattern, channel):
+    if type(pattern) is not type(channel):
+        if isinstance(pattern, str):
+            pattern = pattern.encode('utf-8')
+        if isinstance(channel, str):
+            channel = channel.encode('utf-8')
+    return fnmatchcase(channel, pattern)
+
+
+class Subscriber(ABC):
+    """
+    A connection in push mode. `write` queues bytes for the client and never
+    blocks, a client letting more than `limit` bytes pile up is disconnected.
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.channels = set()
+        self.patterns = set()
+
+    @property
+    def count(self):
+        return len(self.channels) + len(self.patterns)
+
+    @abstractmethod
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class BufferedSubscriber(Subscriber):
+    # gevent and threads, a writer of its own drains the buffer so one slow
+    # client never holds up whoever publishes. Writes only ever come from one
+    # thread at a time, under the server lock, so the buffer is a deque and
+    # the bytes written and sent are counted separately by each side
+    def __init__(self, conn, limit=0, use_gevent=True):
+        super().__init__(limit)
+        self._conn = conn
+        self._use_gevent = use_gevent
+        self._wakeup = Event() if use_gevent else threading.Event()
+        self._chunks = deque()
+        self._written = 0
+        self._sent = 0
+        self._closing = False
+        self.closed = False
+        self._writer = None
+
+    def start(self):
+        if self._use_gevent:
+            self._writer = gevent.spawn(self._drain)
+        else:
+            self._writer = threading.Thread(target=self._drain, daemon=True)
+            self._writer.start()
+
+    def write(self, data):
+        if self.closed:
+            return
+        self._written += len(data)
+        if self.limit and self._written - self._sent > self.limit:
+            self._overflow()
+            return
+        chunks = self._chunks
+        chunks.append(data)
+        if len(chunks) == 1:
+            self._wakeup.set()
+
+    def _overflow(self):
+        logger.warning(f'Disconnecting subscriber over its {self.limit} bytes output buffer limit')
+        self.closed = True
+        self._wakeup.set()
+        try:
+            # wakes up the reader, which cleans up
+            self._conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _drain(self):
+        chunks = self._chunks
+        wakeup = self._wakeup
+        while not self.closed:
+            wakeup.clear()
+            if not chunks:
+                if self._closing:
+                    return
+                wakeup.wait()
+                continue
+            # everything queued so far goes out in one send
+            data = b''.join([chunks.popleft() for _ in range(len(chunks))])
+            try:
+                self._conn.sendall(data)
+            except OSError:
+                self.closed = True
+                return
+            self._sent += len(data)
+
+    def close(self):
+        """Stop the writer once what's buffered is sent."""
+        self._closing = True
+        self._wakeup.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+
+class PubSub:
+    """
+    Channels and patterns with their subscribers. A published message is
+    encoded once per channel or matching pattern and the same bytes written to
+    every subscriber.
+    """
+    def __init__(self):
+        self._protocol = ProtocolHandler()
+        # channel -> dict of subscribers, used as an ordered set
+        self._channels = {}
+        self._patterns = {}
+
+    def _encode(self, reply):
+        buf = bytearray()
+        self._protocol.encode(buf, reply)
+        return bytes(buf)
+
+    def execute(self, subscriber, command, *args):
+        """Run a pub/sub command for `subscriber`, its replies are written to it."""
+        if command == b'SUBSCRIBE':
+            replies = self._subscribe(subscriber, args, subscriber.channels,
+                                      self._channels, b'subscribe')
+        elif command == b'PSUBSCRIBE':
+            replies = self._subscribe(subscriber, args, subscriber.patterns,
+                                      self._patterns, b'psubscribe')
+        elif command == b'UNSUBSCRIBE':
+            replies = self._unsubscribe(subscriber, args, subscriber.channels,
+                                        self._channels, b'unsubscribe')
+        elif command == b'PUNSUBSCRIBE':
+            replies = self._unsubscribe(subscriber, args, subscriber.patterns,
+                                        self._patterns, b'punsubscribe')
+        else:
+            raise CommandError(f'Only (P)SUBSCRIBE / (P)UNSUBSCRIBE / QUIT '
+                               f'allowed while subscribed, got {command}')
+        for reply in replies:
+            subscriber.write(self._encode(reply))
+
+    def _subscribe(self, subscriber, names, own, registry, kind):
+        if not names:
+            raise CommandError('At least one channel is required')
+        replies = []
+        for name in names:
+            if name not in own:
+                own.add(name)
+                registry.setdefault(name, {})[subscriber] = None
+            replies.append([kind, name, subscriber.count])
+        return replies
+
+    def _unsubscribe(self, subscriber, names, own, registry, kind):
+        names = names or list(own)
+        if not names:
+            return [[kind, None, subscriber.count]]
+        replies = []
+        for name in names:
+            if name in own:
+                own.discard(name)
+                subscribers = registry[name]
+                del subscribers[subscriber]
+                if not subscribers:
+                    del registry[name]
+            replies.append([kind, name, subscriber.count])
+        return replies
+
+    def unsubscribe_all(self, subscriber):
+        for own, registry in ((subscriber.channels, self._channels),
+                              (subscriber.patterns, self._patterns)):
+            for name in own:
+                subscribers = registry[name]
+                del subscribers[subscriber]
+                if not subscribers:
+                    del registry[name]
+            own.clear()
+
+    def publish(self, channel, message):
+        n = 0
+        subscribers = self._channels.get(channel)
+        if subscribers:
+            data = self._encode([b'message', channel, message])
+            for subscriber in subscribers:
+                subscriber.write(data)
+            n += len(subscribers)
+        for pattern, subscribers in self._patterns.items():
+            if _match(pattern, channel):
+                data = self._encode([b'pmessage', pattern, channel, message])
+                for subscriber in subscribers:
+                    subscriber.write(data)
+                n += len(subscribers)
+        return n
@@ -0,0 +1,205 @@
+from collections import deque
+from itertools import chain, islice
+import sys
+
+
+# items per chunk, pushing to the front of a chunk moves at most this many
+CHUNK_SIZE = 128
+# items looked at to estimate the memory held by a list
+SIZE_SAMPLES = 8
+
+
+class QuickList:
+    """
+    A list kept as a deque of chunks, python lists of at most CHUNK_SIZE items.
+    Every chunk but the first and the last is full, so the chunk holding
+    position i is found arithmetically. Pushing and popping at either end is
+    O(1), a range costs O(offset / CHUNK_SIZE + count), the deque's own walk
+    to the chunk, and a trim only touches the chunks it drops.
+
+    The deque methods used by the list commands are supported with the same
+    semantics. `head` is the position of the first item counted from the
+    first one ever pushed, pushing and popping at the front moves it, so the
+    scans can resume from an item whatever happens at either end.
+    """
+    __slots__ = ('_chunks', '_len', 'head')
+
+    def __init__(self, items=()):
+        self._chunks = deque()
+        self._len = 0
+        self.head = 0
+        self.extend(items)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self) + sys.getsizeof(self._chunks)
+        size += len(self._chunks) * sys.getsizeof([]) + 8 * self._len
+        if self._len:
+            sample = list(islice(self, SIZE_SAMPLES))
+            size += sum(map(sys.getsizeof, sample)) * self._len // len(sample)
+        return size
+
+    def __repr__(self):
+        return f'QuickList({list(self)!r})'
+
+    def append(self, item):
+        chunks = self._chunks
+        if chunks and len(chunks[-1]) < CHUNK_SIZE:
+            chunks[-1].append(item)
+        else:
+            chunks.append([item])
+        self._len += 1
+
+    def appendleft(self, item):
+        chunks = self._chunks
+        if chunks and len(chunks[0]) < CHUNK_SIZE:
+            chunks[0].insert(0, item)
+        else:
+            chunks.appendleft([item])
+        self._len += 1
+        self.head -= 1
+
+    def extend(self, items):
+        items = list(items)
+        chunks = self._chunks
+        self._len += len(items)
+        start = 0
+        if chunks:
+            start = CHUNK_SIZE - len(chunks[-1])
+            chunks[-1].extend(items[:start])
+        for i in range(start, len(items), CHUNK_SIZE):
+            chunks.append(items[i:i + CHUNK_SIZE])
+
+    def extendleft(self, items):
+        # like deque.extendleft, the items end up in reverse order
+        items = list(items)
+        items.reverse()
+        chunks = self._chunks
+        self._len += len(items)
+        self.head -= len(items)
+        end = len(items)
+        if chunks:
+            room = min(CHUNK_SIZE - len(chunks[0]), end)
+            if room > 0:
+                chunks[0][0:0] = items[end - room:]
+                end -= room
+        while end > 0:
+            chunks.appendleft(items[max(end - CHUNK_SIZE, 0):end])
+            end -= CHUNK_SIZE
+
+    def pop(self):
+        chunks = self._chunks
+        if not chunks:
+            raise IndexError('pop from an empty list')
+        item = chunks[-1].pop()
+        if not chunks[-1]:
+            chunks.pop()
+        self._len -= 1
+        return item
+
+    def popleft(self):
+        chunks = self._chunks
+        if not chunks:
+            raise IndexError('pop from an empty list')
+        item = chunks[0].pop(0)
+        if not chunks[0]:
+            chunks.popleft()
+        self._len -= 1
+        self.head += 1
+        return item
+
+    def clear(self):
+        self._chunks.clear()
+        self.head += self._len
+        self._len = 0
+
+    def _locate(self, index):
+        # position of the chunk holding index, within bounds, and of the item in it
+        head = len(self._chunks[0])
+        if index < head:
+            return 0, index
+        i, j = divmod(index - head, CHUNK_SIZE)
+        return i + 1, j
+
+    def _position(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('list index out of range')
+        i, j = self._locate(index)
+        return self._chunks[i], j
+
+    def __getitem__(self, index):
+        chunk, j = self._position(index)
+        return chunk[j]
+
+    def __setitem__(self, index, item):
+        chunk, j = self._position(index)
+        chunk[j] = item
+
+    def remove(self, item):
+        """Remove the first occurrence of item, ValueError if there's none."""
+        chunks = self._chunks
+        for i, chunk in enumerate(chunks):
+            if item in chunk:
+                break
+        else:
+            raise ValueError('item not in list')
+        chunk.remove(item)
+        self._len -= 1
+        if i == 0 or i == len(chunks) - 1:
+            if not chunk:
+                del chunks[i]
+            return
+        # the chunks after it move up one item to fill it again, finding the
+        # item was O(n) already
+        for i in range(i, len(chunks) - 1):
+            chunks[i].append(chunks[i + 1].pop(0))
+        if not chunks[-1]:
+            chunks.pop()
+
+    def range(self, start=None, stop=None):
+        """The items in [start:stop], like slicing a list."""
+        start, stop, _ = slice(start, stop).indices(self._len)
+        if start >= stop:
+            return []
+        chunks = self._chunks
+        i, j = self._locate(start)
+        n = stop - start
+        accum = []
+        while n:
+            part = chunks[i][j:j + n]
+            accum += part
+            n -= len(part)
+            i += 1
+            j = 0
+        return accum
+
+    def trim(self, start=None, stop=None):
+        """Keep only the items in [start:stop], in place."""
+        start, stop, _ = slice(start, stop).indices(self._len)
+        if start >= stop:
+            self.clear()
+            return
+        chunks = self._chunks
+        n = self._len - stop
+        while n:
+            if len(chunks[-1]) <= n:
+                n -= len(chunks.pop())
+            else:
+                del chunks[-1][-n:]
+                n = 0
+        n = start
+        while n:
+            if len(chunks[0]) <= n:
+                n -= len(chunks.popleft())
+            else:
+                del chunks[0][:n]
+                n = 0
+        self.head += start
+        self._len = stop - start
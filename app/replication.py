@@ -0,0 +1,166 @@
+"""
+Primary/replica replication.
+
+A replica connects to the primary's client port and sends PSYNC with the
+replication id and offset it got to, ? and -1 the first time. The primary
+answers CONTINUE followed by whatever the replica missed if that's all still
+in its backlog, FULLRESYNC and a snapshot of the keyspace otherwise. From then
+on the connection carries the write commands applied on the primary, in the
+format of the append only file. Offsets count bytes of that stream.
+"""
+import logging
+import os
+import socket
+import time
+
+from const import Error
+from exc import CommandError
+from protocol_handler import ProtocolHandler, RequestParser
+
+
+logger = logging.getLogger(__name__)
+
+# seconds between attempts to reach the primary
+RECONNECT_INTERVAL = 1
+READ_SIZE = 2**16
+
+
+def new_replid():
+    return os.urandom(20).hex().encode('ascii')
+
+
+class Backlog:
+    """The last `size` bytes of the replication stream, `offset` counts all of it."""
+    def __init__(self, size):
+        self.size = size
+        self.offset = 0
+        self._buf = bytearray()
+
+    def append(self, data):
+        buf = self._buf
+        buf += data
+        self.offset += len(data)
+        if len(buf) > self.size:
+            del buf[:len(buf) - self.size]
+
+    def since(self, offset):
+        """The stream from `offset` on, None once part of it was dropped."""
+        start = self.offset - len(self._buf)
+        if isinstance(offset, bool) or not isinstance(offset, int) or not start <= offset <= self.offset:
+            return None
+        return bytes(self._buf[offset - start:])
+
+
+class Primary:
+    """
+    The replicas of this server, pubsub.Subscribers that get the stream. Writes
+    are only encoded, and the backlog kept, from the first replica on.
+    """
+    def __init__(self, backlog_size=2**20):
+        self.replid = new_replid()
+        self.backlog_size = backlog_size
+        self.backlog = None
+        # replica -> its address
+        self.replicas = {}
+        self.full_syncs = 0
+        self.partial_syncs = 0
+        self._protocol = ProtocolHandler()
+
+    @property
+    def offset(self):
+        return self.backlog.offset if self.backlog is not None else 0
+
+    def feed(self, args):
+        buf = bytearray()
+        self._protocol.encode(buf, args)
+        data = bytes(buf)
+        self.backlog.append(data)
+        for replica in self.replicas:
+            replica.write(data)
+
+    def attach(self, replica, address, replid, offset, snapshot):
+        """
+        Stream to `replica` from the offset it asked for or, failing that, from
+        the snapshot `snapshot()` returns as bytes. Returns True for the latter.
+        """
+        buf = bytearray()
+        missed = None
+        if self.backlog is not None and replid == self.replid:
+            missed = self.backlog.since(offset)
+        if missed is not None:
+            self._protocol.encode(buf, [b'CONTINUE', self.replid, offset])
+            buf += missed
+            self.partial_syncs += 1
+        else:
+            if self.backlog is None:
+                self.backlog = Backlog(self.backlog_size)
+            self._protocol.encode(buf, [b'FULLRESYNC', self.replid, self.offset, snapshot()])
+            self.full_syncs += 1
+        replica.write(bytes(buf))
+        self.replicas[replica] = address
+        return missed is None
+
+    def detach(self, replica):
+        self.replicas.pop(replica, None)
+
+
+class ReplicaLink:
+    """
+    Keeps this server a copy of the primary at `host`:`port`, reconnecting
+    whenever the connection drops. `load(snapshot)` replaces the keyspace
+    with a full snapshot, `apply(requests)` runs commands from the stream.
+    """
+    def __init__(self, host, port, load, apply):
+        self.host = host
+        self.port = port
+        self._load = load
+        self._apply = apply
+        self._protocol = ProtocolHandler()
+        self.replid = None
+        self.offset = -1
+        self.connected = False
+        self.full_syncs = 0
+
+    def run(self):
+        while True:
+            try:
+                self._sync()
+            except (OSError, EOFError, ValueError) as e:
+                logger.warning(f'Lost link to primary {self.host}:{self.port}. {e}')
+            except CommandError as e:
+                logger.error(f'Primary {self.host}:{self.port} refused to sync. {e.message}')
+            self.connected = False
+            time.sleep(RECONNECT_INTERVAL)
+
+    def _sync(self):
+        with socket.create_connection((self.host, self.port)) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            buf = bytearray()
+            self._protocol.encode(buf, [b'PSYNC', self.replid or b'?', self.offset])
+            sock.sendall(buf)
+            # the reply is read off a buffered file, the stream after it too
+            fh = sock.makefile('rb')
+            reply = self._protocol.handle_request(fh)
+            if isinstance(reply, Error):
+                raise CommandError(reply.message)
+            if not isinstance(reply, list) or not reply or reply[0] not in (b'FULLRESYNC', b'CONTINUE'):
+                raise ValueError(f'Unexpected reply to PSYNC {reply!r:.100}')
+            if reply[0] == b'FULLRESYNC':
+                _, self.replid, self.offset, data = reply
+                self._load(data)
+                self.full_syncs += 1
+                logger.info(f'Full resync from {self.host}:{self.port}, {len(data)} bytes')
+            else:
+                logger.info(f'Partial resync from {self.host}:{self.port} at offset {self.offset}')
+            self.connected = True
+            start = self.offset
+            parser = RequestParser()
+            while True:
+                data = fh.read1(READ_SIZE)
+                if not data:
+                    raise EOFError('primary closed the connection')
+                parser.feed(data)
+                requests = parser.parse()
+                if requests:
+                    self._apply(requests)
+                    self.offset = start + parser.offset
@@ -0,0 +1,305 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+import sys
+
+from exc import CommandError
+
+
+# entries looked at per call unless COUNT says otherwise
+DEFAULT_COUNT = 10
+# entries per chunk of a HashOrder, chunks are split at twice this
+LOAD = 1000
+# cursors of the hash ordered scans are hash values, 64 bit unsigned
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+def match(pattern, value):
+    return fnmatchcase(_text(value), _text(pattern))
+
+
+def _hash(key):
+    return hash(key) & HASH_MASK
+
+
+def _check_cursor(cursor):
+    if isinstance(cursor, bool) or not isinstance(cursor, int) or cursor < 0:
+        raise CommandError('Invalid cursor')
+
+
+class HashOrder:
+    """
+    The keys of a collection ordered by their hash, in a list of sorted
+    chunks of at most 2 * LOAD entries with the last hash of each in `_maxes`,
+    so the keys from any hash value on are a bisect away. The hashes of a
+    chunk are kept apart from its keys in an array, which bisects without
+    chasing pointers.
+
+    A scan's cursor is the hash to continue from, no state is kept between
+    calls. The order doesn't depend on what else is in the collection, so
+    keys present for the whole scan are returned exactly once whatever is
+    added or removed in between, and keys added or removed during it may or
+    may not be.
+    """
+    __slots__ = ('_hashes', '_keys', '_maxes')
+
+    def __init__(self, keys=()):
+        pairs = sorted(((_hash(key), key) for key in keys), key=lambda pair: pair[0])
+        self._hashes = [array('Q', [h for h, _ in pairs[i:i + LOAD]])
+                        for i in range(0, len(pairs), LOAD)]
+        self._keys = [[key for _, key in pairs[i:i + LOAD]] for i in range(0, len(pairs), LOAD)]
+        self._maxes = [chunk[-1] for chunk in self._hashes]
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self) + sys.getsizeof(self._maxes) * 3
+        # the hash and a pointer to the key
+        return size + sum(len(chunk) for chunk in self._hashes) * 16
+
+    def add(self, key):
+        h = _hash(key)
+        hashes, maxes = self._hashes, self._maxes
+        if not hashes:
+            hashes.append(array('Q', [h]))
+            self._keys.append([key])
+            maxes.append(h)
+            return
+        i = min(bisect_left(maxes, h), len(maxes) - 1)
+        chunk = hashes[i]
+        j = bisect_right(chunk, h)
+        chunk.insert(j, h)
+        self._keys[i].insert(j, key)
+        maxes[i] = chunk[-1]
+        if len(chunk) > 2 * LOAD:
+            hashes[i:i + 1] = [chunk[:LOAD], chunk[LOAD:]]
+            keys = self._keys[i]
+            self._keys[i:i + 1] = [keys[:LOAD], keys[LOAD:]]
+            maxes[i:i + 1] = [chunk[LOAD - 1], chunk[-1]]
+
+    def remove(self, key):
+        h = _hash(key)
+        hashes, maxes = self._hashes, self._maxes
+        # keys with the same hash may straddle chunks
+        i = bisect_left(maxes, h)
+        while i < len(hashes):
+            chunk = hashes[i]
+            j = bisect_left(chunk, h)
+            keys = self._keys[i]
+            while j < len(chunk) and chunk[j] == h:
+                if keys[j] == key:
+                    del chunk[j]
+                    del keys[j]
+                    if chunk:
+                        maxes[i] = chunk[-1]
+                    else:
+                        del hashes[i], self._keys[i], maxes[i]
+                    return
+                j += 1
+            if j < len(chunk):
+                return
+            i += 1
+
+    def clear(self):
+        self._hashes = []
+        self._keys = []
+        self._maxes = []
+
+    def walk(self, cursor, count):
+        """
+        At least `count` keys from the hash `cursor` on, all the ones sharing
+        the last hash included, and the cursor to continue from, 0 once done.
+        """
+        _check_cursor(cursor)
+        hashes, maxes = self._hashes, self._maxes
+        i = bisect_left(maxes, cursor)
+        if i == len(maxes):
+            return 0, []
+        j = bisect_left(hashes[i], cursor)
+        batch = []
+        last = None
+        while i < len(hashes):
+            chunk = hashes[i]
+            if len(batch) < count:
+                n = min(count - len(batch), len(chunk) - j)
+                batch += self._keys[i][j:j + n]
+                j += n
+                last = chunk[j - 1]
+            while j < len(chunk) and chunk[j] == last:
+                batch.append(self._keys[i][j])
+                j += 1
+            if j < len(chunk):
+                return (last + 1) & HASH_MASK, batch
+            i += 1
+            j = 0
+        return 0, batch
+
+
+class ScanDict(dict):
+    """A dict that keeps its keys in a HashOrder as well, for the scans."""
+    __slots__ = ('order',)
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.order = HashOrder(self)
+
+    def __sizeof__(self):
+        return dict.__sizeof__(self) + sys.getsizeof(self.order)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.order.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.order.remove(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        if key in self:
+            self.order.remove(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.order.remove(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+            return default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self.order.clear()
+
+
+class ScanSet(set):
+    """A set that keeps its members in a HashOrder as well, for the scans."""
+    __slots__ = ('order',)
+
+    def __init__(self, members=()):
+        super().__init__(members)
+        self.order = HashOrder(self)
+
+    def __sizeof__(self):
+        return set.__sizeof__(self) + sys.getsizeof(self.order)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def add(self, member):
+        if member not in self:
+            self.order.add(member)
+            set.add(self, member)
+
+    def remove(self, member):
+        set.remove(self, member)
+        self.order.remove(member)
+
+    def discard(self, member):
+        if member in self:
+            self.remove(member)
+
+    def pop(self):
+        member = set.pop(self)
+        self.order.remove(member)
+        return member
+
+    def update(self, *others):
+        for other in others:
+            for member in other:
+                self.add(member)
+
+    def difference_update(self, *others):
+        for other in others:
+            for member in other:
+                self.discard(member)
+
+    def intersection_update(self, *others):
+        keep = set(self).intersection(*others)
+        for member in set(self) - keep:
+            self.remove(member)
+
+    def symmetric_difference_update(self, other):
+        for member in set(other):
+            if member in self:
+                self.remove(member)
+            else:
+                self.add(member)
+
+    def clear(self):
+        set.clear(self)
+        self.order.clear()
+
+
+def walk(collection, cursor, count):
+    """
+    The next keys of `collection` in hash order from `cursor` and the cursor
+    to continue from, 0 once done. Compact encodings have no HashOrder of
+    their own, they are small enough to be sorted on each call.
+    """
+    order = getattr(collection, 'order', None)
+    if order is None:
+        _check_cursor(cursor)
+        order = HashOrder(collection)
+    return order.walk(cursor, count)
+
+
+def _position(cursor):
+    # positions go negative once items are pushed at the front, cursors
+    # interleave them with the positive ones
+    _check_cursor(cursor)
+    return (cursor - 1) // 2 if cursor & 1 else -(cursor // 2)
+
+
+def _list_cursor(position):
+    return 2 * position + 1 if position >= 0 else -2 * position
+
+
+def walk_list(items, cursor, count):
+    """
+    The next `count` items of QuickList `items` and the cursor to continue
+    from, 0 once done. Cursors are positions counted from the list's first
+    item ever, pushing and popping at either end doesn't move the others.
+    """
+    if cursor:
+        start = max(_position(cursor) - items.head, 0)
+    else:
+        _check_cursor(cursor)
+        start = 0
+    stop = start + count
+    batch = items.range(start, stop)
+    if stop >= len(items):
+        return 0, batch
+    return _list_cursor(stop + items.head), batch
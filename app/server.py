@@ -1,73 +1,441 @@
+from contextlib import nullcontext
 import logging
 from optparse import OptionParser
+import select
+import socket
 import sys
+import threading
+import time
+import gevent
+from gevent.event import Event
 from gevent.pool import Pool
 from gevent.server import StreamServer
 
-from protocol_handler import ProtocolHandler
-from command_handler import CommandHandler
-from exc import CommandError, ClientQuit, Shutdown
+from protocol_handler import ProtocolHandler, RequestParser
+from command_handler import CommandHandler, Waiter
+from eviction import POLICIES, NOEVICTION, parse_size
+from aof import AppendOnlyFile, FSYNC_POLICIES, FSYNC_EVERYSEC
+from exc import CommandError, ClientQuit, Shutdown, Subscribed, Replicate
+from pubsub import BufferedSubscriber, PUBSUB_COMMANDS
+from replication import ReplicaLink
 from const import Error
 from thread_server import ThreadedStreamServer
+from asyncio_server import AsyncioStreamServer
+from shard import ShardRouter, run_workers
 
 
 logger = logging.getLogger(__name__)
 
+# seconds between checks that a client blocked on an empty list is still there
+BLOCK_CHECK_INTERVAL = 1
+
 class QueueServer:
-    def __init__(self, host='0.0.0.0', port=8888, max_clients=2**10, use_gevent=True):
+    def __init__(self, host='0.0.0.0', port=8888, max_clients=2**10, use_gevent=True,
+                 read_size=2**16, hz=10, expire_budget=0.025, maxmemory=0,
+                 maxmemory_policy=NOEVICTION, maxmemory_samples=5, appendonly=None,
+                 appendfsync=FSYNC_EVERYSEC, aof_rewrite_min_size=64 * 2**20,
+                 aof_rewrite_percentage=100, snapshot_compression=False,
+                 listener=None, shard=0, peers=None, peer_listener=None,
+                 use_asyncio=False, backlog=128, pubsub_buffer_limit=32 * 2**20,
+                 hash_max_entries=128, hash_max_value=64, set_max_entries=128,
+                 set_max_value=64, set_max_intset_entries=512,
+                 slowlog_log_slower_than=10000, slowlog_max_len=128, replicaof=None,
+                 repl_backlog_size=2**20, replica_buffer_limit=256 * 2**20,
+                 tracking_table_max_keys=10**6):
         self._host = host
         self._port = port
         self._max_clients = max_clients
+        self._read_size = read_size
+        self._use_gevent = use_gevent and not use_asyncio
+        self._use_asyncio = use_asyncio
+        # background tasks run `hz` times a second, active expiry may use up to
+        # `expire_budget` seconds of each run
+        self._hz = hz
+        self._expire_budget = expire_budget
+        # bytes a subscriber or a replica may fall behind by before it is
+        # disconnected, a replica then resyncs
+        self.pubsub_buffer_limit = pubsub_buffer_limit
+        self.replica_buffer_limit = replica_buffer_limit
 
-        if use_gevent:
+        # an already bound socket is passed in when running as a worker
+        address = listener if listener is not None else (self._host, self._port)
+        if use_asyncio:
+            self._server = AsyncioStreamServer(address, self, backlog=backlog)
+        elif use_gevent:
             self._pool = Pool(self._max_clients)
-            self._server = StreamServer((self._host, self._port),
-                                        self.connection_handler,
-                                        spawn=self._pool)
+            self._server = StreamServer(address,
+                                        self.client_handler,
+                                        spawn=self._pool,
+                                        backlog=None if listener is not None else backlog)
         else:
-            self._server = ThreadedStreamServer((self._host, self._port),
-                                                self.connection_handler)
+            self._server = ThreadedStreamServer(address,
+                                                self.client_handler,
+                                                max_workers=self._max_clients,
+                                                backlog=backlog)
+        # CommandHandler isn't thread safe, with real threads commands and
+        # background tasks run one at a time under this lock
+        self._lock = nullcontext() if use_gevent or use_asyncio else threading.Lock()
         
         self._protocol = ProtocolHandler()
-        self._commands = CommandHandler()
+        self._aof = None
+        if appendonly:
+            self._aof = AppendOnlyFile(appendonly, fsync=appendfsync,
+                                       rewrite_min_size=aof_rewrite_min_size,
+                                       rewrite_percentage=aof_rewrite_percentage)
+        self._commands = CommandHandler(maxmemory=maxmemory,
+                                        maxmemory_policy=maxmemory_policy,
+                                        maxmemory_samples=maxmemory_samples,
+                                        aof=self._aof,
+                                        snapshot_compression=snapshot_compression,
+                                        hash_max_entries=hash_max_entries,
+                                        hash_max_value=hash_max_value,
+                                        set_max_entries=set_max_entries,
+                                        set_max_value=set_max_value,
+                                        set_max_intset_entries=set_max_intset_entries,
+                                        slowlog_log_slower_than=slowlog_log_slower_than,
+                                        slowlog_max_len=slowlog_max_len,
+                                        repl_backlog_size=repl_backlog_size,
+                                        tracking_table_max_keys=tracking_table_max_keys)
+        # PROFILE samples the whole of a request's handling, from parsing to
+        # encoding its reply
+        self._commands.profiler.add_scope(self.execute_request, self.route_requests,
+                                          self.encode_result)
+        if self._aof is not None:
+            start = time.monotonic()
+            n = self._commands.load_aof()
+            logger.info(f'Replayed {n} commands from {appendonly} in '
+                        f'{time.monotonic() - start:.3f}s')
+        
+        # with several workers each one owns a shard of the keyspace, commands
+        # for other shards are forwarded to their worker's peer listener
+        self._router = None
+        self._peer_server = None
+        if peers:
+            self._router = ShardRouter(shard, peers, self._commands)
+            self._peer_server = StreamServer(peer_listener, self.peer_handler,
+                                             spawn=Pool(self._max_clients))
+        
+        # a replica takes writes from its primary only, replicaof is its
+        # (host, port). With asyncio the link runs in a thread and hands what
+        # it receives over to the event loop
+        self._replica_link = None
+        if replicaof is not None:
+            load, apply = self.sync_replica, self.apply_replicated
+            if use_asyncio:
+                load, apply = self._server.threadsafe(load), self._server.threadsafe(apply)
+            self._replica_link = ReplicaLink(*replicaof, load, apply)
+            self._commands.replica_link = self._replica_link
+            self._commands.read_only = True
+    
+    def client_handler(self, conn, address):
+        # peers forwarding commands between workers aren't counted as clients
+        self.client_connected()
+        try:
+            self.connection_handler(conn, address)
+        finally:
+            self.client_disconnected(f'{address[0]}:{address[1]}'.encode('utf-8'))
+    
+    def client_connected(self):
+        with self._lock:
+            self._commands.stats.connected()
+    
+    def client_disconnected(self, client):
+        with self._lock:
+            self._commands.stats.disconnected()
+            self._commands.tracking.disable(client)
     
-    def connection_handler(self, conn, address):
+    def peer_handler(self, conn, address):
+        self.connection_handler(conn, address, local=True)
+    
+    def connection_handler(self, conn, address, local=False):
         logger.info(f'Request received on address {address[0]}:{address[1]}')
-        # converting socket into file like objects, ease of use, can read/write by line
-        # without multiple recv or send calls 
-        socket_file = conn.makefile('rwb')
+        route = self._router is not None and not local
+        client = f'{address[0]}:{address[1]}'.encode('utf-8')
+        # requests are parsed straight from what recv returns and the replies of
+        # a whole batch are encoded into one reusable buffer and sent together
+        parser = RequestParser()
+        out = bytearray()
         while True:
             try:
-                self.request_response(socket_file)
+                data = conn.recv(self._read_size)
+                if not data:
+                    raise EOFError()
+                try:
+                    self.handle_data(parser, data, out, route, conn, client)
+                except Subscribed as e:
+                    self.subscribed(conn, parser, e.requests, out, route, client)
+                except Replicate as e:
+                    conn.sendall(out)
+                    self.serve_replica(conn, client, e)
+                    break
+                conn.sendall(out)
+                del out[:]
             except EOFError:
                 logger.info(f"Finished reading request at {address[0]}:{address[1]}")
-                socket_file.close()
+                conn.close()
                 break
             except ClientQuit:
                 logger.info(f"Client exited: {address[0]}:{address[1]}")
+                conn.sendall(out)
                 break
+            except Shutdown:
+                self.shutdown()
+                conn.sendall(out)
+                raise KeyboardInterrupt
             except Exception as e:
                 logger.error(f"Error processing request. {str(e)}")
     
-    def request_response(self, socket_file):
-        data = self._protocol.handle_request(socket_file)
+    def handle_data(self, parser, data, out, route=False, conn=None, client=None):
+        parser.feed(data)
+        # pipelining: answer every complete request received so far
+        return self.handle_requests(parser.parse(), out, route, conn, client)
+    
+    def handle_requests(self, requests, out, route=False, conn=None, client=None):
+        """
+        Execute `requests`, encoding the replies into `out`. A blocking command
+        with nothing to pop is waited on right here with gevent and threads,
+        with asyncio the Waiter and the requests after it are returned instead.
+        """
+        with self._lock:
+            try:
+                # for the slow log, again for every request as another
+                # client's may have run while this one was blocked
+                self._commands.client = client
+                if route:
+                    self.route_requests(requests, out, conn)
+                else:
+                    for i, request in enumerate(requests):
+                        self._commands.client = client
+                        resp = self.execute_request(request)
+                        if isinstance(resp, Subscribed):
+                            raise Subscribed(requests[i:])
+                        if isinstance(resp, Replicate):
+                            raise resp
+                        if isinstance(resp, Waiter):
+                            if self._use_asyncio:
+                                return resp, requests[i + 1:]
+                            resp = self.wait(resp, out, conn)
+                        self.encode_result(resp, out)
+            finally:
+                self.commit()
+    
+    def subscribed(self, conn, parser, requests, out, route=False, client=None):
+        # push mode until every subscription is dropped, the requests after
+        # that run as usual and may subscribe again
+        while True:
+            conn.sendall(out)
+            del out[:]
+            requests = self.push_mode(conn, parser, requests)
+            try:
+                return self.handle_requests(requests, out, route, conn, client)
+            except Subscribed as e:
+                requests = e.requests
+    
+    def push_mode(self, conn, parser, requests):
+        """
+        Serve a subscribed connection until it has no subscriptions left.
+        Replies and messages all go through the subscriber's output buffer,
+        returns the requests received after the last unsubscribe.
+        """
+        subscriber = BufferedSubscriber(conn, self.pubsub_buffer_limit, self._use_gevent)
+        subscriber.start()
+        try:
+            while True:
+                rest = self.handle_pubsub(subscriber, requests)
+                if rest is not None:
+                    return rest
+                data = conn.recv(self._read_size)
+                if not data:
+                    raise EOFError()
+                parser.feed(data)
+                requests = parser.parse()
+        finally:
+            self.unsubscribe_all(subscriber)
+            subscriber.close()
+    
+    def handle_pubsub(self, subscriber, requests):
+        """
+        Run the requests of a connection in push mode. Returns the requests
+        after the one dropping its last subscription, None while it has some.
+        """
+        with self._lock:
+            for i, data in enumerate(requests):
+                try:
+                    command, args = self.parse_request(data)
+                    if command == b'QUIT':
+                        subscriber.write(self.encode(1))
+                        raise ClientQuit('client closed connection')
+                    self._commands.pubsub.execute(subscriber, command, *args)
+                except CommandError as e:
+                    subscriber.write(self.encode(Error(e.message)))
+                if not subscriber.count:
+                    return requests[i + 1:]
+    
+    def unsubscribe_all(self, subscriber):
+        with self._lock:
+            self._commands.pubsub.unsubscribe_all(subscriber)
+    
+    def serve_replica(self, conn, client, request):
+        # the replica sends nothing after PSYNC, its connection is read from
+        # only to notice it going away
+        replica = BufferedSubscriber(conn, self.replica_buffer_limit, self._use_gevent)
+        replica.start()
+        try:
+            self.attach_replica(replica, client, request)
+            while conn.recv(self._read_size):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.detach_replica(replica)
+            replica.close()
+            conn.close()
+    
+    def attach_replica(self, replica, client, request):
+        with self._lock:
+            full = self._commands.attach_replica(replica, client, request.replid, request.offset)
+        logger.info(f'Replica {client.decode("utf-8")} attached, '
+                    f'{"full" if full else "partial"} resync')
+    
+    def detach_replica(self, replica):
+        with self._lock:
+            self._commands.detach_replica(replica)
+    
+    def sync_replica(self, data):
+        with self._lock:
+            try:
+                self._commands.sync_from(data)
+            finally:
+                self.commit()
+    
+    def apply_replicated(self, requests):
+        with self._lock:
+            try:
+                for request in requests:
+                    try:
+                        self._commands.apply(request[0].upper(), *request[1:])
+                    except CommandError as e:
+                        logger.warning(f'Error applying {request[0]} from the primary: {e.message}')
+            finally:
+                self.commit()
+    
+    def encode(self, resp):
+        buf = bytearray()
+        self._protocol.encode(buf, resp)
+        return bytes(buf)
+    
+    def resume_requests(self, waiter, requests, out, client=None):
+        # asyncio, once the waiter was served or timed out
+        self.encode_result(self.finish_wait(waiter), out)
+        return self.handle_requests(requests, out, client=client)
+    
+    def finish_wait(self, waiter):
+        with self._lock:
+            return self._commands.finish_wait(waiter)
+    
+    def wait(self, waiter, out, conn=None):
+        # called holding the lock, it is released while blocked so other
+        # clients can push to the lists
+        self.commit()
+        event = Event() if self._use_gevent else threading.Event()
+        waiter.notify = event.set
+        if conn is not None:
+            # a client gone while blocked mustn't take an item with it
+            waiter.alive = lambda: not self.disconnected(conn)
+        threaded = not self._use_gevent
+        if threaded:
+            self._lock.release()
         try:
-            resp = self.respond(data)
-        except Shutdown:
-            logger.info('Shutting down')
-            self._protocol.write_response(socket_file, 1)
-            raise KeyboardInterrupt
-        except ClientQuit:
-            self._protocol.write_response(socket_file, 1)
-            raise
-        except CommandError as e:
-            resp = Error(e.message)
+            if conn is not None and out:
+                conn.sendall(out)
+                del out[:]
+            deadline = time.monotonic() + waiter.timeout if waiter.timeout else None
+            while True:
+                interval = BLOCK_CHECK_INTERVAL
+                if deadline is not None:
+                    interval = min(interval, max(deadline - time.monotonic(), 0))
+                if event.wait(interval):
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                if conn is not None and self.disconnected(conn):
+                    break
+        finally:
+            if threaded:
+                self._lock.acquire()
+            result = self._commands.finish_wait(waiter)
+        return result
+    
+    def disconnected(self, conn):
+        readable, _, _ = select.select([conn], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not conn.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+    
+    def shutdown(self):
+        logger.info('Shutting down')
+        if self._aof is not None:
+            with self._lock:
+                self._aof.close()
+    
+    def commit(self):
+        # group commit, the writes of a batch are logged before any of its
+        # replies go out
+        if self._aof is not None:
+            self._aof.flush()
+    
+    def execute_request(self, data):
+        try:
+            return self.respond(data)
         except Exception as e:
-            logger.exception(f'Unhandled error {str(e)}')
+            return e
+    
+    def encode_result(self, resp, out):
+        if isinstance(resp, (Shutdown, ClientQuit)):
+            self._protocol.encode(out, 1)
+            raise resp
+        if isinstance(resp, CommandError):
+            resp = Error(resp.message)
+        elif isinstance(resp, Exception):
+            logger.error(f'Unhandled error {str(resp)}', exc_info=resp)
             resp = Error('Unhandled server error')
-        self._protocol.write_response(socket_file, resp)
+        self._protocol.encode(out, resp)
+    
+    def route_requests(self, requests, out, conn=None):
+        commands = []
+        subscribe = None
+        for i, data in enumerate(requests):
+            try:
+                command = self.parse_request(data)
+            except CommandError as e:
+                command = e
+            else:
+                if command[0] in PUBSUB_COMMANDS:
+                    # subscriptions are local to this worker
+                    subscribe = requests[i:]
+                    break
+            commands.append(command)
+        for resp in self._router.execute_many(commands):
+            if isinstance(resp, Waiter):
+                resp = self.wait(resp, out, conn)
+            self.encode_result(resp, out)
+        if subscribe is not None:
+            raise Subscribed(subscribe)
     
     def respond(self, data):
+        command, args = self.parse_request(data)
+        if command in PUBSUB_COMMANDS:
+            raise Subscribed([data])
+        if command == b'PSYNC':
+            if len(args) != 2:
+                raise CommandError('PSYNC takes a replication id and an offset')
+            raise Replicate(*args)
+        return self._commands.execute(command, *args)
+    
+    def parse_request(self, data):
         if not isinstance(data, list):
             try:
                 data = data.split()
@@ -78,13 +446,70 @@ class QueueServer:
             raise CommandError('First parameter must be a command name')
         
         command = data[0].upper()
-        try:
-            logger.debug(f"Receieved {command.decode('utf-8')}")
-            return self._commands.handle(command)(*data[1:])
-        except KeyError:
-            raise CommandError(f'Unrecogonized command: {command}')
+        logger.debug(f"Receieved {command.decode('utf-8')}")
+        return command, data[1:]
+    
+    def cron(self):
+        with self._lock:
+            self._cron()
+    
+    def _cron(self):
+        self._commands.stats.sample()
+        n = self._commands.clean_expired(budget=self._expire_budget)
+        if n:
+            logger.debug(f'Expired {n} keys')
+        
+        saved = self._commands.check_background()
+        if saved is not None:
+            if saved:
+                logger.info('Background save finished')
+            else:
+                logger.error('Background save failed')
+        
+        if self._aof is not None:
+            rewritten = self._aof.cron()
+            if rewritten is not None:
+                if rewritten:
+                    logger.info('Append only file rewrite finished')
+                else:
+                    logger.error('Append only file rewrite failed')
+            if self._commands.check_aof_rewrite():
+                logger.info('Append only file rewrite started')
+    
+    def start_periodic(self, func, interval):
+        if self._use_asyncio:
+            return self._server.call_periodic(func, interval)
+        sleep = gevent.sleep if self._use_gevent else time.sleep
+        def loop():
+            while True:
+                sleep(interval)
+                try:
+                    func()
+                except Exception as e:
+                    logger.exception(f'Error running {func.__name__}. {str(e)}')
+        
+        if self._use_gevent:
+            return gevent.spawn(loop)
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+    
+    def start_background(self, func):
+        if self._use_asyncio:
+            return self._server.call_in_thread(func)
+        if self._use_gevent:
+            return gevent.spawn(func)
+        thread = threading.Thread(target=func, daemon=True)
+        thread.start()
+        return thread
     
     def run(self):
+        if self._hz > 0:
+            self.start_periodic(self.cron, 1. / self._hz)
+        if self._replica_link is not None:
+            self.start_background(self._replica_link.run)
+        if self._peer_server is not None:
+            self._peer_server.start()
         self._server.serve_forever()
                 
         
@@ -101,28 +526,88 @@ def get_option_parse() -> OptionParser:
                       help='Log error messages only.')
     parser.add_option('-m', '--max-clients', default=1024, dest='max_clients',
                       help='Maximum number of clients.', type=int)
+    parser.add_option('-b', '--backlog', default=128, dest='backlog', type=int,
+                      help='Connections waiting to be accepted.')
     parser.add_option('-t', '--use-threads', action='store_false', default=True, dest='use_gevent',
                       help='Use threads instead of gevent.')
+    parser.add_option('-a', '--use-asyncio', action='store_true', default=False,
+                      dest='use_asyncio', help='Use asyncio instead of gevent.')
     parser.add_option('-l', '--log-file', dest='log_file', help='Log file.')
+    parser.add_option('-z', '--hz', default=10, dest='hz', type=int,
+                      help='Background tasks (active expiry, BGSAVE, append only file) run per second.')
+    parser.add_option('--expire-budget', default=25, dest='expire_budget', type=int,
+                      help='Milliseconds active expiry may take per run.')
+    parser.add_option('--maxmemory', default='0', dest='maxmemory',
+                      help='Memory limit for the keyspace, e.g. 512mb. 0 for no limit.')
+    parser.add_option('--maxmemory-policy', default=NOEVICTION, dest='maxmemory_policy',
+                      type='choice', choices=POLICIES,
+                      help='What to evict once maxmemory is reached.')
+    parser.add_option('--maxmemory-samples', default=5, dest='maxmemory_samples', type=int,
+                      help='Keys sampled per eviction.')
+    parser.add_option('--appendonly', dest='appendonly',
+                      help='Log writes to this append only file, replayed on startup.')
+    parser.add_option('--appendfsync', default=FSYNC_EVERYSEC, dest='appendfsync',
+                      type='choice', choices=FSYNC_POLICIES,
+                      help='When to fsync the append only file.')
+    parser.add_option('--auto-aof-rewrite-min-size', default='64mb',
+                      dest='aof_rewrite_min_size',
+                      help='Size the append only file has to reach before it is rewritten.')
+    parser.add_option('--auto-aof-rewrite-percentage', default=100, type=int,
+                      dest='aof_rewrite_percentage',
+                      help='Growth since the last rewrite that triggers a rewrite, 0 to disable.')
+    parser.add_option('--snapshot-compression', action='store_true', default=False,
+                      dest='snapshot_compression', help='Compress snapshots with zlib.')
+    parser.add_option('--pubsub-buffer-limit', default='32mb', dest='pubsub_buffer_limit',
+                      help='Output a subscriber may fall behind by before it is disconnected, 0 for no limit.')
+    parser.add_option('--hash-max-entries', default=128, dest='hash_max_entries', type=int,
+                      help='Largest hash kept in the compact encoding, 0 to disable it.')
+    parser.add_option('--hash-max-value', default=64, dest='hash_max_value', type=int,
+                      help='Longest field or value, in bytes, of a compactly encoded hash.')
+    parser.add_option('--set-max-entries', default=128, dest='set_max_entries', type=int,
+                      help='Largest set kept in the compact encoding, 0 to disable it.')
+    parser.add_option('--set-max-value', default=64, dest='set_max_value', type=int,
+                      help='Longest member, in bytes, of a compactly encoded set.')
+    parser.add_option('--set-max-intset-entries', default=512, dest='set_max_intset_entries',
+                      type=int, help='Largest set of integers kept as an array, 0 to disable it.')
+    parser.add_option('--slowlog-log-slower-than', default=10000, dest='slowlog_log_slower_than',
+                      type=int, help='Microseconds a command has to take to be in the slow log, '
+                                     '0 logs every command, a negative value none.')
+    parser.add_option('--slowlog-max-len', default=128, dest='slowlog_max_len', type=int,
+                      help='Commands kept in the slow log.')
+    parser.add_option('--tracking-table-max-keys', default=10**6, dest='tracking_table_max_keys',
+                      type=int, help='Keys tracked for client side caching, the oldest are '
+                                     'invalidated past that, a negative value tracks any number.')
+    parser.add_option('--replicaof', dest='replicaof',
+                      help='Replicate the primary at this host:port, serving reads only.')
+    parser.add_option('--repl-backlog-size', default='1mb', dest='repl_backlog_size',
+                      help='Writes kept for replicas to resync from after a disconnect.')
+    parser.add_option('--replica-buffer-limit', default='256mb', dest='replica_buffer_limit',
+                      help='Output a replica may fall behind by before it is disconnected, 0 for no limit.')
+    parser.add_option('-w', '--workers', default=1, dest='workers', type=int,
+                      help='Worker processes, the keyspace is partitioned across them.')
     
     return parser
 
 def configure_logger(options: OptionParser):
-    logger.addHandler(logging.StreamHandler())
+    # configured on the root logger so the other modules log the same way
+    root = logging.getLogger()
+    root.addHandler(logging.StreamHandler())
     if options.log_file:
-        logger.addHandler(logging.FileHandler(options.log_file))
+        root.addHandler(logging.FileHandler(options.log_file))
     if options.debug:
-        logger.setLevel(logging.DEBUG)
+        root.setLevel(logging.DEBUG)
     elif options.error:
-        logger.setLevel(logging.ERROR)
+        root.setLevel(logging.ERROR)
     else:
-        logger.setLevel(logging.INFO)
+        root.setLevel(logging.INFO)
     
 
 if __name__ == "__main__":
     options, args = get_option_parse().parse_args()
     try:
-        from gevent import monkey; monkey.patch_all()
+        # asyncio and threads run on the unpatched stdlib
+        if options.use_gevent and not options.use_asyncio:
+            from gevent import monkey; monkey.patch_all()
     except Exception:
         logger.error("Error applying monkey patch for gevent")
         sys.stderr.write("Error applying monkey patch for gevent")
@@ -130,9 +615,54 @@ if __name__ == "__main__":
         sys.exit(1)
     
     configure_logger(options)
-    server = QueueServer(host=options.host, port=options.port,
-                         max_clients=options.max_clients,
-                         use_gevent=options.use_gevent)
+    if options.workers > 1 and (options.use_asyncio or not options.use_gevent):
+        sys.stderr.write('Multiple workers are only supported with gevent\n')
+        sys.exit(1)
+    replicaof = None
+    if options.replicaof:
+        if options.workers > 1:
+            sys.stderr.write('Replication is only supported with a single worker\n')
+            sys.exit(1)
+        host, _, port = options.replicaof.rpartition(':')
+        if not host or not port.isdigit():
+            sys.stderr.write('--replicaof takes host:port\n')
+            sys.exit(1)
+        replicaof = (host, int(port))
+    
+    def make_server(**kwargs):
+        return QueueServer(host=options.host, port=options.port,
+                           max_clients=options.max_clients,
+                           use_gevent=options.use_gevent,
+                           use_asyncio=options.use_asyncio,
+                           backlog=options.backlog,
+                           hz=options.hz,
+                           expire_budget=options.expire_budget / 1000.,
+                           maxmemory=parse_size(options.maxmemory),
+                           maxmemory_policy=options.maxmemory_policy,
+                           maxmemory_samples=options.maxmemory_samples,
+                           appendfsync=options.appendfsync,
+                           aof_rewrite_min_size=parse_size(options.aof_rewrite_min_size),
+                           aof_rewrite_percentage=options.aof_rewrite_percentage,
+                           snapshot_compression=options.snapshot_compression,
+                           pubsub_buffer_limit=parse_size(options.pubsub_buffer_limit),
+                           hash_max_entries=options.hash_max_entries,
+                           hash_max_value=options.hash_max_value,
+                           set_max_entries=options.set_max_entries,
+                           set_max_value=options.set_max_value,
+                           set_max_intset_entries=options.set_max_intset_entries,
+                           slowlog_log_slower_than=options.slowlog_log_slower_than,
+                           slowlog_max_len=options.slowlog_max_len,
+                           repl_backlog_size=parse_size(options.repl_backlog_size),
+                           replica_buffer_limit=parse_size(options.replica_buffer_limit),
+                           tracking_table_max_keys=options.tracking_table_max_keys,
+                           **kwargs)
+    
+    def serve_shard(shard, listener, peers, peer_listener):
+        # every worker keeps its own append only file
+        appendonly = f'{options.appendonly}.{shard}' if options.appendonly else None
+        make_server(appendonly=appendonly, listener=listener, shard=shard,
+                    peers=peers, peer_listener=peer_listener).run()
+    
     print('\x1b[32m  / \\__')
     print(' \x1b[32m (    @\\____', 
           '\x1b[1;32mMiniRedis '
@@ -141,7 +671,11 @@ if __name__ == "__main__":
     print(' \x1b[32m/   (_____ /')
     print(' \x1b[32m\\_____/   U')
     try:
-        server.run()
+        if options.workers > 1:
+            run_workers(options.workers, options.host, options.port, serve_shard,
+                        backlog=options.backlog)
+        else:
+            make_server(appendonly=options.appendonly, replicaof=replicaof).run()
     except KeyboardInterrupt:
         print('\x1b[1;31mshutting down\x1b[0m')
 
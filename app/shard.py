@@ -0,0 +1,442 @@
+import logging
+import os
+import signal
+import socket
+from zlib import crc32
+
+import gevent
+
+from client import Client
+from command_handler import BLOCKING_COMMANDS, KEYLESS_COMMANDS, command_keys
+from exc import CommandError, ClientQuit, Shutdown
+
+
+logger = logging.getLogger(__name__)
+
+
+def key_shard(key, shards):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return crc32(key) % shards
+
+
+def _error(e):
+    message = e.message
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    return CommandError(message)
+
+
+class ShardRouter:
+    """
+    Routes commands to the worker owning their keys when the keyspace is
+    partitioned across worker processes.
+
+    Commands whose keys all live on one shard are sent there as they are, so
+    they keep their exact semantics. Multi-key commands spanning shards are
+    split into per shard commands and their replies merged, those are not
+    atomic. Keyless commands like LEN and FLUSHALL run on every shard.
+    """
+    def __init__(self, shard, peers, commands):
+        self.shard = shard
+        self.shards = len(peers)
+        self._commands = commands
+        self._peers = [None if i == shard else Client(host, port)
+                       for i, (host, port) in enumerate(peers)]
+        self._scatter = {
+            b'MGET': self.mget,
+            b'MPOP': self.mpop,
+            b'MDELETE': self.mdelete,
+            b'MSET': self.mset,
+            b'MSETEX': self.msetex,
+            b'SDIFF': self.sdiff,
+            b'SINTER': self.sinter,
+            b'SUNION': self.sunion,
+            b'SDIFFSTORE': self.sdiffstore,
+            b'SINTERSTORE': self.sinterstore,
+            b'SUNIONSTORE': self.sunionstore,
+            b'RPOPLPUSH': self.rpoplpush,
+        }
+        self._keyless = {
+            b'LEN': self._sum,
+            b'FLUSH': self._sum,
+            b'FLUSHALL': self._all,
+            b'SAVE': self._all,
+            b'RESTORE': self._all,
+            b'MERGE': self._all,
+            b'BGSAVE': self._first,
+            b'BGREWRITEAOF': self._first,
+            b'LASTSAVE': min,
+            b'SAVESTATUS': list,
+            b'PUBLISH': self._sum,
+            b'INFO': list,
+            b'CONFIG': self._all,
+            b'SLOWLOG': list,
+            b'PROFILE': list,
+        }
+
+    def owner(self, command, args):
+        """The shard a command should run on, None if it spans shards."""
+        if command in KEYLESS_COMMANDS:
+            return None
+        keys = command_keys(command, args)
+        if not keys:
+            return self.shard
+        shard = key_shard(keys[0], self.shards)
+        for key in keys[1:]:
+            if key_shard(key, self.shards) != shard:
+                return None
+        return shard
+
+    def _remote(self, shard, commands):
+        pipe = self._peers[shard].pipeline()
+        for command in commands:
+            pipe.execute(*command)
+        try:
+            replies = pipe.send()
+        except Exception:
+            logger.exception(f'Error forwarding to shard {shard}')
+            error = CommandError(f'Shard {shard} unavailable')
+            return [error] * len(commands)
+        return [_error(r) if isinstance(r, CommandError) else r for r in replies]
+
+    def _local(self, commands):
+        replies = []
+        for command, *args in commands:
+            try:
+                replies.append(self._commands.execute(command, *args))
+            except Exception as e:
+                replies.append(e)
+        return replies
+
+    def run(self, jobs):
+        """
+        Run `jobs`, a dict of shard to a list of commands, on their shards
+        concurrently and return a dict of shard to the list of replies.
+        """
+        greenlets = {shard: gevent.spawn(self._remote, shard, commands)
+                     for shard, commands in jobs.items() if shard != self.shard}
+        results = {}
+        if self.shard in jobs:
+            results[self.shard] = self._local(jobs[self.shard])
+        gevent.joinall(list(greenlets.values()))
+        for shard, greenlet in greenlets.items():
+            results[shard] = greenlet.value
+        return results
+
+    def call(self, shard, command, *args):
+        reply, = self.run({shard: [(command, *args)]})[shard]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def execute_many(self, requests):
+        """
+        Execute a batch of (command, args) received on one connection. Runs of
+        commands each owned by a single shard are sent to their shards in one
+        go, commands spanning shards are run on their own in between. Returns
+        the replies in order, failed commands as their exception.
+        """
+        results = [None] * len(requests)
+        jobs = {}
+        positions = {}
+
+        def flush():
+            for shard, replies in self.run(jobs).items():
+                for i, reply in zip(positions[shard], replies):
+                    results[i] = reply
+            jobs.clear()
+            positions.clear()
+
+        for i, request in enumerate(requests):
+            if isinstance(request, Exception):
+                results[i] = request
+                continue
+            command, args = request
+            shard = self.owner(command, args)
+            if shard is not None:
+                jobs.setdefault(shard, []).append((command, *args))
+                positions.setdefault(shard, []).append(i)
+                continue
+
+            flush()
+            try:
+                results[i] = self.execute(command, args)
+            except Exception as e:
+                results[i] = e
+            if isinstance(results[i], (ClientQuit, Shutdown)):
+                # nothing after these gets a reply
+                return results[:i + 1]
+        flush()
+        return results
+
+    def execute(self, command, args):
+        if command == b'SCAN':
+            return self.scan(*args)
+        if command == b'CLIENT':
+            # tracking is per connection, commands reach other workers on theirs
+            raise CommandError('Client tracking is not supported with multiple workers')
+        if command in KEYLESS_COMMANDS:
+            return self.broadcast(command, args)
+        shard = self.owner(command, args)
+        if shard is not None:
+            return self.call(shard, command, *args)
+        if command in BLOCKING_COMMANDS:
+            # a pop can't wait on several workers at once
+            raise CommandError('Keys of a blocking command must be on the same shard')
+        return self._scatter[command](*args)
+
+    def scan(self, cursor, *options):
+        # shards are scanned one after the other, the shard being scanned is
+        # kept in the low digits of the cursor
+        if isinstance(cursor, bool) or not isinstance(cursor, int) or cursor < 0:
+            raise CommandError('Invalid cursor')
+        cursor, shard = divmod(cursor, self.shards)
+        cursor, keys = self.call(shard, b'SCAN', cursor, *options)
+        if cursor:
+            return [cursor * self.shards + shard, keys]
+        return [shard + 1 if shard + 1 < self.shards else 0, keys]
+
+    def _sum(self, replies):
+        return sum(replies)
+
+    def _all(self, replies):
+        return all(replies)
+
+    def _first(self, replies):
+        return replies[0]
+
+    def broadcast(self, command, args):
+        if command == b'QUIT':
+            return self._commands.execute(command)
+        if command == b'SHUTDOWN':
+            for shard in range(self.shards):
+                if shard != self.shard:
+                    self._remote(shard, [(command,)])
+            return self._commands.execute(command)
+
+        jobs = {}
+        for shard in range(self.shards):
+            shard_args = args
+            if command in (b'SAVE', b'BGSAVE', b'RESTORE', b'MERGE') and args:
+                # each shard has its own file
+                filename = args[0]
+                if isinstance(filename, bytes):
+                    filename = filename.decode('utf-8')
+                shard_args = (f'{filename}.{shard}', *args[1:])
+            jobs[shard] = [(command, *shard_args)]
+        results = self.run(jobs)
+        replies = []
+        for shard in range(self.shards):
+            reply = results[shard][0]
+            if isinstance(reply, Exception):
+                raise reply
+            replies.append(reply)
+        return self._keyless[command](replies)
+
+    def _group(self, keys):
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(key_shard(key, self.shards), []).append(i)
+        return groups
+
+    def _gather(self, command, keys):
+        # run command on each shard with its keys, replies are put back in
+        # the order of keys
+        groups = self._group(keys)
+        results = self.run({shard: [(command, *[keys[i] for i in idx])]
+                            for shard, idx in groups.items()})
+        accum = [None] * len(keys)
+        for shard, idx in groups.items():
+            reply = results[shard][0]
+            if isinstance(reply, Exception):
+                raise reply
+            for i, value in zip(idx, reply):
+                accum[i] = value
+        return accum
+
+    def _each(self, command, keys):
+        # run command once per key, on each shard in one go, replies are put
+        # back in the order of keys
+        groups = self._group(keys)
+        results = self.run({shard: [(command, keys[i]) for i in idx]
+                            for shard, idx in groups.items()})
+        accum = [None] * len(keys)
+        for shard, idx in groups.items():
+            for i, reply in zip(idx, results[shard]):
+                if isinstance(reply, Exception):
+                    raise reply
+                accum[i] = reply
+        return accum
+
+    def mget(self, *keys):
+        return self._gather(b'MGET', keys)
+
+    def mpop(self, *keys):
+        return self._gather(b'MPOP', keys)
+
+    def mdelete(self, *keys):
+        groups = self._group(keys)
+        results = self.run({shard: [(b'MDELETE', *[keys[i] for i in idx])]
+                            for shard, idx in groups.items()})
+        n = 0
+        for (reply,) in results.values():
+            if isinstance(reply, Exception):
+                raise reply
+            n += reply
+        return n
+
+    def _split(self, data):
+        parts = {}
+        for key, value in data.items():
+            parts.setdefault(key_shard(key, self.shards), {})[key] = value
+        return parts
+
+    def mset(self, data):
+        results = self.run({shard: [(b'MSET', part)]
+                            for shard, part in self._split(data).items()})
+        n = 0
+        for (reply,) in results.values():
+            if isinstance(reply, Exception):
+                raise reply
+            n += reply
+        return n
+
+    def msetex(self, data, expires):
+        results = self.run({shard: [(b'MSETEX', part, expires)]
+                            for shard, part in self._split(data).items()})
+        for (reply,) in results.values():
+            if isinstance(reply, Exception):
+                raise reply
+
+    def _members(self, key, keys):
+        # the first key is read like the command would, creating it if missing,
+        # the others only count if they exist
+        first = set(self.call(key_shard(key, self.shards), b'SMEMBERS', key))
+        present = [k for k, exists in zip(keys, self._each(b'EXISTS', keys)) if exists]
+        return first, [set(value) for value in self._each(b'SMEMBERS', present)]
+
+    def sdiff(self, key, *keys):
+        src, others = self._members(key, keys)
+        for value in others:
+            src -= value
+        return list(src)
+
+    def sinter(self, key, *keys):
+        src, others = self._members(key, keys)
+        if len(others) < len(keys):
+            return []
+        for value in others:
+            src &= value
+        return list(src)
+
+    def sunion(self, key, *keys):
+        src, others = self._members(key, keys)
+        for value in others:
+            src |= value
+        return list(src)
+
+    def _store(self, dest, members):
+        shard = key_shard(dest, self.shards)
+        # type check dest the way the store commands do before replacing it
+        self.call(shard, b'SCARD', dest)
+        replies = self.run({shard: [(b'DELETE', dest), (b'SADD', dest, *members)]})
+        for reply in replies[shard]:
+            if isinstance(reply, Exception):
+                raise reply
+        return len(members)
+
+    def sdiffstore(self, dest, key, *keys):
+        return self._store(dest, self.sdiff(key, *keys))
+
+    def sinterstore(self, dest, key, *keys):
+        return self._store(dest, self.sinter(key, *keys))
+
+    def sunionstore(self, dest, key, *keys):
+        return self._store(dest, self.sunion(key, *keys))
+
+    def rpoplpush(self, src, dest):
+        dest_shard = key_shard(dest, self.shards)
+        self.call(dest_shard, b'LLEN', dest)
+        value = self.call(key_shard(src, self.shards), b'RPOP', src)
+        if value is None:
+            return 0
+        self.call(dest_shard, b'LPUSH', dest, value)
+        return 1
+
+
+def reuseport_listener(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def watch_parent(parent, main, interval=1):
+    # workers go down with the process that started them
+    while os.getppid() == parent:
+        gevent.sleep(interval)
+    logger.info('Parent process exited, shutting down')
+    main.throw(KeyboardInterrupt)
+
+
+def run_workers(workers, host, port, serve, backlog=128):
+    """
+    Fork `workers` processes, each calling `serve(shard, listener, peers,
+    peer_listener)`. Workers accept client connections on their own
+    SO_REUSEPORT socket where supported, a shared socket otherwise, and each
+    one listens on a private port for commands forwarded by the others.
+    """
+    peer_listeners = []
+    for _ in range(workers):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        peer_listeners.append(sock)
+    peers = [sock.getsockname() for sock in peer_listeners]
+
+    shared = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        shared = socket.create_server((host, port), backlog=backlog)
+
+    parent = os.getpid()
+    pids = []
+    for shard in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                gevent.spawn(watch_parent, parent, gevent.getcurrent())
+                for i, sock in enumerate(peer_listeners):
+                    if i != shard:
+                        sock.close()
+                listener = shared or reuseport_listener(host, port, backlog)
+                serve(shard, listener, peers, peer_listeners[shard])
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception(f'Worker {shard} failed')
+                status = 1
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    for sock in peer_listeners:
+        sock.close()
+    if shared is not None:
+        shared.close()
+
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        raise
@@ -0,0 +1,51 @@
+from collections import deque
+import time
+
+
+# arguments kept per entry, and bytes kept per argument
+MAX_ARGS = 32
+MAX_ARG_LEN = 128
+
+
+def _truncate(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    elif not isinstance(value, (bytes, int, float)) or isinstance(value, bool):
+        # mappings and the like, only for display
+        value = repr(value).encode('utf-8')
+    if isinstance(value, bytes) and len(value) > MAX_ARG_LEN:
+        value = value[:MAX_ARG_LEN] + b'... (%d more bytes)' % (len(value) - MAX_ARG_LEN)
+    return value
+
+
+class SlowLog:
+    """
+    The last `max_len` commands that took longer than `threshold` microseconds
+    to run, newest first. A negative threshold disables it, 0 logs everything.
+    """
+    def __init__(self, threshold=10000, max_len=128):
+        self.threshold = threshold
+        # compared to in nanoseconds on every command
+        self.threshold_ns = threshold * 1000 if threshold >= 0 else float('inf')
+        self._entries = deque(maxlen=max_len)
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, command, args, ns, client=None):
+        if len(args) >= MAX_ARGS:
+            kept = [command, *map(_truncate, args[:MAX_ARGS - 2])]
+            kept.append(b'... (%d more arguments)' % (len(args) + 1 - len(kept)))
+        else:
+            kept = [command, *map(_truncate, args)]
+        self._entries.appendleft([self._next_id, int(time.time()), ns // 1000, kept, client])
+        self._next_id += 1
+
+    def get(self, count=10):
+        if count < 0:
+            return list(self._entries)
+        return [entry for entry, _ in zip(self._entries, range(count))]
+
+    def reset(self):
+        self._entries.clear()
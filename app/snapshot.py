@@ -0,0 +1,432 @@
+# Binary snapshot format.
+#
+#     header  MAGIC, u16 version, u16 flags
+#     chunks  u32 length, u32 crc32 of the (possibly compressed) payload, payload
+#
+# A payload holds whole records, so a chunk can be checked and decoded on its
+# own and neither writing nor loading ever needs more than one chunk in memory.
+# Collections larger than BATCH_SIZE are split into several records for the same
+# key, each one adding to what the previous ones loaded. The last record is
+# R_END, a snapshot without it was cut short.
+#
+# Keys and values are tagged with their type, only the types the server can
+# receive are supported.
+from collections import deque
+from itertools import accumulate, islice
+import struct
+import zlib
+
+from const import Value, KV, HASH, QUEUE, SET, ZSET
+from exc import SnapshotError
+from quicklist import QuickList
+from sorted_set import SortedSet
+
+
+MAGIC = b'MINIREDIS'
+VERSION = 1
+FLAG_ZLIB = 1
+
+CHUNK_SIZE = 2**20
+BATCH_SIZE = 1024
+
+R_KV = 1
+R_HASH = 2
+R_QUEUE = 3
+R_SET = 4
+R_EXPIRE = 5
+R_ZSET = 6
+R_END = 255
+
+RECORD_TYPES = {KV: R_KV, HASH: R_HASH, QUEUE: R_QUEUE, SET: R_SET, ZSET: R_ZSET}
+
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+F64 = struct.Struct('<d')
+HEADER = struct.Struct(f'<{len(MAGIC)}sHH')
+CHUNK = struct.Struct('<II')
+
+
+def _encode_bytes(buf, obj):
+    buf += b'b'
+    buf += U32.pack(len(obj))
+    buf += obj
+
+def _encode_str(buf, obj):
+    data = obj.encode('utf-8')
+    buf += b's'
+    buf += U32.pack(len(data))
+    buf += data
+
+def _encode_int(buf, obj):
+    if -2**63 <= obj < 2**63:
+        buf += b'i'
+        buf += I64.pack(obj)
+    else:
+        data = b'%d' % obj
+        buf += b'I'
+        buf += U32.pack(len(data))
+        buf += data
+
+def _encode_float(buf, obj):
+    buf += b'f'
+    buf += F64.pack(obj)
+
+def _encode_bool(buf, obj):
+    buf += b't' if obj else b'F'
+
+def _encode_none(buf, obj):
+    buf += b'n'
+
+def _encode_list(buf, obj):
+    # runs of bytes, strings or integers are packed so they decode in bulk
+    if obj:
+        kind = type(obj[0])
+        if kind in PACKED and all(type(item) is kind for item in obj):
+            if PACKED[kind](buf, obj):
+                return
+    buf += b'l'
+    buf += U32.pack(len(obj))
+    for item in obj:
+        encode(buf, item)
+
+def _pack_bytes(buf, items):
+    buf += b'B'
+    buf += U32.pack(len(items))
+    buf += struct.pack(f'<{len(items)}I', *map(len, items))
+    buf += b''.join(items)
+    return True
+
+def _pack_str(buf, items):
+    # lengths in characters, the text is decoded in one go and sliced
+    data = ''.join(items).encode('utf-8')
+    buf += b'U'
+    buf += U32.pack(len(items))
+    buf += struct.pack(f'<{len(items)}I', *map(len, items))
+    buf += U32.pack(len(data))
+    buf += data
+    return True
+
+def _pack_int(buf, items):
+    try:
+        data = struct.pack(f'<{len(items)}q', *items)
+    except struct.error:
+        return False
+    buf += b'Q'
+    buf += U32.pack(len(items))
+    buf += data
+    return True
+
+PACKED = {bytes: _pack_bytes, str: _pack_str, int: _pack_int}
+
+def _encode_set(buf, obj):
+    buf += b'S'
+    buf += U32.pack(len(obj))
+    for item in obj:
+        encode(buf, item)
+
+def _encode_dict(buf, obj):
+    buf += b'd'
+    buf += U32.pack(len(obj))
+    for key, value in obj.items():
+        encode(buf, key)
+        encode(buf, value)
+
+ENCODERS = {
+    bytes: _encode_bytes,
+    str: _encode_str,
+    int: _encode_int,
+    float: _encode_float,
+    bool: _encode_bool,
+    type(None): _encode_none,
+    list: _encode_list,
+    tuple: _encode_list,
+    deque: _encode_list,
+    set: _encode_set,
+    frozenset: _encode_set,
+    dict: _encode_dict,
+}
+
+
+def encode(buf, obj):
+    try:
+        encoder = ENCODERS[type(obj)]
+    except KeyError:
+        for base in type(obj).__mro__[1:]:
+            if base in ENCODERS:
+                encoder = ENCODERS[type(obj)] = ENCODERS[base]
+                break
+        else:
+            raise SnapshotError(f'Unable to snapshot values of type {type(obj).__name__}')
+    encoder(buf, obj)
+
+
+class ChunkReader:
+    # decodes the records of one chunk
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = 0
+        self.decoders = {
+            ord('I'): self._bigint,
+            ord('f'): self._float,
+            ord('t'): lambda: True,
+            ord('F'): lambda: False,
+            ord('n'): lambda: None,
+            ord('l'): self._list,
+            ord('B'): self._packed_bytes,
+            ord('U'): self._packed_str,
+            ord('Q'): self._packed_int,
+            ord('S'): self._set,
+            ord('d'): self._dict,
+        }
+
+    def done(self):
+        return self.pos >= len(self.data)
+
+    def byte(self):
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def u32(self):
+        value, = U32.unpack_from(self.data, self.pos)
+        self.pos += 4
+        return value
+
+    def i64(self):
+        value, = I64.unpack_from(self.data, self.pos)
+        self.pos += 8
+        return value
+
+    def _raw(self):
+        length = self.u32()
+        start = self.pos
+        self.pos += length
+        if self.pos > len(self.data):
+            raise SnapshotError('Record overruns its chunk')
+        return self.view[start:self.pos]
+
+    def _bigint(self):
+        return int(bytes(self._raw()))
+
+    def _float(self):
+        value, = F64.unpack_from(self.data, self.pos)
+        self.pos += 8
+        return value
+
+    def _packed_bytes(self):
+        n = self.u32()
+        lengths = struct.unpack_from(f'<{n}I', self.data, self.pos)
+        start = self.pos + 4 * n
+        ends = list(accumulate(lengths, initial=start))
+        self.pos = ends[-1]
+        if self.pos > len(self.data):
+            raise SnapshotError('Record overruns its chunk')
+        data = self.data
+        return [data[a:b] for a, b in zip(ends, ends[1:])]
+
+    def _packed_str(self):
+        n = self.u32()
+        lengths = struct.unpack_from(f'<{n}I', self.data, self.pos)
+        self.pos += 4 * n
+        text = str(self._raw(), 'utf-8')
+        ends = list(accumulate(lengths, initial=0))
+        return [text[a:b] for a, b in zip(ends, ends[1:])]
+
+    def _packed_int(self):
+        n = self.u32()
+        items = list(struct.unpack_from(f'<{n}q', self.data, self.pos))
+        self.pos += 8 * n
+        return items
+
+    def _list(self):
+        return [self.value() for _ in range(self.u32())]
+
+    def _set(self):
+        return {self.value() for _ in range(self.u32())}
+
+    def _dict(self):
+        accum = {}
+        for _ in range(self.u32()):
+            key = self.value()
+            accum[key] = self.value()
+        return accum
+
+    def value(self):
+        # bytes, strings and integers are decoded inline, they make up most
+        # of a keyspace
+        data = self.data
+        pos = self.pos
+        tag = data[pos]
+        if tag == 98 or tag == 115: # 'b', 's'
+            length, = U32.unpack_from(data, pos + 1)
+            start = pos + 5
+            self.pos = stop = start + length
+            if stop > len(data):
+                raise SnapshotError('Record overruns its chunk')
+            if tag == 98:
+                return bytes(self.view[start:stop])
+            return str(self.view[start:stop], 'utf-8')
+        if tag == 105: # 'i'
+            value, = I64.unpack_from(data, pos + 1)
+            self.pos = pos + 9
+            return value
+        self.pos = pos + 1
+        try:
+            decoder = self.decoders[tag]
+        except KeyError:
+            raise SnapshotError(f'Unknown value tag {tag}')
+        return decoder()
+
+
+class SnapshotWriter:
+    def __init__(self, fh, compress=False, report=None):
+        self._fh = fh
+        self._compress = compress
+        self._report = report
+        self._buf = bytearray()
+        self.written = 0
+        self._write(HEADER.pack(MAGIC, VERSION, FLAG_ZLIB if compress else 0))
+
+    def _write(self, data):
+        self._fh.write(data)
+        self.written += len(data)
+
+    def flush(self):
+        if not self._buf:
+            return
+        payload = zlib.compress(self._buf, 1) if self._compress else self._buf
+        self._write(CHUNK.pack(len(payload), zlib.crc32(payload)))
+        self._write(payload)
+        del self._buf[:]
+        if self._report is not None:
+            self._report(self.written)
+
+    def _record_done(self):
+        if len(self._buf) >= CHUNK_SIZE:
+            self.flush()
+
+    def write_key(self, key, value, deadline=None):
+        buf = self._buf
+        data_type, data = value
+        record = RECORD_TYPES[data_type]
+        if data_type == KV:
+            buf.append(record)
+            encode(buf, key)
+            encode(buf, data)
+            self._record_done()
+        else:
+            # hash fields and sorted set members are written as two lists, the
+            # second one with their values or scores
+            pairs = data_type in (HASH, ZSET)
+            items = iter(data.items() if pairs else data)
+            batch = list(islice(items, BATCH_SIZE))
+            # at least one record, even for an empty collection
+            while True:
+                buf.append(record)
+                encode(buf, key)
+                if pairs:
+                    _encode_list(buf, [field for field, _ in batch])
+                    _encode_list(buf, [item for _, item in batch])
+                else:
+                    _encode_list(buf, batch)
+                self._record_done()
+                batch = list(islice(items, BATCH_SIZE))
+                if not batch:
+                    break
+
+        if deadline is not None:
+            buf.append(R_EXPIRE)
+            encode(buf, key)
+            buf += I64.pack(deadline)
+            self._record_done()
+
+    def close(self):
+        self._buf.append(R_END)
+        self.flush()
+
+
+def dump(fh, kv, expiry, compress=False, report=None):
+    """Write the keyspace `kv` and deadlines from `expiry` to the file `fh`."""
+    writer = SnapshotWriter(fh, compress=compress, report=report)
+    for key, value in kv.items():
+        writer.write_key(key, value, expiry.get(key))
+    writer.close()
+    return writer.written
+
+
+def _read_exact(fh, n):
+    data = fh.read(n)
+    if len(data) != n:
+        raise SnapshotError('Snapshot is truncated')
+    return data
+
+
+def load(fh):
+    """Read a snapshot from `fh`, returns the keyspace and a dict of deadlines."""
+    header = fh.read(HEADER.size)
+    if len(header) != HEADER.size or not header.startswith(MAGIC):
+        raise SnapshotError('Not a snapshot file')
+    _, version, flags = HEADER.unpack(header)
+    if version > VERSION:
+        raise SnapshotError(f'Unsupported snapshot version {version}')
+    compressed = flags & FLAG_ZLIB
+
+    kv = {}
+    deadlines = {}
+    # sorted set members, built in one go once everything is read
+    zsets = {}
+    while True:
+        length, checksum = CHUNK.unpack(_read_exact(fh, CHUNK.size))
+        payload = _read_exact(fh, length)
+        if zlib.crc32(payload) != checksum:
+            raise SnapshotError('Snapshot checksum mismatch')
+        if compressed:
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error as e:
+                raise SnapshotError(f'Corrupt snapshot chunk: {e}')
+
+        try:
+            done = _load_chunk(ChunkReader(payload), kv, deadlines, zsets)
+        except (struct.error, IndexError, UnicodeDecodeError, ValueError) as e:
+            raise SnapshotError(f'Corrupt snapshot record: {e}')
+        if done:
+            try:
+                for key, pairs in zsets.items():
+                    kv[key].value.update(pairs)
+            except TypeError as e:
+                raise SnapshotError(f'Corrupt snapshot record: {e}')
+            return kv, deadlines
+
+
+def _load_chunk(reader, kv, deadlines, zsets):
+    while not reader.done():
+        record = reader.byte()
+        if record == R_END:
+            return True
+        key = reader.value()
+        if record == R_KV:
+            kv[key] = Value(KV, reader.value())
+        elif record == R_EXPIRE:
+            deadlines[key] = reader.i64()
+        elif record == R_HASH:
+            if key not in kv:
+                kv[key] = Value(HASH, {})
+            fields = reader.value()
+            kv[key].value.update(zip(fields, reader.value()))
+        elif record == R_QUEUE:
+            if key not in kv:
+                kv[key] = Value(QUEUE, QuickList())
+            kv[key].value.extend(reader.value())
+        elif record == R_ZSET:
+            if key not in kv:
+                kv[key] = Value(ZSET, SortedSet())
+            members = reader.value()
+            zsets.setdefault(key, []).extend(zip(members, reader.value()))
+        elif record == R_SET:
+            if key not in kv:
+                kv[key] = Value(SET, set())
+            kv[key].value.update(reader.value())
+        else:
+            raise SnapshotError(f'Unknown record type {record}')
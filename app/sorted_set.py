@@ -0,0 +1,324 @@
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+import math
+import sys
+
+from scan import ScanDict
+
+
+# members per bucket, buckets are split at twice this and merged below a quarter
+LOAD = 1000
+# members looked at to estimate the memory held by a sorted set
+SIZE_SAMPLES = 8
+
+# members of different types are ordered by type first, then by value
+MEMBER_KINDS = {int: 0, float: 0, bool: 0, bytes: 1, str: 2}
+
+
+def member_kind(member):
+    try:
+        return MEMBER_KINDS[type(member)]
+    except KeyError:
+        raise TypeError(f'Unsupported member type {type(member).__name__}')
+
+
+class SortedSet:
+    """
+    Members ordered by score, ties broken by the member itself.
+
+    A dict maps members to their score, the order is kept in a list of sorted
+    buckets of (score, kind, member) entries, each at most 2 * LOAD long, with
+    the last entry of each bucket in `_maxes`. Finding an entry is a bisect over
+    `_maxes` then one within its bucket. Positions go through a Fenwick tree of
+    the bucket lengths, so ranks and index based ranges are O(log n) too. The
+    tree is rebuilt lazily after buckets are split or merged.
+
+    Inserting into a bucket moves at most 2 * LOAD pointers, which in practice
+    costs less than allocating the nodes of a skiplist would.
+
+    The dict is a ScanDict, ZSCAN walks the members in the order of their
+    hash, which unlike scores doesn't change and has no long runs of ties.
+    """
+    def __init__(self, pairs=None):
+        self._scores = ScanDict()
+        self._lists = []
+        self._maxes = []
+        self._tree = None
+        if pairs:
+            self.update(pairs)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, member):
+        return member in self._scores
+
+    def __iter__(self):
+        for bucket in self._lists:
+            for _, _, member in bucket:
+                yield member
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self) + sys.getsizeof(self._scores)
+        size += sys.getsizeof(self._lists) + sys.getsizeof(self._maxes)
+        if self._scores:
+            sample = list(islice(self._scores.items(), SIZE_SAMPLES))
+            # the member, its score and its entry in a bucket
+            per_item = sum(sys.getsizeof(m) + sys.getsizeof(s) + 72 for m, s in sample)
+            size += per_item * len(self._scores) // len(sample)
+        return size
+
+    def scan(self, cursor, count):
+        """The next members from cursor in hash order, see scan.HashOrder."""
+        return self._scores.order.walk(cursor, count)
+
+    def items(self):
+        """(member, score) pairs from the lowest score up."""
+        for bucket in self._lists:
+            for score, _, member in bucket:
+                yield member, score
+
+    def score(self, member):
+        return self._scores.get(member)
+
+    def update(self, pairs):
+        """Add (member, score) pairs, returns the number of new members."""
+        if not self._scores:
+            return self._build(pairs)
+        n = 0
+        for member, score in pairs:
+            n += self.add(member, score)
+        return n
+
+    def _build(self, pairs):
+        # bulk load, sorted once and cut into buckets
+        scores = {}
+        for member, score in pairs:
+            member_kind(member)
+            scores[member] = score
+        self._scores = ScanDict(scores)
+        entries = sorted((score, member_kind(member), member)
+                         for member, score in scores.items())
+        self._lists = [entries[i:i + LOAD] for i in range(0, len(entries), LOAD)]
+        self._maxes = [bucket[-1] for bucket in self._lists]
+        self._tree = None
+        return len(scores)
+
+    def add(self, member, score):
+        """Set the score of member, returns 1 if it is new."""
+        old = self._scores.get(member)
+        if old is not None:
+            if old == score:
+                return 0
+            self._remove_entry((old, member_kind(member), member))
+            self._scores[member] = score
+            self._insert((score, member_kind(member), member))
+            return 0
+        entry = (score, member_kind(member), member)
+        self._scores[member] = score
+        self._insert(entry)
+        return 1
+
+    def remove(self, member):
+        score = self._scores.pop(member, None)
+        if score is None:
+            return 0
+        self._remove_entry((score, member_kind(member), member))
+        return 1
+
+    def _insert(self, entry):
+        lists = self._lists
+        maxes = self._maxes
+        if not lists:
+            lists.append([entry])
+            maxes.append(entry)
+            self._tree = None
+            return
+        i = bisect_left(maxes, entry)
+        if i == len(maxes):
+            i -= 1
+            lists[i].append(entry)
+            maxes[i] = entry
+        else:
+            insort(lists[i], entry)
+        self._grew(i, 1)
+
+    def _grew(self, i, delta):
+        bucket = self._lists[i]
+        if len(bucket) > 2 * LOAD:
+            half = len(bucket) // 2
+            self._lists[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+            self._tree = None
+        elif self._tree is not None:
+            self._tree_add(i, delta)
+
+    def _remove_entry(self, entry):
+        i = bisect_left(self._maxes, entry)
+        bucket = self._lists[i]
+        j = bisect_left(bucket, entry)
+        self._delete(i, j)
+
+    def _delete(self, i, j):
+        lists = self._lists
+        bucket = lists[i]
+        del bucket[j]
+        if not bucket:
+            del lists[i]
+            del self._maxes[i]
+            self._tree = None
+            return
+        self._maxes[i] = bucket[-1]
+        if len(bucket) < LOAD // 4 and len(lists) > 1:
+            # fold small buckets into a neighbour
+            k = i - 1 if i > 0 else i
+            lists[k:k + 2] = [lists[k] + lists[k + 1]]
+            self._maxes[k:k + 2] = [lists[k][-1]]
+            self._tree = None
+            if len(lists[k]) > 2 * LOAD:
+                self._grew(k, 0)
+        elif self._tree is not None:
+            self._tree_add(i, -1)
+
+    # Fenwick tree over the bucket lengths
+    def _build_tree(self):
+        tree = [0] + [len(bucket) for bucket in self._lists]
+        n = len(tree)
+        for i in range(1, n):
+            parent = i + (i & -i)
+            if parent < n:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, delta):
+        tree = self._tree
+        i += 1
+        n = len(tree)
+        while i < n:
+            tree[i] += delta
+            i += i & -i
+
+    def _offset(self, i):
+        # members in the buckets before bucket i
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, index):
+        # bucket and position within it of the member at index
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        pos = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] <= index:
+                index -= tree[nxt]
+                pos = nxt
+            step >>= 1
+        return pos, index
+
+    def rank(self, member, reverse=False):
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        entry = (score, member_kind(member), member)
+        i = bisect_left(self._maxes, entry)
+        rank = self._offset(i) + bisect_left(self._lists[i], entry)
+        return len(self._scores) - 1 - rank if reverse else rank
+
+    def _entries(self, start, stop, reverse=False):
+        # entries at positions start until stop, both already within bounds
+        if start >= stop:
+            return
+        if not reverse:
+            i, j = self._locate(start)
+            n = stop - start
+            lists = self._lists
+            while n > 0:
+                bucket = lists[i]
+                chunk = bucket[j:j + n]
+                yield from chunk
+                n -= len(chunk)
+                i += 1
+                j = 0
+        else:
+            i, j = self._locate(stop - 1)
+            n = stop - start
+            lists = self._lists
+            while n > 0:
+                bucket = lists[i]
+                lo = max(j + 1 - n, 0)
+                chunk = bucket[lo:j + 1]
+                chunk.reverse()
+                yield from chunk
+                n -= len(chunk)
+                i -= 1
+                if i >= 0:
+                    j = len(lists[i]) - 1
+
+    def range(self, start, stop, reverse=False):
+        """
+        (member, score) pairs from position start to stop inclusive, negative
+        positions count from the end like python's, like ZRANGE.
+        """
+        n = len(self._scores)
+        if start < 0:
+            start = max(n + start, 0)
+        if stop < 0:
+            stop = n + stop
+        stop = min(stop, n - 1)
+        if start > stop:
+            return []
+        if reverse:
+            start, stop = n - 1 - stop, n - 1 - start
+        return [(member, score) for score, _, member in self._entries(start, stop + 1, reverse)]
+
+    def _bound(self, score, exclusive, upper):
+        # position of the first entry past (upper) or at (lower) score
+        if upper != exclusive:
+            key = (score, math.inf)
+            i = bisect_right(self._maxes, key)
+            if i == len(self._maxes):
+                return len(self._scores)
+            return self._offset(i) + bisect_right(self._lists[i], key)
+        key = (score,)
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return len(self._scores)
+        return self._offset(i) + bisect_left(self._lists[i], key)
+
+    def range_by_score(self, min_score, max_score, min_exclusive=False,
+                       max_exclusive=False, offset=0, count=None, reverse=False):
+        """(member, score) pairs with a score between min and max."""
+        start = self._bound(min_score, min_exclusive, upper=False)
+        stop = self._bound(max_score, max_exclusive, upper=True)
+        if reverse:
+            stop -= offset
+        else:
+            start += offset
+        if count is not None and count >= 0:
+            if reverse:
+                start = max(start, stop - count)
+            else:
+                stop = min(stop, start + count)
+        return [(member, score) for score, _, member in self._entries(start, stop, reverse)]
+
+    def pop(self, count=1, reverse=False):
+        """Remove and return the count members with the lowest (highest) scores."""
+        accum = []
+        while count > 0 and self._lists:
+            i = len(self._lists) - 1 if reverse else 0
+            j = len(self._lists[i]) - 1 if reverse else 0
+            score, _, member = self._lists[i][j]
+            self._delete(i, j)
+            del self._scores[member]
+            accum.append((member, score))
+            count -= 1
+        return accum
@@ -0,0 +1,134 @@
+from collections import deque
+import os
+import sys
+import time
+
+
+# latencies are bucketed log-linearly: every power of two of nanoseconds is
+# split in 2**SUB_BITS buckets, so a percentile is off by at most 1 / 2**SUB_BITS
+SUB_BITS = 3
+# enough for any latency in 64 bits of nanoseconds
+BUCKETS = (65 - SUB_BITS) << SUB_BITS
+# (time, commands processed) samples behind the instantaneous ops/sec
+OPS_SAMPLES = 16
+PERCENTILES = ((b'p50', 0.5), (b'p99', 0.99), (b'p999', 0.999))
+
+
+def bucket_limit(index):
+    """The largest latency, in nanoseconds, counted in bucket `index`."""
+    shift, sub = divmod(index, 1 << SUB_BITS)
+    if shift <= 1:
+        return index
+    return ((sub + (1 << SUB_BITS) + 1) << (shift - 1)) - 1
+
+
+class CommandStats:
+    __slots__ = ('calls', 'failed', 'ns', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.failed = 0
+        self.ns = 0
+        self.histogram = [0] * BUCKETS
+
+    def percentile(self, p):
+        # in microseconds
+        rank = p * self.calls
+        seen = 0
+        for index, n in enumerate(self.histogram):
+            seen += n
+            if n and seen >= rank:
+                return bucket_limit(index) / 1000
+        return 0
+
+
+class Stats:
+    """
+    What the server has been doing, for INFO. Commands are counted and timed
+    as they run, the rest is read off the server when asked for.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.connected_clients = 0
+        self.total_connections = 0
+        self.reset()
+
+    def reset(self):
+        self.commands = {}
+        self._reset_at = time.monotonic()
+        self._samples = deque(maxlen=OPS_SAMPLES)
+
+    def record(self, command, ns, failed=False):
+        # on every command, kept cheap
+        try:
+            stats = self.commands[command]
+        except KeyError:
+            stats = self.commands[command] = CommandStats()
+        stats.calls += 1
+        stats.ns += ns
+        if failed:
+            stats.failed += 1
+        # the top SUB_BITS + 1 bits of ns, plus where they were taken from
+        shift = ns.bit_length() - SUB_BITS - 1
+        stats.histogram[ns if shift <= 0 else (shift << SUB_BITS) + (ns >> shift)] += 1
+
+    def connected(self):
+        self.connected_clients += 1
+        self.total_connections += 1
+
+    def disconnected(self):
+        self.connected_clients -= 1
+
+    def total_commands(self):
+        return sum(stats.calls for stats in self.commands.values())
+
+    def sample(self):
+        # called periodically, the server's cron
+        self._samples.append((time.monotonic(), self.total_commands()))
+
+    def ops_per_sec(self):
+        samples = self._samples
+        if len(samples) >= 2:
+            (start, first), (end, last) = samples[0], samples[-1]
+        else:
+            # not sampled yet, the average since the reset over at least a second
+            start, first, last = self._reset_at, 0, self.total_commands()
+            end = max(time.monotonic(), start + 1)
+        return round((last - first) / (end - start), 2)
+
+    def server(self):
+        return {
+            b'uptime_in_seconds': int(time.time() - self.started),
+            b'process_id': os.getpid(),
+            b'python_version': sys.version.split()[0],
+        }
+
+    def clients(self):
+        return {
+            b'connected_clients': self.connected_clients,
+            b'total_connections_received': self.total_connections,
+        }
+
+    def stats(self):
+        return {
+            b'total_commands_processed': self.total_commands(),
+            b'failed_commands': sum(stats.failed for stats in self.commands.values()),
+            b'instantaneous_ops_per_sec': self.ops_per_sec(),
+        }
+
+    def command_stats(self):
+        accum = {}
+        for command, stats in sorted(self.commands.items()):
+            usec = stats.ns / 1000
+            accum[command] = {
+                b'calls': stats.calls,
+                b'failed_calls': stats.failed,
+                b'usec': round(usec, 3),
+                b'usec_per_call': round(usec / stats.calls, 3),
+            }
+        return accum
+
+    def latency_stats(self):
+        """Percentiles of each command's latency in microseconds."""
+        return {command: {name: stats.percentile(p) for name, p in PERCENTILES}
+                for command, stats in sorted(self.commands.items())}
@@ -1,21 +1,91 @@
-import socketserver as ss
+import logging
+import queue
+import socket
+import threading
+
+
+logger = logging.getLogger(__name__)
+
 
 class ThreadedStreamServer:
-    def __init__(self, address, handler):
+    """
+    Serves each connection on a thread from a bounded pool.
+
+    Threads are started as connections come in, up to `max_workers`, and then
+    reused. Once every worker is busy no more connections are accepted, the
+    following ones wait in the listen backlog until a worker frees up.
+    """
+    def __init__(self, address, handler, max_workers=1024, backlog=128):
         self.address = address
         self.handler = handler
-    
-    def serve_forever(self):
-        handler = self.handler
-        class RequestHandler(ss.BaseRequestHandler):
-            def handle(self):
-                return handler(self.request, self.client_address)
+        self.max_workers = max_workers
+        self.backlog = backlog
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = 0
+        self._stopped = threading.Event()
+        self._interrupted = False
+        self._socket = None
+
+    def _listen(self):
+        if isinstance(self.address, socket.socket):
+            return self.address
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        return sock
+
+    def _worker(self, conn, address):
+        while True:
+            try:
+                self.handler(conn, address)
+            except KeyboardInterrupt:
+                # raised by SHUTDOWN, stop the whole server
+                self._interrupted = True
+                self.stop()
+            except Exception:
+                logger.exception(f'Error handling {address[0]}:{address[1]}')
+            finally:
+                conn.close()
+            # idle before the slot is given back, so an accepted connection
+            # always finds either an idle worker or room for a new one
+            with self._lock:
+                self._idle += 1
+            self._slots.release()
+            conn, address = self._queue.get()
 
-        class ThreadedServer(ss.ThreadingMixIn, ss.TCPServer):
-            allow_reuse_address = True
+    def _dispatch(self, conn, address):
+        # an idle worker is claimed here rather than when it picks the
+        # connection up, or two connections could count on the same worker
+        with self._lock:
+            spawn = not self._idle
+            if not spawn:
+                self._idle -= 1
+        if spawn:
+            threading.Thread(target=self._worker, args=(conn, address), daemon=True).start()
+        else:
+            self._queue.put((conn, address))
 
-        self.stream_server = ThreadedServer(self.address, RequestHandler)
-        self.stream_server.serve_forever()
+    def serve_forever(self, poll_interval=0.5):
+        self._socket = sock = self._listen()
+        sock.settimeout(poll_interval)
+        try:
+            while not self._stopped.is_set():
+                if not self._slots.acquire(timeout=poll_interval):
+                    continue
+                try:
+                    conn, address = sock.accept()
+                except (socket.timeout, OSError):
+                    self._slots.release()
+                    continue
+                conn.settimeout(None)
+                self._dispatch(conn, address)
+        finally:
+            sock.close()
+        if self._interrupted:
+            raise KeyboardInterrupt
 
     def stop(self):
-        self.stream_server.shutdown()
\ No newline at end of file
+        self._stopped.set()
@@ -0,0 +1,147 @@
+from itertools import islice
+import time
+
+
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+MASK = SLOTS - 1
+LEVELS = 5 # 2**40 ms, deadlines further out are re-armed when they come in range
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel of millisecond deadlines.
+
+    Each key has at most one entry, re-arming or cancelling it is O(1). Level 0
+    has one slot per millisecond, every level above covers SLOTS times the range
+    of the one below and its slots are cascaded down as time reaches them, so a
+    deadline is only ever moved LEVELS times before it fires.
+    """
+    def __init__(self, now=None):
+        self._now = now_ms() if now is None else now
+        self._levels = [[None] * SLOTS for _ in range(LEVELS)]
+        self._counts = [0] * LEVELS
+        # key -> (deadline, level, slot)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry[0]
+
+    def add(self, key, deadline):
+        self.remove(key)
+        self._place(key, deadline)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        deadline, level, slot = entry
+        self._levels[level][slot].discard(key)
+        self._counts[level] -= 1
+        return deadline
+
+    def clear(self):
+        self._levels = [[None] * SLOTS for _ in range(LEVELS)]
+        self._counts = [0] * LEVELS
+        self._entries = {}
+
+    def nearest(self, limit):
+        """
+        Return up to `limit` keys from the first populated slot, i.e. among the
+        keys that expire soonest. Only approximate across levels.
+        """
+        for level in range(LEVELS):
+            if not self._counts[level]:
+                continue
+            current = (self._now >> (SLOT_BITS * level)) & MASK
+            slots = self._levels[level]
+            for offset in range(SLOTS + 1):
+                bucket = slots[(current + offset) & MASK]
+                if bucket:
+                    return list(islice(bucket, limit))
+        return []
+
+    def _place(self, key, deadline):
+        # anything already due fires on the next tick, level 0 covers the next
+        # SLOTS ticks, each level above SLOTS times as many
+        tick = max(deadline, self._now + 1)
+        distance = tick - self._now - 1
+        level = max(distance.bit_length() - 1, 0) // SLOT_BITS
+        if level >= LEVELS:
+            level = LEVELS - 1
+            tick = self._now + (1 << (SLOT_BITS * LEVELS))
+        slot = (tick >> (SLOT_BITS * level)) & MASK
+
+        bucket = self._levels[level][slot]
+        if bucket is None:
+            bucket = self._levels[level][slot] = set()
+        bucket.add(key)
+        self._counts[level] += 1
+        self._entries[key] = (deadline, level, slot)
+
+    def _cascade(self, level, slot):
+        bucket = self._levels[level][slot]
+        if not bucket:
+            return
+        self._levels[level][slot] = None
+        self._counts[level] -= len(bucket)
+        for key in bucket:
+            self._place(key, self._entries[key][0])
+
+    def advance(self, now=None, deadline=None):
+        """
+        Move the wheel forward to `now` (ms) and return the keys that expired.
+        Stops early once time.monotonic() passes `deadline`, the remaining
+        ticks are processed by the next call.
+        """
+        now = now_ms() if now is None else now
+        expired = []
+        ticks = 0
+        while self._now < now:
+            if not self._entries:
+                self._now = now
+                break
+
+            # skip ahead to the next boundary where the lowest populated level
+            # has to be looked at
+            lowest = next(level for level, count in enumerate(self._counts) if count)
+            if lowest:
+                step = 1 << (SLOT_BITS * lowest)
+                boundary = (self._now // step + 1) * step
+                if boundary > now:
+                    self._now = now
+                    break
+                self._now = boundary - 1
+
+            tick = self._now + 1
+            # cascade from the top so entries can move down more than one level
+            for level in range(LEVELS - 1, 0, -1):
+                if not tick & ((1 << (SLOT_BITS * level)) - 1):
+                    self._cascade(level, (tick >> (SLOT_BITS * level)) & MASK)
+
+            slot = tick & MASK
+            bucket = self._levels[0][slot]
+            if bucket:
+                self._levels[0][slot] = None
+                self._counts[0] -= len(bucket)
+                for key in bucket:
+                    del self._entries[key]
+                expired.extend(bucket)
+            self._now = tick
+
+            ticks += 1
+            if deadline is not None and not ticks % 64 and time.monotonic() > deadline:
+                break
+        return expired
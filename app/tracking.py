@@ -0,0 +1,59 @@
+class Tracking:
+    """
+    Keys read by connections with tracking on, for caching on the client. A
+    connection names the pubsub channel its invalidations go to. Once a key
+    changes or expires each channel that read it is sent the key and stops
+    tracking it, the next read tracks it again.
+
+    Past `max_keys` tracked keys the oldest are invalidated early to make
+    room, a negative `max_keys` never does.
+    """
+    def __init__(self, max_keys=10**6):
+        self.max_keys = max_keys
+        # client address -> its channel
+        self.clients = {}
+        # key -> channels that read it, insertion ordered
+        self.keys = {}
+
+    def enable(self, client, channel):
+        self.clients[client] = channel
+
+    def disable(self, client):
+        # keys it read stay tracked, the channel may still be listened to
+        self.clients.pop(client, None)
+
+    def track(self, channel, keys):
+        """Remember `channel` read `keys`, returns what to invalidate to make room."""
+        tracked = self.keys
+        for key in keys:
+            try:
+                tracked[key].add(channel)
+            except KeyError:
+                tracked[key] = {channel}
+            except TypeError:
+                # unhashable, the command failed anyway
+                pass
+        if self.max_keys < 0 or len(tracked) <= self.max_keys:
+            return {}
+        return self.invalidate([key for key, _ in zip(tracked, range(len(tracked) - self.max_keys))])
+
+    def invalidate(self, keys):
+        """Forget `keys`, returns channel -> the keys of them it read."""
+        tracked = self.keys
+        accum = {}
+        for key in keys:
+            try:
+                channels = tracked.pop(key)
+            except (KeyError, TypeError):
+                continue
+            for channel in channels:
+                accum.setdefault(channel, []).append(key)
+        return accum
+
+    def invalidate_all(self):
+        """Forget every key, returns the channels that read any."""
+        channels = set()
+        for readers in self.keys.values():
+            channels |= readers
+        self.keys.clear()
+        return channels
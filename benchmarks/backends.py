@@ -0,0 +1,120 @@
+"""
+Compare the gevent, threaded and asyncio server backends.
+
+Each backend is started in its own process and hit by concurrent clients
+doing single round trips, where latency matters, and pipelined batches,
+where throughput does.
+
+    python benchmarks/backends.py --clients 16 --requests 5000
+"""
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import socket
+import subprocess
+import sys
+import time
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+BACKENDS = (
+    ('gevent', []),
+    ('threads', ['-t']),
+    ('asyncio', ['-a']),
+)
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def request(i):
+    key = b'key:%d' % i
+    return b'*3\r\n$3\r\nSET\r\n$%d\r\n%s\r\n$5\r\nvalue\r\n' % (len(key), key)
+
+
+def read_replies(sock, n):
+    seen = 0
+    while seen < n:
+        data = sock.recv(1 << 16)
+        if not data:
+            raise RuntimeError('server closed the connection')
+        seen += data.count(b'\r\n')
+
+
+def round_trips(args):
+    port, client, n = args
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        sock.sendall(request(client * n + i))
+        read_replies(sock, 1)
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+    return latencies
+
+
+def pipelined(args):
+    port, client, n, batch = args
+    sock = socket.create_connection(('127.0.0.1', port))
+    payload = b''.join(request(client * n + i) for i in range(batch))
+    for _ in range(n // batch):
+        sock.sendall(payload)
+        read_replies(sock, batch)
+    sock.close()
+    return n // batch * batch
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def bench(name, flags, port, options):
+    server = subprocess.Popen([sys.executable, 'server.py', '-p', str(port), '-e'] + flags,
+                              cwd=APP, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        with Pool(options.clients) as pool:
+            start = time.perf_counter()
+            results = pool.map(round_trips, [(port, c, options.requests)
+                                             for c in range(options.clients)])
+            elapsed = time.perf_counter() - start
+            latencies = sorted(l for result in results for l in result)
+
+            start = time.perf_counter()
+            total = sum(pool.map(pipelined, [(port, c, options.requests * 10, options.batch)
+                                             for c in range(options.clients)]))
+            pipelined_elapsed = time.perf_counter() - start
+        print(f'{name:<8} round trips {len(latencies) / elapsed:9,.0f}/s  '
+              f'p50 {percentile(latencies, .5) * 1e6:7.0f}us  '
+              f'p99 {percentile(latencies, .99) * 1e6:7.0f}us  '
+              f'pipelined {total / pipelined_elapsed:10,.0f}/s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-c', '--clients', default=8, type=int, dest='clients')
+    parser.add_option('-n', '--requests', default=2000, type=int, dest='requests',
+                      help='Round trips per client, pipelined runs send 10x as many.')
+    parser.add_option('-b', '--batch', default=100, type=int, dest='batch')
+    parser.add_option('-p', '--port', default=9100, type=int, dest='port')
+    options, _ = parser.parse_args()
+
+    for i, (name, flags) in enumerate(BACKENDS):
+        bench(name, flags, options.port + i, options)
+
+
+if __name__ == '__main__':
+    main()
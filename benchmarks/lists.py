@@ -0,0 +1,59 @@
+"""
+List commands on a long list, chunked against the deque it replaced, which
+was copied in full by every LRANGE and LTRIM.
+
+    python benchmarks/lists.py --items 5000000 --ops 10000
+"""
+from collections import deque
+from optparse import OptionParser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from quicklist import QuickList
+
+
+def timed(name, n, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<34} {elapsed:8.3f}s  {n / elapsed:12,.0f} ops/s')
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--items', default=5000000, type=int, dest='items')
+    parser.add_option('-o', '--ops', default=10000, type=int, dest='ops')
+    parser.add_option('-b', '--baseline-ops', default=20, type=int, dest='baseline_ops',
+                      help='Ranges and trims run against the deque, which copy it whole.')
+    options, _ = parser.parse_args()
+    n, ops, baseline = options.items, options.ops, options.baseline_ops
+    rnd = random.Random(0)
+    offsets = [rnd.randrange(n - 10) for _ in range(ops)]
+
+    for name, cls in (('quicklist', QuickList), ('deque', deque)):
+        print(f'\n{name}, {n:,} items')
+        items = cls()
+        timed('RPUSH', n, lambda: [items.append(i) for i in range(n)])
+        timed('LPUSH + LPOP', ops, lambda: [(items.appendleft(i), items.popleft())
+                                            for i in range(ops)])
+        timed('LINDEX at a random offset', ops, lambda: [items[i] for i in offsets])
+        if cls is QuickList:
+            timed('LRANGE 0 10', ops, lambda: [items.range(0, 10) for _ in range(ops)])
+            timed('LRANGE 10 at a random offset', ops,
+                  lambda: [items.range(i, i + 10) for i in offsets])
+            timed('LTRIM dropping 10 at each end', ops,
+                  lambda: [items.trim(10, -10) for _ in range(ops)])
+        else:
+            timed('LRANGE 0 10', baseline, lambda: [list(items)[0:10] for _ in range(baseline)])
+            timed('LRANGE 10 at a random offset', baseline,
+                  lambda: [list(items)[i:i + 10] for i in offsets[:baseline]])
+            timed('LTRIM dropping 10 at each end', baseline,
+                  lambda: [deque(list(items)[10:-10]) for _ in range(baseline)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+Load generator in the style of redis-benchmark, driving a running server
+through Client.
+
+Each test sends `--requests` commands from `--clients` concurrent clients,
+greenlets, threads or processes, `--pipeline` at a time, on keys picked at
+random among `--keyspace` of them. Tests run in the order given against the
+same keys, so reads find what the writes before them left. A `--mix` of
+weighted commands runs as one more test.
+
+    python benchmarks/load.py -p 8888 -c 50 -n 100000
+    python benchmarks/load.py -t get,set -P 16 -d 256 --mix get:8,set:2
+    python benchmarks/load.py --json > before.json
+    python benchmarks/load.py --compare before.json
+
+With --json every test is printed as a line of JSON, with the settings and
+the commit it ran against, --compare prints the change against such a file.
+"""
+from multiprocessing import Pool
+from optparse import OptionParser
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from client import Client
+from exc import CommandError
+
+
+DEFAULT_TESTS = 'set,get,incr,lpush,rpop,lrange,hset,hget,sadd,spop,sinter,zadd'
+
+
+def make_commands(keyspace, value):
+    """Command name -> function of a random.Random returning its arguments."""
+    def key(prefix, rnd):
+        return b'%s:%d' % (prefix, rnd.randrange(keyspace))
+
+    return {
+        'set': lambda rnd: (b'SET', key(b'key', rnd), value),
+        'get': lambda rnd: (b'GET', key(b'key', rnd)),
+        'incr': lambda rnd: (b'INCR', key(b'counter', rnd)),
+        'lpush': lambda rnd: (b'LPUSH', key(b'list', rnd), value),
+        'rpop': lambda rnd: (b'RPOP', key(b'list', rnd)),
+        'lrange': lambda rnd: (b'LRANGE', key(b'list', rnd), 0, 99),
+        'hset': lambda rnd: (b'HSET', key(b'hash', rnd), b'field:%d' % rnd.randrange(10), value),
+        'hget': lambda rnd: (b'HGET', key(b'hash', rnd), b'field:%d' % rnd.randrange(10)),
+        'sadd': lambda rnd: (b'SADD', key(b'set', rnd), b'member:%d' % rnd.randrange(100)),
+        'spop': lambda rnd: (b'SPOP', key(b'set', rnd)),
+        'sinter': lambda rnd: (b'SINTER', key(b'set', rnd), key(b'set', rnd)),
+        'zadd': lambda rnd: (b'ZADD', key(b'zset', rnd), rnd.random(),
+                             b'member:%d' % rnd.randrange(100)),
+    }
+
+
+def parse_mix(mix, commands):
+    names, weights = [], []
+    for part in mix.split(','):
+        name, _, weight = part.partition(':')
+        if name not in commands:
+            raise ValueError(f'unknown command {name!r} in mix')
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+def generator(test, options, seed):
+    """A function returning the arguments of the next command of `test`."""
+    rnd = random.Random(seed)
+    commands = make_commands(options.keyspace, b'x' * options.data_size)
+    if test != 'mix':
+        command = commands[test]
+        return lambda: command(rnd)
+    names, weights = parse_mix(options.mix, commands)
+    mixed = [commands[name] for name in names]
+    return lambda: rnd.choices(mixed, weights)[0](rnd)
+
+
+def run_client(args):
+    """Send `n` commands of `test`, returns the latency of each and the errors."""
+    test, n, seed, options = args
+    client = Client(options.host, options.port)
+    next_command = generator(test, options, seed)
+    depth = options.pipeline
+    latencies = []
+    errors = 0
+    for i in range(0, n, depth):
+        batch = min(depth, n - i)
+        start = time.perf_counter()
+        if batch == 1:
+            try:
+                client.execute(*next_command())
+            except CommandError:
+                errors += 1
+        else:
+            pipe = client.pipeline(batch)
+            for _ in range(batch):
+                pipe.execute(*next_command())
+            errors += sum(isinstance(result, CommandError) for result in pipe.send())
+        # every command of a pipelined batch waited for the whole of it
+        latencies += [time.perf_counter() - start] * batch
+    return latencies, errors
+
+
+def run_clients(jobs, concurrency):
+    if concurrency == 'process':
+        with Pool(len(jobs)) as pool:
+            return pool.map(run_client, jobs)
+    results = [None] * len(jobs)
+    def run(i):
+        results[i] = run_client(jobs[i])
+    if concurrency == 'greenlet':
+        import gevent
+        gevent.joinall([gevent.spawn(run, i) for i in range(len(jobs))], raise_error=True)
+    else:
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(jobs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def bench(test, options):
+    clients = options.clients
+    jobs = [(test, options.requests // clients + (i < options.requests % clients),
+             options.seed * clients + i, options) for i in range(clients)]
+    start = time.perf_counter()
+    results = run_clients(jobs, options.concurrency)
+    elapsed = time.perf_counter() - start
+    latencies = sorted(l for result, _ in results for l in result)
+    return {
+        'test': test,
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'seconds': round(elapsed, 3),
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, .5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, .99) * 1000, 3),
+        'p999_ms': round(percentile(latencies, .999) * 1000, 3),
+    }
+
+
+def commit():
+    # of the tree the benchmark is in, the server is assumed to run from it
+    try:
+        proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return proc.stdout.strip() or None
+
+
+def load_baseline(filename):
+    with open(filename) as fh:
+        rows = [json.loads(line) for line in fh if line.strip()]
+    return {row['test']: row for row in rows}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-H', '--host', default='127.0.0.1', dest='host')
+    parser.add_option('-p', '--port', default=8888, type=int, dest='port')
+    parser.add_option('-c', '--clients', default=50, type=int, dest='clients')
+    parser.add_option('-n', '--requests', default=100000, type=int, dest='requests',
+                      help='Commands per test, across all clients.')
+    parser.add_option('-P', '--pipeline', default=1, type=int, dest='pipeline',
+                      help='Commands sent at a time by each client.')
+    parser.add_option('-r', '--keyspace', default=10000, type=int, dest='keyspace',
+                      help='Keys of each type picked from at random.')
+    parser.add_option('-d', '--data-size', default=16, type=int, dest='data_size',
+                      help='Bytes per value.')
+    parser.add_option('-t', '--tests', default=DEFAULT_TESTS, dest='tests',
+                      help='Commands to benchmark, in order, any of ' + DEFAULT_TESTS)
+    parser.add_option('-m', '--mix', dest='mix',
+                      help='Weighted commands run as one test, e.g. get:8,set:2.')
+    parser.add_option('--concurrency', default='greenlet', type='choice', dest='concurrency',
+                      choices=('greenlet', 'thread', 'process'),
+                      help='What each client runs in.')
+    parser.add_option('--seed', default=0, type=int, dest='seed')
+    parser.add_option('--json', action='store_true', dest='json',
+                      help='Print each test as a line of JSON.')
+    parser.add_option('--compare', dest='compare',
+                      help='Output of an earlier --json run to compare against.')
+    options, _ = parser.parse_args()
+
+    if options.concurrency == 'greenlet':
+        from gevent import monkey; monkey.patch_all()
+    tests = [test for test in options.tests.split(',') if test]
+    commands = make_commands(options.keyspace, b'')
+    for test in tests:
+        if test not in commands:
+            parser.error(f'unknown test {test!r}')
+    if options.mix:
+        try:
+            parse_mix(options.mix, commands)
+        except ValueError as e:
+            parser.error(str(e))
+        tests.append('mix')
+    baseline = load_baseline(options.compare) if options.compare else {}
+    settings = {
+        'commit': commit(), 'clients': options.clients, 'pipeline': options.pipeline,
+        'keyspace': options.keyspace, 'data_size': options.data_size,
+        'concurrency': options.concurrency, 'mix': options.mix,
+    }
+
+    for test in tests:
+        result = bench(test, options)
+        if options.json:
+            print(json.dumps({**result, **settings}), flush=True)
+            continue
+        line = (f'{test:<8} {result["ops_per_sec"]:12,.0f} ops/s  '
+                f'p50 {result["p50_ms"]:8.3f}ms  p99 {result["p99_ms"]:8.3f}ms  '
+                f'p999 {result["p999_ms"]:8.3f}ms')
+        if result['errors']:
+            line += f'  {result["errors"]} errors'
+        before = baseline.get(test)
+        if before is not None:
+            line += f'  {result["ops_per_sec"] / before["ops_per_sec"] - 1:+.1%} ops/s'
+        print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
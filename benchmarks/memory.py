@@ -0,0 +1,93 @@
+"""
+Memory used by a synthetic keyspace of many small values, with the compact
+encodings of small hashes and sets and without.
+
+    python benchmarks/memory.py --keys 200000
+"""
+from collections import namedtuple
+from optparse import OptionParser
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from command_handler import CommandHandler
+from const import Value
+
+
+def commands(n, seed=0):
+    rnd = random.Random(seed)
+    for i in range(n):
+        kind = i % 4
+        key = b'key:%d' % i
+        if kind == 0:
+            yield (b'SET', key, b'value:%d' % i)
+        elif kind == 1:
+            fields = {b'field:%d' % j: b'v%d' % rnd.randrange(1000)
+                      for j in range(rnd.randint(2, 10))}
+            yield (b'HMSET', key, fields)
+        elif kind == 2:
+            yield (b'SADD', key, *[rnd.randrange(10**6) for _ in range(rnd.randint(2, 20))])
+        else:
+            yield (b'SADD', key, *[b'tag:%d' % rnd.randrange(100)
+                                   for _ in range(rnd.randint(2, 10))])
+
+
+def build(n, limits):
+    handler = CommandHandler(**limits)
+    for command in commands(n):
+        handler.execute(*command)
+    return handler
+
+
+def measure(n, **limits):
+    # timed on its own, tracing allocations slows everything down
+    start = time.perf_counter()
+    build(n, limits)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    handler = build(n, limits)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del handler
+    return used, elapsed
+
+
+def header_size(cls, n=100000):
+    tracemalloc.start()
+    values = [cls(0, None) for _ in range(n)]
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del values
+    return used / n
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--keys', default=200000, type=int, dest='keys')
+    options, _ = parser.parse_args()
+    n = options.keys
+
+    print(f'{n:,} keys: strings, hashes of 2-10 fields, sets of 2-20 integers '
+          'and of 2-10 strings')
+    full, full_time = measure(n, hash_max_entries=0, set_max_entries=0,
+                              set_max_intset_entries=0)
+    compact, compact_time = measure(n)
+    print(f'{"dicts and sets":<20} {full / 2**20:8.1f}MB  {full / n:6.0f} bytes/key  '
+          f'{full_time:6.2f}s to build')
+    print(f'{"compact encodings":<20} {compact / 2**20:8.1f}MB  {compact / n:6.0f} bytes/key  '
+          f'{compact_time:6.2f}s to build')
+    print(f'saved {1 - compact / full:.0%}')
+
+    OldValue = namedtuple('Value', ('data_type', 'value'))
+    print(f'\nvalue header: namedtuple {header_size(OldValue):.0f} bytes, '
+          f'slotted {header_size(Value):.0f} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Compare the binary snapshot format with the pickle based one it replaced.
+
+    python benchmarks/snapshot.py --keys 200000
+"""
+from optparse import OptionParser
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from const import Value, KV, HASH, QUEUE, SET
+from quicklist import QuickList
+from timing_wheel import TimingWheel, now_ms
+import snapshot
+
+
+def build_keyspace(n, collection_size):
+    kv = {}
+    expiry = TimingWheel()
+    deadline = now_ms() + 3600 * 1000
+    for i in range(n):
+        kind = i % 5
+        key = f'key:{i}'
+        if kind == 0:
+            kv[key] = Value(KV, b'x' * 64)
+        elif kind == 1:
+            kv[key] = Value(KV, i)
+            expiry.add(key, deadline)
+        elif kind == 2:
+            kv[key] = Value(HASH, {f'f{j}': j for j in range(collection_size)})
+        elif kind == 3:
+            kv[key] = Value(QUEUE, QuickList(b'item:%d' % j for j in range(collection_size)))
+        else:
+            kv[key] = Value(SET, {f'm{j}' for j in range(collection_size)})
+    return kv, expiry
+
+
+def pickle_dump(fh, kv, expiry, compress):
+    pickle.dump({'kv': kv}, fh, pickle.HIGHEST_PROTOCOL)
+
+
+def pickle_load(fh):
+    return pickle.load(fh)['kv']
+
+
+def snapshot_dump(compress):
+    def dump(fh, kv, expiry, _):
+        snapshot.dump(fh, kv, expiry, compress=compress)
+    return dump
+
+
+def measure(name, dump, load, kv, expiry, path):
+    start = time.perf_counter()
+    with open(path, 'wb') as fh:
+        dump(fh, kv, expiry, False)
+    dump_time = time.perf_counter() - start
+    size = os.path.getsize(path)
+
+    # memory allocated on top of the keyspace while writing it out
+    tracemalloc.start()
+    with open(path, 'wb') as fh:
+        dump(fh, kv, expiry, False)
+    _, dump_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    with open(path, 'rb') as fh:
+        load(fh)
+    load_time = time.perf_counter() - start
+
+    # allocations held while loading beyond the keyspace that was loaded
+    tracemalloc.start()
+    with open(path, 'rb') as fh:
+        loaded = load(fh)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+
+    print(f'{name:<18} dump {dump_time:7.3f}s  load {load_time:7.3f}s  '
+          f'size {size / 2**20:7.1f}MB  dump peak {dump_peak / 2**20:7.1f}MB  '
+          f'load peak/retained {peak / max(current, 1):5.2f}x')
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--keys', default=100000, type=int, dest='keys')
+    parser.add_option('-c', '--collection-size', default=20, type=int,
+                      dest='collection_size')
+    options, _ = parser.parse_args()
+
+    kv, expiry = build_keyspace(options.keys, options.collection_size)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'dump')
+        measure('pickle', pickle_dump, pickle_load, kv, expiry, path)
+        measure('snapshot', snapshot_dump(False), lambda fh: snapshot.load(fh)[0],
+                kv, expiry, path)
+        measure('snapshot+zlib', snapshot_dump(True), lambda fh: snapshot.load(fh)[0],
+                kv, expiry, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Sorted set operations at 1M members, against what they replace: a hash of
+member to score sorted client side on every read, and a single sorted list
+kept up to date with bisect.insort.
+
+    python benchmarks/zset.py --members 1000000 --ops 100000
+"""
+from bisect import insort, bisect_left
+from optparse import OptionParser
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from const import Value, ZSET
+from sorted_set import SortedSet
+from timing_wheel import TimingWheel
+import snapshot
+
+
+def timed(name, n, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<34} {elapsed:8.3f}s  {n / elapsed:12,.0f} ops/s')
+    return elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--members', default=1000000, type=int, dest='members')
+    parser.add_option('-o', '--ops', default=100000, type=int, dest='ops')
+    parser.add_option('-b', '--baseline-ops', default=5, type=int, dest='baseline_ops',
+                      help='Operations run against the baselines, which are O(n) each.')
+    options, _ = parser.parse_args()
+    n, ops = options.members, options.ops
+
+    rnd = random.Random(0)
+    members = [b'player:%d' % i for i in range(n)]
+    scores = [rnd.randint(0, 10 * n) for _ in range(n)]
+    picks = [rnd.randrange(n) for _ in range(ops)]
+
+    print(f'{n:,} members')
+    zset = SortedSet()
+    timed('ZADD one at a time', n, lambda: [zset.add(m, s) for m, s in zip(members, scores)])
+    timed('ZADD bulk (snapshot load)', n, lambda: SortedSet(zip(members, scores)))
+
+    def update():
+        for i in picks:
+            zset.add(members[i], zset.score(members[i]) + rnd.randint(1, 100))
+    timed('ZINCRBY', ops, update)
+    timed('ZSCORE', ops, lambda: [zset.score(members[i]) for i in picks])
+    timed('ZRANK', ops, lambda: [zset.rank(members[i]) for i in picks])
+    timed('ZREVRANGE top 10', ops, lambda: [zset.range(0, 9, reverse=True) for _ in range(ops)])
+    timed('ZRANGE 10 at a random offset', ops,
+          lambda: [zset.range(i, i + 9) for i in picks])
+    timed('ZRANGEBYSCORE window of ~10', ops,
+          lambda: [zset.range_by_score(s, s + 100) for s in (scores[i] for i in picks)])
+    timed('ZREM + ZADD', ops, lambda: [(zset.remove(members[i]), zset.add(members[i], scores[i]))
+                                       for i in picks])
+
+    baseline = options.baseline_ops
+    print(f'\nbaselines, {baseline} operations')
+    hash_scores = dict(zip(members, scores))
+    timed('HGETALL + sort for top 10', baseline,
+          lambda: [sorted(hash_scores.items(), key=lambda kv: kv[1], reverse=True)[:10]
+                   for _ in range(baseline)])
+    ordered = sorted(zip(scores, members))
+    def insort_update():
+        for i in picks[:baseline]:
+            entry = (scores[i], members[i])
+            del ordered[bisect_left(ordered, entry)]
+            insort(ordered, (scores[i] + 1, members[i]))
+    timed('sorted list update (insort)', baseline, insort_update)
+
+    print()
+    kv = {b'leaderboard': Value(ZSET, zset)}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'dump')
+        with open(path, 'wb') as fh:
+            timed('snapshot dump', n, lambda: snapshot.dump(fh, kv, TimingWheel()))
+        with open(path, 'rb') as fh:
+            timed('snapshot load', n, lambda: snapshot.load(fh))
+    timed('ZPOPMIN everything', n, lambda: zset.pop(n))
+
+
+if __name__ == '__main__':
+    main()